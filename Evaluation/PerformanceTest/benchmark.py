@@ -0,0 +1,548 @@
+"""Offline benchmarks of the analysis, diff and version lookup hot paths.
+
+Synthetic cells of increasing size and nesting depth, magic heavy cells and
+the notebooks in this repository are run through ``analyze.analyze``,
+``check_files``, the module version lookup, the diff, the serialization of the
+analysis results and the ``/mlprovlab/diff`` and ``/mlprovlab/analyze``
+handlers of a server on the loopback interface.
+The results are written as JSON, with the scaling exponent (slope of the
+time over the size on a log-log scale) of every benchmark, and two result
+files can be compared to find regressions.
+
+Run from the root of the repository with mlprovlab installed in development
+mode (the handler benchmarks also need jupyter_server):
+
+    python Evaluation/PerformanceTest/benchmark.py run --output results.json
+    python Evaluation/PerformanceTest/benchmark.py compare baseline.json results.json
+"""
+import argparse
+import ast
+import gzip
+import itertools
+import json
+import math
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import timeit
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+
+from mlprovlab import analyze, datasources, diff, versions, wire
+
+REPOSITORY = Path(__file__).resolve().parents[2]
+
+# Version of the format of the result files
+RESULT_FORMAT = 1
+
+benchmarks = {}
+
+
+def benchmark(name: str, sizes, quick_sizes=None):
+    """Registers a benchmark.
+
+    The decorated function is called with a size and returns the function
+    that is timed, so setting up the input is not measured. If the timed
+    function has an ``output_bytes`` attribute it is reported with the time.
+    """
+    def register(setup):
+        benchmarks[name] = {"setup": setup, "sizes": list(sizes), "quick_sizes": list(quick_sizes or sizes[:2]),
+                            "description": (setup.__doc__ or "").strip()}
+        return setup
+    return register
+
+
+# Synthetic cells
+
+def flat_cell(statements: int) -> str:
+    templates = [
+        "v{i} = pd.read_csv('data/file{m}.csv')",
+        "v{i} = v{p} + {i}",
+        "def f{i}(x, y={i}):\n    z = x + v{p}\n    return z * y",
+        "for k{i} in range(v{p}):\n    v{i} = k{i} + 1",
+        "class C{i}:\n    a = {i}\n    def m(self):\n        return self.a + v{p}",
+        "v{i} = [x for x in range({i}) if x > v{p}]",
+        "if v{p} > {i}:\n    v{i} = 1\nelse:\n    v{i} = 2",
+        "print(v{p}, 'text {i}')"
+    ]
+    lines = ["import pandas as pd", "v0 = 0"]
+    for i in range(1, statements + 1):
+        lines.append(templates[i % len(templates)].format(i=i, p=i - 1, m=i % 10))
+    return "\n".join(lines) + "\n"
+
+
+def nested_cell(depth: int) -> str:
+    blocks = ["def f{i}(a{i}):", "for k{i} in range(a{p}):", "if k{p} > {i}:", "while a{p} < {i}:",
+              "with open('file{i}.txt') as h{i}:"]
+    lines = ["a0 = 10", "k0 = 0"]
+    for i in range(1, depth + 1):
+        indent = "    " * (i - 1)
+        lines.append(indent + blocks[i % len(blocks)].format(i=i, p=i - 1))
+        lines.append(indent + "    a{i} = a{p} + k{p}".format(i=i, p=i - 1))
+        lines.append(indent + "    k{i} = a{i} * 2".format(i=i))
+    return "\n".join(lines) + "\n"
+
+
+def magic_cell(statements: int) -> str:
+    templates = ["%matplotlib inline", "!pip list", "files{i} = !ls data", "%time v{i} = v{p} + 1", "v{p}?",
+                 "v{i} = v{p} * 2", "%load_ext autoreload", "v{i} = len(files{p}) if 'files{p}' in dir() else 0"]
+    lines = ["%%capture", "v0 = 0"]
+    for i in range(1, statements + 1):
+        lines.append(templates[i % len(templates)].format(i=i, p=i - 1))
+    return "\n".join(lines) + "\n"
+
+
+def edited(code: str, counter) -> str:
+    # The cell with one changed line, as after a typical edit
+    return code + f"v_edit = {next(counter)}\n"
+
+
+def notebook_cells(path: Path) -> list:
+    with path.open(encoding="utf-8") as file:
+        notebook = json.load(file)
+    cells = []
+    for cell in notebook.get("cells", []):
+        if cell.get("cell_type") == "code":
+            source = cell.get("source", "")
+            cells.append(source if isinstance(source, str) else "".join(source))
+    return cells
+
+
+# Analysis
+
+@benchmark("analyze/flat", (10, 100, 1000, 5000))
+def bench_analyze_flat(size):
+    """analyze.analyze of a cell with ``size`` top level statements, without memoized statements."""
+    code = flat_cell(size)
+
+    def run():
+        analyze.statement_memo.clear()
+        analyze.analyze(code)
+    return run
+
+
+@benchmark("analyze/flat_edit", (10, 100, 1000, 5000))
+def bench_analyze_flat_edit(size):
+    """analyze.analyze of a cell with ``size`` top level statements after changing one line."""
+    code = flat_cell(size)
+    counter = itertools.count()
+    analyze.analyze(code)
+    return lambda: analyze.analyze(edited(code, counter))
+
+
+@benchmark("analyze/nested", (5, 10, 25, 50))
+def bench_analyze_nested(size):
+    """analyze.analyze of a cell with blocks nested ``size`` levels deep."""
+    code = nested_cell(size)
+
+    def run():
+        analyze.statement_memo.clear()
+        analyze.analyze(code)
+    return run
+
+
+@benchmark("analyze/magics", (10, 100, 1000, 5000))
+def bench_analyze_magics(size):
+    """analyze.analyze of a cell with ``size`` lines of which most are IPython magics or shell commands."""
+    code = magic_cell(size)
+
+    def run():
+        analyze.statement_memo.clear()
+        analyze.analyze(code)
+    return run
+
+
+@benchmark("check_files/strings", (10, 100, 1000, 10000))
+def bench_check_files(size):
+    """check_files of a statement with ``size`` string constants (existing files, URLs and other strings)."""
+    directory = tempfile.mkdtemp(prefix="mlprovlab-benchmark-")
+    for index in range(10):
+        Path(directory, f"file{index}.csv").write_text("a,b\n1,2\n")
+    values = []
+    for index in range(size):
+        kind = index % 3
+        if kind == 0:
+            values.append(os.path.join(directory, f"file{index % 10}.csv"))
+        elif kind == 1:
+            values.append(f"https://example.org/data/{index}.csv")
+        else:
+            values.append(f"label {index}")
+    element = ast.parse("data = " + repr(values)).body[0]
+
+    def run():
+        datasources.stat_cache.clear()
+        analyze.check_files(element, [], [])
+    return run
+
+
+# Module versions
+
+def _module_names() -> list:
+    names = set(sys.builtin_module_names)
+    for path in sys.path:
+        try:
+            names.update(re.sub(r"\.py$", "", entry) for entry in os.listdir(path or ".")
+                         if entry.isidentifier() or entry.endswith(".py"))
+        except OSError:
+            pass
+    return sorted(names)
+
+
+@benchmark("versions/index", (1,), (1,))
+def bench_versions_index(size):
+    """Building the index of the installed distributions and the first lookup."""
+    return lambda: versions.VersionResolver().get_version("numpy")
+
+
+@benchmark("versions/lookup", (100, 1000, 10000))
+def bench_versions_lookup(size):
+    """``size`` lookups of installed and unknown (sub)modules with an existing index."""
+    names = _module_names()
+    modules = [name + (".sub" if index % 4 == 0 else "") for index, name in
+               zip(range(size), itertools.cycle(names + ["unknown_module"]))]
+    resolver = versions.VersionResolver()
+    resolver.get_version("numpy")
+
+    def run():
+        for module in modules:
+            resolver.get_version(module)
+    return run
+
+
+# Diff
+
+def diff_sources(size: int, rewrite: bool) -> tuple:
+    old = flat_cell(size).splitlines()
+    if rewrite:
+        new = [line.replace("v", "w") + "  # changed" for line in old]
+    else:
+        new = [line + "  # changed" if index % 10 == 5 else line for index, line in enumerate(old)]
+    return "\n".join(old) + "\n", "\n".join(new) + "\n"
+
+
+@benchmark("diff/edit", (100, 1000, 10000))
+def bench_diff_edit(size):
+    """diff.diff of a cell with ``size`` statements where every tenth line changed."""
+    old, new = diff_sources(size, False)
+    return lambda: diff.diff(old, new)
+
+
+@benchmark("diff/rewrite", (100, 1000, 10000))
+def bench_diff_rewrite(size):
+    """diff.diff of a cell with ``size`` statements where every line changed."""
+    old, new = diff_sources(size, True)
+    return lambda: diff.diff(old, new)
+
+
+# Wire format of the analysis results
+
+def serialized(serialize, result: dict):
+    # The size of the output is reported with the time
+    def run():
+        return serialize(result)
+    run.output_bytes = len(run())
+    return run
+
+
+@benchmark("wire/json", (100, 1000, 5000))
+def bench_wire_json(size):
+    """json.dumps of the analysis result of a cell with ``size`` statements, the default response."""
+    return serialized(lambda result: json.dumps(result).encode("utf-8"), analyze.analyze_cell(flat_cell(size)))
+
+
+@benchmark("wire/compact", (100, 1000, 5000))
+def bench_wire_compact(size):
+    """wire.encode and wire.dumps of the analysis result of a cell with ``size`` statements."""
+    return serialized(lambda result: wire.dumps(wire.encode(result)), analyze.analyze_cell(flat_cell(size)))
+
+
+@benchmark("wire/compact_gzip", (100, 1000, 5000))
+def bench_wire_compact_gzip(size):
+    """The compact analysis result of a cell with ``size`` statements, compressed like large responses."""
+    return serialized(lambda result: gzip.compress(wire.dumps(wire.encode(result)), wire.GZIP_LEVEL),
+                      analyze.analyze_cell(flat_cell(size)))
+
+
+# Handlers
+
+class Server:
+    """Jupyter server handlers of mlprovlab on the loopback interface, in a thread of its own."""
+
+    def __init__(self):
+        self.url = None
+        self._loop = None
+        self._thread = None
+        self._directory = tempfile.TemporaryDirectory(prefix="mlprovlab-benchmark-")
+
+    def start(self):
+        # The provenance store of the handlers is created in a temporary directory
+        os.environ["JUPYTER_DATA_DIR"] = self._directory.name
+        started = threading.Event()
+        errors = []
+
+        def serve():
+            import asyncio
+            import tornado.httpserver
+            import tornado.netutil
+            import tornado.web
+            from mlprovlab.handlers import setup_handlers
+
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                app = tornado.web.Application(base_url="/")
+                setup_handlers(app)
+                sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+                server = tornado.httpserver.HTTPServer(app)
+                server.add_sockets(sockets)
+                self.url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}/mlprovlab/"
+            except Exception as error:
+                errors.append(error)
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+    def post(self, endpoint: str, body) -> bytes:
+        request = urllib.request.Request(self.url + endpoint, data=json.dumps(body).encode("utf-8"), method="POST",
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            return response.read()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._directory.cleanup()
+
+
+server = Server()
+
+
+@benchmark("handler/analyze", (10, 100, 1000))
+def bench_handler_analyze(size):
+    """POST /mlprovlab/analyze of a cell with ``size`` statements, changed every time so the result cache is missed."""
+    code = flat_cell(size)
+    counter = itertools.count()
+    server.post("analyze", code)
+    return lambda: server.post("analyze", {"cell_id": "benchmark", "source": edited(code, counter)})
+
+
+@benchmark("handler/diff", (100, 1000))
+def bench_handler_diff(size):
+    """POST /mlprovlab/diff returning the ndiff text of a cell with ``size`` statements where every tenth line changed."""
+    old, new = diff_sources(size, False)
+    return lambda: server.post("diff", {"old": old, "current": new})
+
+
+@benchmark("handler/diff_hunks", (100, 1000, 10000))
+def bench_handler_diff_hunks(size):
+    """POST /mlprovlab/diff?format=hunks of a cell with ``size`` statements where every tenth line changed."""
+    old, new = diff_sources(size, False)
+    counter = itertools.count()
+    return lambda: server.post("diff?format=hunks", {"old": old, "current": edited(new, counter)})
+
+
+# Notebooks of the repository
+
+def notebook_benchmarks():
+    for path in sorted(REPOSITORY.glob("**/*.ipynb")):
+        if "node_modules" in path.parts or ".ipynb_checkpoints" in path.parts:
+            continue
+        cells = notebook_cells(path)
+        if not cells:
+            continue
+
+        def setup(size, cells=cells):
+            def run():
+                analyze.statement_memo.clear()
+                for cell in cells:
+                    analyze.analyze(cell)
+            return run
+        setup.__doc__ = "analyze.analyze of every code cell of the notebook."
+        benchmark("notebook/" + path.relative_to(REPOSITORY).as_posix(), (len(cells),), (len(cells),))(setup)
+
+
+# Running and comparing
+
+def measure(run, repeat: int, min_time: float) -> dict:
+    # Calls are repeated until one sample takes at least min_time, the time per call is reported
+    run()
+    timer = timeit.Timer(run)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1000000:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    samples = [elapsed / number] + [sample / number for sample in timer.repeat(repeat - 1, number)]
+    return {"min": min(samples), "median": statistics.median(samples), "mean": statistics.fmean(samples),
+            "repeat": repeat, "number": number}
+
+
+def scaling(results: list):
+    """Returns the least squares slope of the median time over the size on a log-log scale."""
+    points = [(math.log(result["size"]), math.log(result["median"])) for result in results
+              if result["size"] > 0 and result["median"] > 0]
+    if len(points) < 2:
+        return None
+    mean_x = statistics.fmean(x for x, _ in points)
+    mean_y = statistics.fmean(y for _, y in points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def run_benchmarks(pattern: str, repeat: int, min_time: float, quick: bool) -> dict:
+    notebook_benchmarks()
+    selected = [name for name in benchmarks if re.search(pattern, name)]
+    output = {
+        "format": RESULT_FORMAT,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "mlprovlab": _mlprovlab_version(),
+        "benchmarks": {},
+        "skipped": {}
+    }
+
+    if any(name.startswith("handler/") for name in selected):
+        try:
+            server.start()
+        except ImportError as error:
+            for name in [name for name in selected if name.startswith("handler/")]:
+                output["skipped"][name] = f"jupyter_server is not available: {error}"
+                selected.remove(name)
+    try:
+        for name in selected:
+            entry = benchmarks[name]
+            results = []
+            for size in entry["quick_sizes"] if quick else entry["sizes"]:
+                run = entry["setup"](size)
+                result = {"size": size, **measure(run, repeat, min_time)}
+                if hasattr(run, "output_bytes"):
+                    result["bytes"] = run.output_bytes
+                results.append(result)
+                print(f"{name:<40} {size:>8} {_format_time(result['median']):>12} "
+                      f"{result['bytes'] if 'bytes' in result else '':>10}", file=sys.stderr)
+            output["benchmarks"][name] = {"description": entry["description"], "scaling": scaling(results),
+                                          "results": results}
+    finally:
+        server.stop()
+    return output
+
+
+def compare(baseline: dict, current: dict, threshold: float, min_delta: float, scaling_threshold: float) -> tuple:
+    """Returns the lines of the comparison report and whether a regression was found."""
+    lines = []
+    regression = False
+    for name, entry in current["benchmarks"].items():
+        base_entry = baseline["benchmarks"].get(name)
+        if base_entry is None:
+            lines.append(f"{name:<40} {'':>8} new")
+            continue
+        base_results = {result["size"]: result for result in base_entry["results"]}
+        for result in entry["results"]:
+            base = base_results.get(result["size"])
+            if base is None:
+                continue
+            ratio = result["median"] / base["median"] if base["median"] else float("inf")
+            flag = ""
+            if ratio > 1 + threshold and result["median"] - base["median"] > min_delta:
+                flag = "REGRESSION"
+                regression = True
+            elif ratio < 1 / (1 + threshold) and base["median"] - result["median"] > min_delta:
+                flag = "improvement"
+            lines.append(f"{name:<40} {result['size']:>8} {_format_time(base['median']):>12} "
+                         f"{_format_time(result['median']):>12} {ratio:>7.2f}x {flag}")
+        if entry.get("scaling") is not None and base_entry.get("scaling") is not None:
+            change = entry["scaling"] - base_entry["scaling"]
+            flag = ""
+            if change > scaling_threshold:
+                flag = "SCALING REGRESSION"
+                regression = True
+            lines.append(f"{name:<40} {'scaling':>8} {base_entry['scaling']:>12.2f} {entry['scaling']:>12.2f} "
+                         f"{change:>+7.2f}  {flag}")
+    for name in baseline["benchmarks"]:
+        if name not in current["benchmarks"]:
+            lines.append(f"{name:<40} {'':>8} missing")
+    return lines, regression
+
+
+def _format_time(seconds: float) -> str:
+    for unit, factor in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= factor:
+            return f"{seconds / factor:.3f} {unit}"
+    return f"{seconds / 1e-9:.1f} ns"
+
+
+def _mlprovlab_version():
+    try:
+        from mlprovlab import __version__
+        return __version__
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of MLProvLab.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks and write the results as JSON.")
+    run_parser.add_argument("--output", "-o", help="File for the results, printed if not given.")
+    run_parser.add_argument("--filter", "-k", default="", help="Only run benchmarks whose name matches this regex.")
+    run_parser.add_argument("--repeat", type=int, default=5, help="Number of samples per size.")
+    run_parser.add_argument("--min-time", type=float, default=0.05, help="Minimum seconds per sample.")
+    run_parser.add_argument("--quick", action="store_true", help="Only run the smallest sizes.")
+    run_parser.add_argument("--list", action="store_true", help="List the benchmarks instead of running them.")
+
+    compare_parser = commands.add_parser("compare", help="Compare results and exit with 1 on a regression.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.2,
+                                help="Allowed relative slowdown of the median time (0.2 is 20 percent).")
+    compare_parser.add_argument("--min-delta", type=float, default=1e-4,
+                                help="Slowdowns of less than this many seconds are ignored as noise.")
+    compare_parser.add_argument("--scaling-threshold", type=float, default=0.25,
+                                help="Allowed increase of the scaling exponent.")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        if args.list:
+            notebook_benchmarks()
+            for name, entry in benchmarks.items():
+                print(f"{name:<40} {entry['description']}")
+            return 0
+        output = run_benchmarks(args.filter, max(args.repeat, 1), args.min_time, args.quick)
+        text = json.dumps(output, indent=2)
+        if args.output:
+            Path(args.output).write_text(text + "\n", encoding="utf-8")
+        else:
+            print(text)
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+    with open(args.current, encoding="utf-8") as file:
+        current = json.load(file)
+    lines, regression = compare(baseline, current, args.threshold, args.min_delta, args.scaling_threshold)
+    print(f"{'benchmark':<40} {'size':>8} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    print("\n".join(lines))
+    return 1 if regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
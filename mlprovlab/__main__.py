@@ -0,0 +1,132 @@
+"""Command line interface of MLProvLab.
+
+    python -m mlprovlab extract notebooks/ --output provenance.ndjson --checkpoint provenance.checkpoint
+    python -m mlprovlab compact notebooks/
+"""
+import argparse
+import json
+import os
+import sys
+
+from jupyter_core.paths import jupyter_data_dir
+
+from . import bulk, compaction
+from .store import ProvenanceStore
+
+DEFAULT_STORE = os.path.join(jupyter_data_dir(), "mlprovlab", "provenance.sqlite")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m mlprovlab", description="MLProvLab without JupyterLab.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract_parser = commands.add_parser(
+        "extract", help="Extract the provenance of notebooks as NDJSON, one line per notebook.")
+    extract_parser.add_argument("paths", nargs="+", help="Notebooks and directories that are searched for notebooks.")
+    extract_parser.add_argument("--output", "-o", help="NDJSON file, appended to if it exists. Printed if not given.")
+    extract_parser.add_argument("--checkpoint", "-c",
+                                help="File with the notebooks that were processed. Unchanged notebooks are skipped "
+                                     "and interrupted runs continue where they stopped.")
+    extract_parser.add_argument("--workers", "-j", type=int, default=None,
+                                help="Worker processes, the number of CPUs by default.")
+    extract_parser.add_argument("--fingerprints", action="store_true",
+                                help="Add size, modification time and hash of the local data files.")
+    extract_parser.add_argument("--definitions", action="store_true",
+                                help="Add the definitions found in every cell.")
+    extract_parser.add_argument("--store", default=DEFAULT_STORE,
+                                help="Provenance store of the server, for notebooks that only point to their "
+                                     "provenance (default: %(default)s).")
+
+    compact_parser = commands.add_parser(
+        "compact", help="Move the provenance in the metadata of notebooks into the store and compact the store.")
+    compact_parser.add_argument("paths", nargs="*",
+                                help="Notebooks and directories that are searched for notebooks. Without paths all "
+                                     "provenance in the store is compacted.")
+    compact_parser.add_argument("--store", default=DEFAULT_STORE,
+                                help="Provenance store of the server (default: %(default)s).")
+    compact_parser.add_argument("--no-deltas", action="store_true",
+                                help="Store every source in full instead of as delta against the one before.")
+    compact_parser.add_argument("--max-output-size", type=int, default=None,
+                                help="Do not store outputs larger than this many bytes. This loses data, by default "
+                                     "all outputs are kept.")
+    compact_parser.add_argument("--dry-run", "-n", action="store_true",
+                                help="Only report the bytes that would be saved.")
+    compact_parser.add_argument("--vacuum", action="store_true",
+                                help="Shrink the database file afterwards, only while the server is not running.")
+    args = parser.parse_args(argv)
+
+    if args.command == "extract":
+        checkpoint = bulk.Checkpoint(args.checkpoint)
+        output = open(args.output, "a", encoding="utf-8") if args.output else sys.stdout
+
+        def log(message):
+            print(message, file=sys.stderr)
+
+        try:
+            counts = bulk.run(args.paths, output, checkpoint, args.workers, args.fingerprints, args.definitions,
+                              args.store, log)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        print(f"{counts['processed']} processed, {counts['skipped']} unchanged, {counts['failed']} failed",
+              file=sys.stderr)
+        return 1 if counts["failed"] else 0
+
+    if args.command == "compact":
+        return compact(args)
+
+
+def compact(args) -> int:
+    store = ProvenanceStore(args.store, not args.no_deltas, args.max_output_size)
+    saved = 0
+    failed = 0
+    try:
+        if args.paths:
+            store_ids = []
+            for path in bulk.find_notebooks(args.paths):
+                try:
+                    result = compaction.migrate_notebook(path, store, args.dry_run)
+                except (OSError, ValueError, AttributeError) as error:
+                    print(f"{path}: {error}", file=sys.stderr)
+                    failed += 1
+                    continue
+                if result["migrated"]:
+                    saved += result["before"] - result["after"] - result["stored"]
+                    print(f"{path}: {format_bytes(result['before'])} -> {format_bytes(result['after'])} "
+                          f"and {format_bytes(result['stored'])} in the store")
+                else:
+                    store_ids.append(_store_id(path))
+            store_ids = [store_id for store_id in dict.fromkeys(store_ids) if store_id and store.exists(store_id)]
+        else:
+            store_ids = store.stores()
+
+        for store_id in store_ids:
+            result = store.compact(store_id, args.dry_run)
+            if result["records"]:
+                saved += result["before"] - result["after"]
+                print(f"{store_id}: {result['records']} records, {format_bytes(result['before'])} -> "
+                      f"{format_bytes(result['after'])}")
+        if args.vacuum and not args.dry_run:
+            store.vacuum()
+    finally:
+        store.close()
+    print(f"{format_bytes(saved)} {'would be ' if args.dry_run else ''}saved", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def _store_id(path: str):
+    # Id of the store a notebook in the new format points to
+    with open(path, encoding="utf-8") as file:
+        provenance = json.load(file).get("metadata", {}).get("provenance")
+    return provenance.get("store") if isinstance(provenance, dict) else None
+
+
+def format_bytes(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return f"{size} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""Provenance extraction of notebook directories without a Jupyter server.
+
+Every code cell of every notebook is analyzed in a pool of worker processes.
+One line of NDJSON is written per notebook, as soon as it is done, with the
+dependency graph between its cells, the imported modules with their versions
+in the environment of the extraction, the detected data sources and a
+summary of the provenance that was recorded in the notebook. A checkpoint
+file keeps the size, modification time and hash of every processed notebook,
+so an interrupted run can be resumed and notebooks that did not change since
+the last run are skipped.
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from . import analyze, datasources
+from .graph import DependencyGraph
+from .store import ProvenanceStore
+
+# Version of the format of the checkpoint files
+CHECKPOINT_FORMAT = 1
+
+# Seconds between two writes of the checkpoint
+CHECKPOINT_INTERVAL = 10
+
+# Directories that never contain notebooks of interest
+SKIPPED_DIRECTORIES = {".ipynb_checkpoints", ".git", "node_modules", "__pycache__"}
+
+
+class Checkpoint:
+    """Size, modification time and hash of the notebooks that were processed, by path."""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.notebooks = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                data = json.load(file)
+            if data.get("format") == CHECKPOINT_FORMAT:
+                self.notebooks = data.get("notebooks", {})
+
+    def unchanged(self, path: str, info: os.stat_result) -> bool:
+        """Whether the notebook has the same size and modification time as when it was processed."""
+        entry = self.notebooks.get(path)
+        return entry is not None and entry["size"] == info.st_size and entry["mtime_ns"] == info.st_mtime_ns
+
+    def sha256(self, path: str):
+        entry = self.notebooks.get(path)
+        return entry["sha256"] if entry else None
+
+    def update(self, path: str, size: int, mtime_ns: int, sha256: str):
+        self.notebooks[path] = {"size": size, "mtime_ns": mtime_ns, "sha256": sha256}
+
+    def save(self):
+        if not self.path:
+            return
+        # Written to a temporary file first so an interrupted write does not lose the checkpoint
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump({"format": CHECKPOINT_FORMAT, "notebooks": self.notebooks}, file)
+        os.replace(temporary, self.path)
+
+
+def find_notebooks(paths: list):
+    """Yields the notebooks in the given files and directories, directories are walked in sorted order."""
+    for path in paths:
+        if os.path.isfile(path):
+            yield os.path.abspath(path)
+            continue
+        for directory, directories, files in os.walk(path):
+            directories[:] = sorted(name for name in directories if name not in SKIPPED_DIRECTORIES)
+            for name in sorted(files):
+                if name.endswith(".ipynb"):
+                    yield os.path.abspath(os.path.join(directory, name))
+
+
+def extract(path: str, previous_sha256: str = None, fingerprints: bool = False, definitions: bool = False,
+            store_path: str = None) -> dict:
+    """Extracts the provenance of one notebook, runs in the worker processes.
+
+    Returns ``{"unchanged": True, ...}`` without analyzing the notebook if its
+    content has the hash ``previous_sha256``.
+    """
+    info = os.stat(path)
+    with open(path, "rb") as file:
+        content = file.read()
+    sha256 = hashlib.sha256(content).hexdigest()
+    result = {"path": path, "size": info.st_size, "mtime_ns": info.st_mtime_ns, "sha256": sha256}
+    if sha256 == previous_sha256:
+        return dict(result, unchanged=True)
+
+    start = time.perf_counter()
+    try:
+        notebook = json.loads(content)
+        cells = notebook.get("cells", [])
+        metadata = notebook.get("metadata", {})
+    except (ValueError, AttributeError) as error:
+        return dict(result, error=f"Not a notebook: {error}")
+
+    # Relative paths of data files are resolved like in the kernel, from the directory of the notebook
+    directory = os.getcwd()
+    os.chdir(os.path.dirname(path))
+    # The cached checks of relative paths belong to the directory of the notebook before
+    datasources.stat_cache.clear()
+    try:
+        result.update(_analyze_cells(cells, fingerprints, definitions))
+    finally:
+        os.chdir(directory)
+    provenance = metadata.get("provenance") if isinstance(metadata, dict) else None
+    if isinstance(provenance, dict) and provenance:
+        result["provenance"] = _recorded_provenance(provenance, store_path)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def _analyze_cells(cells: list, fingerprints: bool, definitions: bool) -> dict:
+    graph = DependencyGraph()
+    nodes = []
+    modules = {}
+    data_sources = {}
+    for index, cell in enumerate(cells):
+        if not isinstance(cell, dict) or cell.get("cell_type") != "code":
+            continue
+        source = cell.get("source", "")
+        source = source if isinstance(source, str) else "".join(source)
+        cell_metadata = cell.get("metadata", {})
+        # The id of the cell in the recorded provenance, if it was executed with MLProvLab
+        cell_id = cell_metadata.get("prov_id") or cell.get("id") or str(index)
+        analysis = analyze.analyze_cell(source, fingerprints)
+
+        graph.add(analysis)
+        node = {"index": index, "cell_id": cell_id, "execution_count": cell.get("execution_count"),
+                "local": analysis["local"], "remote": analysis["remote"], "imports": analysis["imports"],
+                "data_vars": analysis["data_vars"], "data_values": analysis["data_values"],
+                "dropped_lines": analysis["dropped_lines"]}
+        if definitions:
+            node["definitions"] = analysis["definitions"]
+        nodes.append(node)
+        modules.update(analysis["modules"])
+        for value in analysis["data_values"]:
+            data_sources.setdefault(value, {"cells": []})["cells"].append(index)
+        for value, fingerprint in analysis.get("data_fingerprints", {}).items():
+            data_sources[value]["fingerprint"] = fingerprint
+
+    # Edges point from the cell that last defined a variable before to the cell using it, in notebook order
+    edges = [dict(edge, source=nodes[edge["source"]]["index"], target=nodes[edge["target"]]["index"])
+             for edge in graph.edges(imports=True)]
+    return {"cells": nodes, "edges": edges, "modules": modules, "data_sources": data_sources}
+
+
+def _recorded_provenance(provenance: dict, store_path: str) -> dict:
+    # The old metadata format contains the epochs, the new one only the id of the store of the server
+    if isinstance(provenance.get("epochs"), list):
+        epochs = [(epoch, epoch.get("data", [])) for epoch in provenance["epochs"]]
+        return {"format": "metadata", "epochs": [_recorded_epoch(index, epoch, records)
+                                                 for index, (epoch, records) in enumerate(epochs)]}
+    store_id = provenance.get("store")
+    if not store_id:
+        return {"format": "unknown"}
+    if not store_path or not os.path.exists(store_path):
+        return {"format": "store", "store": store_id, "error": "Provenance store not available"}
+    store = ProvenanceStore(store_path)
+    try:
+        if not store.exists(store_id):
+            return {"format": "store", "store": store_id, "error": "Unknown provenance store"}
+        return {"format": "store", "store": store_id,
+                "epochs": [_recorded_epoch(epoch["epoch"], epoch, store.iter_executions(store_id, epoch["epoch"]))
+                           for epoch in store.iter_epochs(store_id)]}
+    finally:
+        store.close()
+
+
+def _recorded_epoch(index: int, epoch: dict, records) -> dict:
+    graph = DependencyGraph()
+    executions = 0
+    data_sources = set()
+    for record in records:
+        graph.add(record)
+        executions += 1
+        data_sources.update(datasources.used_sources(record))
+    return {"epoch": index, "environment": epoch.get("environment", {}), "modules": epoch.get("modules", {}),
+            "executions": executions, "edges": graph.edges(imports=True), "data_sources": sorted(data_sources)}
+
+
+def run(paths: list, output, checkpoint: Checkpoint, workers: int = None, fingerprints: bool = False,
+        definitions: bool = False, store_path: str = None, log=None) -> dict:
+    """Extracts the provenance of all notebooks in ``paths`` and writes it to ``output`` as NDJSON.
+
+    Returns the number of notebooks that were processed, skipped and failed.
+    """
+    counts = {"processed": 0, "skipped": 0, "failed": 0}
+    saved = time.monotonic()
+    workers = workers or os.cpu_count() or 1
+
+    def write(done):
+        nonlocal saved
+        _write(done, output, checkpoint, counts, log)
+        if time.monotonic() - saved >= CHECKPOINT_INTERVAL:
+            # The output is flushed first, so every notebook in the checkpoint is in the output
+            output.flush()
+            checkpoint.save()
+            saved = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for path in find_notebooks(paths):
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            if checkpoint.unchanged(path, info):
+                counts["skipped"] += 1
+                continue
+            # Only a few notebooks per worker are queued, so walking large directories does not fill the memory
+            if len(pending) >= 4 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(done)
+            pending.add(pool.submit(extract, path, checkpoint.sha256(path), fingerprints, definitions, store_path))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            write(done)
+    output.flush()
+    checkpoint.save()
+    return counts
+
+
+def _write(done, output, checkpoint: Checkpoint, counts: dict, log):
+    for future in done:
+        try:
+            result = future.result()
+        except Exception as error:
+            counts["failed"] += 1
+            if log:
+                log(f"Extraction failed: {error}")
+            continue
+        if result.pop("unchanged", False):
+            # Only touched, the content is the same as in the last run
+            counts["skipped"] += 1
+        elif "error" in result:
+            counts["failed"] += 1
+            if log:
+                log(f"{result['path']}: {result['error']}")
+            output.write(json.dumps(result) + "\n")
+        else:
+            counts["processed"] += 1
+            output.write(json.dumps(result) + "\n")
+        checkpoint.update(result["path"], result["size"], result["mtime_ns"], result["sha256"])
@@ -0,0 +1,83 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from ._version import __version__
+
+
+class AnalysisCache:
+    """Bounded LRU cache for analysis results keyed by the content of a cell.
+
+    The key is a hash of the source code and the version of the analyzer, so
+    identical cells of different notebooks and users share one entry.
+    Entries expire after ``max_age`` seconds because the detected data sources
+    depend on the files that exist when the cell is analyzed.
+    """
+
+    def __init__(self, maxsize: int = 1024, max_age: float = 600):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(code: str, *options) -> str:
+        # Options that change the result (e.g. fingerprints) are part of the key
+        content = "\0".join([__version__, *map(str, options), code])
+        return hashlib.sha256(content.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            created, value = entry
+            if time.monotonic() - created > self.max_age:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, code: str, compute, *options):
+        """Returns the cached result for ``code`` or computes and stores it."""
+        key = self.key(code, *options)
+        value = self.get(key)
+        if value is None:
+            value = compute(code, *options)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,112 @@
+"""Compact storage of the sources and outputs of executions.
+
+A cell that is executed again and again repeats its source and outputs in
+every record, plotting cells repeat whole base64 images. The provenance
+store keeps them in a content-addressed table of blobs per store instead and
+the records only reference them by hash: ``cell_source`` is replaced by
+``cell_source_blob`` and ``cell_outputs`` by ``cell_outputs_blobs`` with one
+hash per output. Equal contents are stored once, the records are restored
+completely when they are read.
+
+A source can also be stored as a delta against the source of the last
+execution of its cell, copied line ranges and inserted lines as::
+
+    [[start, end], "inserted lines\\n", ...]
+
+if that is shorter. Deltas of deltas are resolved up to ``MAX_DELTA_DEPTH``
+times, then the full source is stored again so reading stays cheap.
+
+Outputs larger than an optional cap are replaced by a text output with their
+size and hash. That is the only part that is not lossless and off by default.
+"""
+import hashlib
+import json
+import os
+
+from .diff import get_opcodes
+
+# Longest chain of deltas before a source is stored in full again
+MAX_DELTA_DEPTH = 16
+
+# A delta is only stored if it is at most this part of the size of the full source
+MAX_DELTA_RATIO = 0.5
+
+
+def dumps(value) -> str:
+    # Same contents give the same text and therefore the same hash
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def make_delta(old: str, new: str) -> list:
+    """Returns the delta that turns the source ``old`` into ``new``."""
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    delta = []
+    for tag, i1, i2, j1, j2 in get_opcodes(old_lines, new_lines):
+        if tag == "equal":
+            delta.append([i1, i2])
+        elif j1 < j2:
+            delta.append("".join(new_lines[j1:j2]))
+    return delta
+
+
+def apply_delta(old: str, delta: list) -> str:
+    """Inverse of ``make_delta``."""
+    old_lines = old.splitlines(keepends=True)
+    return "".join("".join(old_lines[item[0]:item[1]]) if isinstance(item, list) else item for item in delta)
+
+
+def cap_output(output, max_size: int):
+    """Returns the output or, if its JSON is longer than ``max_size`` bytes, a text output in its place."""
+    text = dumps(output)
+    size = len(text.encode("utf-8", "surrogatepass"))
+    if max_size is None or size <= max_size:
+        return output
+    return {
+        "output_type": "display_data",
+        "data": {"text/plain": f"[Output of {size} bytes not stored, the limit is {max_size} bytes]"},
+        "metadata": {"mlprovlab": {"removed": {"output_type": output.get("output_type") if isinstance(output, dict)
+                                               else None, "size": size, "sha256": content_hash(text)}}}
+    }
+
+
+def migrate_notebook(path: str, store, dry_run: bool = False) -> dict:
+    """Moves the provenance in the metadata of a notebook (the old format) into the store.
+
+    The metadata is replaced by the id of the new store and its summary, the
+    same pointer the frontend writes. Returns the size of the notebook before
+    and after and the bytes the provenance takes in the store.
+    """
+    with open(path, encoding="utf-8") as file:
+        text = file.read()
+    notebook = json.loads(text)
+    before = len(text.encode("utf-8"))
+    provenance = notebook.get("metadata", {}).get("provenance")
+    if not isinstance(provenance, dict) or not isinstance(provenance.get("epochs"), list):
+        return {"path": path, "migrated": False, "before": before, "after": before, "stored": 0}
+
+    if dry_run:
+        # Stored in a temporary store to get its size, the notebook is not changed
+        scratch = type(store)(":memory:", **store.options)
+        store_id = scratch.create(provenance)
+        summary = scratch.summary(store_id)
+        stored = scratch.size(store_id)
+        scratch.close()
+    else:
+        store_id = store.create(provenance)
+        summary = store.summary(store_id)
+        stored = store.size(store_id)
+    notebook["metadata"]["provenance"] = {"store": store_id, "summary": summary}
+    # Written like nbformat does
+    text = json.dumps(notebook, indent=1, sort_keys=True, ensure_ascii=False) + "\n"
+    if not dry_run:
+        temporary = path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(temporary, path)
+    return {"path": path, "migrated": True, "store": store_id, "before": before,
+            "after": len(text.encode("utf-8")), "stored": stored}
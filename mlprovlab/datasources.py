@@ -0,0 +1,155 @@
+"""Detection of the data sources (URLs, files and directories) used by a cell."""
+import hashlib
+import os
+import re
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+url_pattern = re.compile(
+    r"((([A-Za-z]{3,9}:(?:\/\/)?)(?:[-;:&=\+\$,\w]+@)?[A-Za-z0-9.-]+|(?:www.|[-;:&=\+\$,\w]+@)[A-Za-z0-9.-]+)((?:\/[\+~%\/.\w_]*)?\??(?:[-\+=&;%@.\w_]*)#?(?:[\w]*))?)")
+
+# Longest path that is checked on the file system
+MAX_PATH_LENGTH = 4096
+
+# Size of the chunks read when hashing a file
+CHUNK_SIZE = 1024 * 1024
+
+
+def may_be_url(value: str) -> bool:
+    # Every match of url_pattern contains one of these, checking them first skips the regex for most strings
+    return ":" in value or "@" in value or "www" in value
+
+
+class StatCache:
+    """Remembers for ``ttl`` seconds whether a path is an existing file or directory.
+
+    Strings in a cell are checked on every analysis, on network file systems
+    each of these checks is a slow stat call.
+    """
+
+    def __init__(self, ttl: float = 30, maxsize: int = 16384):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def exists(self, path: str) -> bool:
+        if not path or len(path) > MAX_PATH_LENGTH or "\0" in path:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and now - entry[0] <= self.ttl:
+                return entry[1]
+
+        try:
+            mode = os.stat(path).st_mode
+            exists = stat.S_ISDIR(mode) or stat.S_ISREG(mode)
+        except (OSError, ValueError):
+            exists = False
+
+        with self._lock:
+            self._entries[path] = (now, exists)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return exists
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class Fingerprints:
+    """Size, modification time and content hash of local data files.
+
+    Fingerprints are cached by device, inode, size and modification time, so
+    a large dataset is only hashed again once it changed.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str):
+        """Returns the fingerprint of the file at ``path`` or ``None`` if it is not a readable file."""
+        try:
+            info = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if not stat.S_ISREG(info.st_mode):
+            return None
+
+        key = (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+        with self._lock:
+            fingerprint = self._entries.get(key)
+            if fingerprint is not None:
+                self._entries.move_to_end(key)
+                return fingerprint
+
+        try:
+            digest = _hash_file(path)
+        except OSError:
+            return None
+        fingerprint = {"size": info.st_size, "mtime": info.st_mtime, "sha256": digest}
+
+        with self._lock:
+            self._entries[key] = fingerprint
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return fingerprint
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        while True:
+            size = file.readinto(buffer)
+            if not size:
+                break
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+stat_cache = StatCache()
+fingerprints = Fingerprints()
+
+
+def is_data_source(value: str) -> bool:
+    """Checks if a string constant is a URL or the path of an existing file or directory."""
+    if may_be_url(value) and url_pattern.search(value) is not None:
+        return True
+    return stat_cache.exists(value)
+
+
+def used_sources(record: dict) -> list:
+    """Returns the data sources an execution record used.
+
+    These are the detected data sources of its code and the files the kernel
+    saw it read, if the kernel records them (see ``mlprovlab.kernel``).
+    """
+    files = [file["path"] for file in record.get("files") or []
+             if isinstance(file, dict) and "r" in file.get("mode", "")]
+    return list(dict.fromkeys((record.get("data_values") or []) + files))
+
+
+def written_files(record: dict) -> list:
+    """Returns the files the kernel saw an execution write."""
+    return [file["path"] for file in record.get("files") or []
+            if isinstance(file, dict) and "w" in file.get("mode", "")]
+
+
+def fingerprint(paths: list) -> dict:
+    """Returns the fingerprints of all paths that are local files."""
+    result = {}
+    for path in paths:
+        if path not in result:
+            value = fingerprints.get(path)
+            if value is not None:
+                result[path] = value
+    return result
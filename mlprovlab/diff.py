@@ -0,0 +1,202 @@
+"""Line based diff of cell sources.
+
+Lines are replaced by integer ids and matched with the patience algorithm:
+lines that occur exactly once in both versions are used as anchors (the
+longest increasing sequence of them), the gaps between the anchors are
+diffed the same way. Only gaps without unique lines and at most
+``MAX_FALLBACK_SIZE`` line pairs are compared with ``difflib``, larger ones
+become a replacement. Memory stays linear in the number of lines and the
+time close to it, also for large or completely rewritten cells, where
+``difflib.ndiff`` compares every pair of changed lines character by
+character.
+"""
+import difflib
+import hashlib
+from bisect import bisect_left
+from collections import Counter
+
+# Largest gap without unique lines (old lines times new lines) that is compared with difflib
+MAX_FALLBACK_SIZE = 10000
+
+# Lines longer than this (in characters) are not highlighted within the line
+MAX_INTRALINE_LENGTH = 1000
+
+
+def source_hash(source: str) -> str:
+    return hashlib.sha256(source.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def get_opcodes(old: list, new: list) -> list:
+    """Returns the difference of two lists of lines in the format of ``difflib.SequenceMatcher.get_opcodes``."""
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in old]
+    b = [ids.setdefault(line, len(ids)) for line in new]
+
+    # Matching blocks (i, j, size) in order
+    blocks = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        item = stack.pop()
+        if len(item) == 3:
+            blocks.append(item)
+            continue
+        alo, ahi, blo, bhi = item
+
+        # Common prefix and suffix
+        prefix = 0
+        while alo + prefix < ahi and blo + prefix < bhi and a[alo + prefix] == b[blo + prefix]:
+            prefix += 1
+        if prefix:
+            blocks.append((alo, blo, prefix))
+            alo += prefix
+            blo += prefix
+        suffix = 0
+        while alo < ahi - suffix and blo < bhi - suffix and a[ahi - suffix - 1] == b[bhi - suffix - 1]:
+            suffix += 1
+        if suffix:
+            stack.append((ahi - suffix, bhi - suffix, suffix))
+            ahi -= suffix
+            bhi -= suffix
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = _unique_anchors(a, b, alo, ahi, blo, bhi)
+        if anchors:
+            # Gaps and anchors are pushed in reverse so they are handled in order
+            ends = [(ahi, bhi)]
+            for i, j in reversed(anchors):
+                end_a, end_b = ends[-1]
+                stack.append((i + 1, end_a, j + 1, end_b))
+                stack.append((i, j, 1))
+                ends.append((i, j))
+            stack.append((alo, anchors[0][0], blo, anchors[0][1]))
+        elif (ahi - alo) * (bhi - blo) <= MAX_FALLBACK_SIZE:
+            matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+            blocks.extend((alo + i, blo + j, size) for i, j, size in matcher.get_matching_blocks() if size)
+
+    opcodes = []
+    i = j = 0
+    for block_i, block_j, size in blocks + [(len(a), len(b), 0)]:
+        if i < block_i and j < block_j:
+            opcodes.append(("replace", i, block_i, j, block_j))
+        elif i < block_i:
+            opcodes.append(("delete", i, block_i, j, j))
+        elif j < block_j:
+            opcodes.append(("insert", i, i, j, block_j))
+        if size:
+            if opcodes and opcodes[-1][0] == "equal":
+                opcodes[-1] = ("equal", opcodes[-1][1], block_i + size, opcodes[-1][3], block_j + size)
+            else:
+                opcodes.append(("equal", block_i, block_i + size, block_j, block_j + size))
+        i, j = block_i + size, block_j + size
+    return opcodes
+
+
+def _unique_anchors(a: list, b: list, alo: int, ahi: int, blo: int, bhi: int) -> list:
+    # Lines unique in both ranges that are in the same order in both (longest increasing subsequence)
+    count_a = Counter(a[alo:ahi])
+    count_b = Counter(b[blo:bhi])
+    position_b = {b[j]: j for j in range(blo, bhi) if count_b[b[j]] == 1}
+    pairs = [(i, position_b[a[i]]) for i in range(alo, ahi) if count_a[a[i]] == 1 and a[i] in position_b]
+
+    tails = []
+    tail_pairs = []
+    previous = {}
+    for pair in pairs:
+        index = bisect_left(tails, pair[1])
+        if index == len(tails):
+            tails.append(pair[1])
+            tail_pairs.append(pair)
+        else:
+            tails[index] = pair[1]
+            tail_pairs[index] = pair
+        previous[pair] = tail_pairs[index - 1] if index else None
+
+    anchors = []
+    pair = tail_pairs[-1] if tail_pairs else None
+    while pair is not None:
+        anchors.append(pair)
+        pair = previous[pair]
+    return anchors[::-1]
+
+
+def group_opcodes(opcodes: list, context: int = 3) -> list:
+    """Groups the opcodes into hunks with up to ``context`` unchanged lines around the changes."""
+    if not opcodes:
+        return []
+    codes = list(opcodes)
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # A long unchanged range ends the hunk
+        if tag == "equal" and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        groups.append(group)
+    return [group for group in groups if any(code[0] != "equal" for code in group)]
+
+
+def diff(old: str, new: str, context: int = 3, intraline: bool = False) -> dict:
+    """Returns the hunks that turn ``old`` into ``new``.
+
+    Every line of a hunk has a type (``context``, ``delete`` or ``insert``),
+    its 1-based line numbers in the old and the new source and its text.
+    With ``intraline`` the replaced lines also contain the ``[start, end)``
+    character ranges that changed.
+    """
+    old_lines = old.splitlines()
+    new_lines = new.splitlines()
+    opcodes = get_opcodes(old_lines, new_lines)
+
+    hunks = []
+    for group in group_opcodes(opcodes, context):
+        lines = []
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                lines.extend({"type": "context", "old": i + 1, "new": j + 1, "text": old_lines[i]}
+                             for i, j in zip(range(i1, i2), range(j1, j2)))
+                continue
+            deleted = [{"type": "delete", "old": i + 1, "new": None, "text": old_lines[i]} for i in range(i1, i2)]
+            inserted = [{"type": "insert", "old": None, "new": j + 1, "text": new_lines[j]} for j in range(j1, j2)]
+            if intraline and tag == "replace":
+                for deleted_line, inserted_line in zip(deleted, inserted):
+                    _add_intraline(deleted_line, inserted_line)
+            lines.extend(deleted)
+            lines.extend(inserted)
+        first = group[0]
+        last = group[-1]
+        hunks.append({"old_start": first[1] + 1, "old_lines": last[2] - first[1],
+                      "new_start": first[3] + 1, "new_lines": last[4] - first[3], "lines": lines})
+
+    added = sum(j2 - j1 for tag, i1, i2, j1, j2 in opcodes if tag in ("insert", "replace"))
+    removed = sum(i2 - i1 for tag, i1, i2, j1, j2 in opcodes if tag in ("delete", "replace"))
+    return {"old_hash": source_hash(old), "new_hash": source_hash(new),
+            "added": added, "removed": removed, "hunks": hunks}
+
+
+def _add_intraline(deleted: dict, inserted: dict):
+    old_text = deleted["text"]
+    new_text = inserted["text"]
+    if len(old_text) > MAX_INTRALINE_LENGTH or len(new_text) > MAX_INTRALINE_LENGTH:
+        return
+    matcher = difflib.SequenceMatcher(None, old_text, new_text, autojunk=False)
+    deleted["changes"] = []
+    inserted["changes"] = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        if i1 < i2:
+            deleted["changes"].append([i1, i2])
+        if j1 < j2:
+            inserted["changes"].append([j1, j2])
@@ -0,0 +1,264 @@
+"""Streaming export of the provenance data in the store.
+
+The export is produced as a sequence of text chunks while the executions are
+read from the store in batches, so memory use does not depend on the length
+of the history. Only the set of used data sources (and for PROV-JSON the
+last definition of every variable) is kept while exporting.
+"""
+import hashlib
+import json
+import zlib
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from .datasources import used_sources, written_files
+from .store import ProvenanceStore
+
+FORMATS = ("json", "ndjson", "prov")
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "prov": "application/json"
+}
+
+# Namespace of the identifiers in PROV-JSON exports
+PROV_NAMESPACE = "https://github.com/fusion-jena/MLProvLab#"
+
+
+def parse_time(value: str):
+    """Parses ISO 8601 times and the UTC strings recorded by the frontend, returns ``None`` if it is neither."""
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        time = datetime.fromisoformat(value)
+    except ValueError:
+        try:
+            time = parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time
+
+
+class Export:
+    """Export of the provenance of one store.
+
+    Parameters
+    ----------
+    epochs:
+        Indices of the exported epochs, all if ``None``.
+    start, end:
+        Only executions recorded in this time range are exported.
+    """
+
+    def __init__(self, store: ProvenanceStore, store_id: str, epochs=None, start=None, end=None):
+        self.store = store
+        self.store_id = store_id
+        self.epochs = None if epochs is None else set(epochs)
+        self.start = start
+        self.end = end
+
+    def iter_epochs(self):
+        for epoch in self.store.iter_epochs(self.store_id):
+            if self.epochs is None or epoch["epoch"] in self.epochs:
+                yield epoch
+
+    def iter_executions(self, epoch: int, sources: bool = True, outputs: bool = True):
+        records = self.store.iter_executions(self.store_id, epoch, sources=sources, outputs=outputs)
+        for position, record in enumerate(records):
+            if self.start is not None or self.end is not None:
+                time = parse_time(record.get("time"))
+                if time is None or (self.start is not None and time < self.start) or \
+                        (self.end is not None and time > self.end):
+                    continue
+            yield position, record
+
+    def chunks(self, format: str):
+        """Yields the export in the given format as text chunks."""
+        return getattr(self, "_" + format)()
+
+    def _json(self):
+        # Same structure as the export of the frontend, the used data is written last
+        used_data = {}
+        yield '{"epochs": ['
+        for index, epoch in enumerate(self.iter_epochs()):
+            header = json.dumps(epoch_export(epoch))
+            yield (", " if index else "") + header[:-1] + ', "execution_data": ['
+            for position, (_, record) in enumerate(self.iter_executions(epoch["epoch"])):
+                used_data.update(dict.fromkeys(used_sources(record)))
+                yield (", " if position else "") + json.dumps(execution_export(record))
+            yield "]}"
+        yield '], "used_data": ' + json.dumps(list(used_data)) + "}"
+
+    def _ndjson(self):
+        # One line per epoch followed by one line per execution of it
+        for epoch in self.iter_epochs():
+            yield json.dumps({"type": "epoch", "epoch": epoch["epoch"], **epoch_export(epoch)}) + "\n"
+            for position, record in self.iter_executions(epoch["epoch"]):
+                yield json.dumps({"type": "execution", "epoch": epoch["epoch"], "position": position,
+                                  **execution_export(record)}) + "\n"
+
+    def _prov(self):
+        # W3C PROV-JSON, every section is written in its own pass over the executions,
+        # only the pass of the entities reads the sources of the cells and none their outputs
+        yield '{"prefix": ' + json.dumps({"mlprov": PROV_NAMESPACE})
+        sections = [("agent", self._prov_agents), ("activity", self._prov_activities),
+                    ("entity", self._prov_entities), ("used", self._prov_used),
+                    ("wasGeneratedBy", self._prov_generated), ("wasAssociatedWith", self._prov_associated)]
+        for name, records in sections:
+            yield ', "' + name + '": {'
+            for index, (identifier, record) in enumerate(records()):
+                yield (", " if index else "") + json.dumps(identifier) + ": " + json.dumps(record)
+            yield "}"
+        yield "}"
+
+    def _prov_agents(self):
+        for epoch in self.iter_epochs():
+            environment = epoch["environment"]
+            kernel = environment.get("kernel") or {}
+            language = environment.get("language_info") or {}
+            yield _kernel_id(epoch["epoch"]), {
+                "prov:type": "prov:SoftwareAgent",
+                "mlprov:kernel": kernel.get("implementation"),
+                "mlprov:kernel_version": kernel.get("version"),
+                "mlprov:language": language.get("name"),
+                "mlprov:language_version": language.get("version"),
+                "mlprov:start_time": environment.get("time")
+            }
+
+    def _prov_activities(self):
+        for epoch in self.iter_epochs():
+            for position, record in self.iter_executions(epoch["epoch"], sources=False, outputs=False):
+                activity = {"prov:type": "mlprov:Execution", "mlprov:cell_id": record.get("cell_id"),
+                            "mlprov:execution_count": record.get("execution_count"),
+                            "mlprov:status": record.get("type")}
+                time = parse_time(record.get("time"))
+                if time is not None:
+                    activity["prov:startTime"] = time.isoformat()
+                yield _execution_id(epoch["epoch"], position), activity
+
+    def _prov_entities(self):
+        data_sources = set()
+        for epoch in self.iter_epochs():
+            for position, record in self.iter_executions(epoch["epoch"], outputs=False):
+                source = record.get("cell_source", "")
+                yield _code_id(epoch["epoch"], position), {
+                    "prov:type": "mlprov:Code",
+                    "prov:value": source if isinstance(source, str) else "".join(source)
+                }
+                for variable in record.get("local") or []:
+                    yield _variable_id(epoch["epoch"], position, variable), {
+                        "prov:type": "mlprov:Variable", "prov:label": variable
+                    }
+                for value in used_sources(record) + written_files(record):
+                    if value not in data_sources:
+                        data_sources.add(value)
+                        yield _data_id(value), {"prov:type": "mlprov:DataSource", "prov:location": value}
+
+    def _prov_used(self):
+        for epoch in self.iter_epochs():
+            # Last definition of every variable, the variables an execution uses come from there
+            last_local = {}
+            for position, record in self.iter_executions(epoch["epoch"], sources=False, outputs=False):
+                activity = _execution_id(epoch["epoch"], position)
+                yield f"_:used/{epoch['epoch']}/{position}/code", {
+                    "prov:activity": activity, "prov:entity": _code_id(epoch["epoch"], position)}
+                for value in used_sources(record):
+                    yield f"_:used/{epoch['epoch']}/{position}/data/{_digest(value)}", {
+                        "prov:activity": activity, "prov:entity": _data_id(value)}
+                for variable in dict.fromkeys(record.get("remote") or []):
+                    if variable in last_local:
+                        yield f"_:used/{epoch['epoch']}/{position}/variable/{variable}", {
+                            "prov:activity": activity,
+                            "prov:entity": _variable_id(epoch["epoch"], last_local[variable], variable)}
+                for variable in record.get("local") or []:
+                    last_local[variable] = position
+
+    def _prov_generated(self):
+        for epoch in self.iter_epochs():
+            for position, record in self.iter_executions(epoch["epoch"], sources=False, outputs=False):
+                for variable in dict.fromkeys(record.get("local") or []):
+                    yield f"_:generated/{epoch['epoch']}/{position}/{variable}", {
+                        "prov:entity": _variable_id(epoch["epoch"], position, variable),
+                        "prov:activity": _execution_id(epoch["epoch"], position)}
+                for value in dict.fromkeys(written_files(record)):
+                    yield f"_:generated/{epoch['epoch']}/{position}/data/{_digest(value)}", {
+                        "prov:entity": _data_id(value), "prov:activity": _execution_id(epoch["epoch"], position)}
+
+    def _prov_associated(self):
+        for epoch in self.iter_epochs():
+            for position, _ in self.iter_executions(epoch["epoch"], sources=False, outputs=False):
+                yield f"_:associated/{epoch['epoch']}/{position}", {
+                    "prov:activity": _execution_id(epoch["epoch"], position),
+                    "prov:agent": _kernel_id(epoch["epoch"])}
+
+
+def epoch_export(epoch: dict) -> dict:
+    environment = epoch["environment"]
+    kernel = environment.get("kernel") or {}
+    language = environment.get("language_info") or {}
+    return {
+        "kernel_start_time": environment.get("time"),
+        "language": language.get("name"),
+        "language_version": language.get("version"),
+        "language_mimetype": language.get("mimetype"),
+        "kernel": kernel.get("implementation"),
+        "kernel_version": kernel.get("version"),
+        "user_agent": environment.get("user_agent"),
+        "modules": epoch["modules"]
+    }
+
+
+def execution_export(record: dict) -> dict:
+    return {
+        "execution_count": record.get("execution_count"),
+        "used_data": record.get("data_values"),
+        "files": record.get("files"),
+        "profile": record.get("profile"),
+        "data_vars": record.get("data_vars"),
+        "execution_info": record.get("definitions"),
+        "code": record.get("cell_source"),
+        "cell_id": record.get("cell_id"),
+        "dependencies": record.get("remote"),
+        "imports": record.get("imports"),
+        "outputs": record.get("cell_outputs"),
+        "definitions": record.get("local"),
+        "definition_info": record.get("local_info"),
+        "time": record.get("time")
+    }
+
+
+def gzip_chunks(chunks, level: int = 6):
+    """Compresses text chunks to a gzip stream."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8", "surrogatepass")).hexdigest()[:16]
+
+
+def _kernel_id(epoch: int) -> str:
+    return f"mlprov:kernel/{epoch}"
+
+
+def _execution_id(epoch: int, position: int) -> str:
+    return f"mlprov:execution/{epoch}/{position}"
+
+
+def _code_id(epoch: int, position: int) -> str:
+    return f"mlprov:code/{epoch}/{position}"
+
+
+def _variable_id(epoch: int, position: int, variable: str) -> str:
+    return f"mlprov:variable/{epoch}/{position}/{variable}"
+
+
+def _data_id(value: str) -> str:
+    return f"mlprov:data/{_digest(value)}"
@@ -0,0 +1,173 @@
+import threading
+from collections import OrderedDict, deque
+
+from .diff import source_hash
+from .store import ProvenanceStore
+
+
+class DependencyGraph:
+    """Dependencies between the executions of one epoch.
+
+    For every variable the index keeps the last execution that defined it
+    (and the last one that imported it). When an execution is added its
+    remote variables are looked up there, so the edges of an execution are
+    found in time linear to its variables instead of scanning all earlier
+    executions. Edges only point to earlier executions and never change once
+    added, the number of executions is the version of the graph.
+    """
+
+    def __init__(self):
+        self.last_local = {}
+        self.last_import = {}
+        # Per execution: variable, last defining and last importing execution before it
+        self._edges = []
+        # Cell id per execution and, per cell, its last execution and the hash of its source then
+        self.cells = []
+        self.last_execution = {}
+        self.source_hashes = {}
+        # Per execution: later executions that read a variable from it
+        self._dependents = {}
+
+    @property
+    def version(self) -> int:
+        return len(self._edges)
+
+    def add(self, record: dict):
+        position = len(self._edges)
+        edges = []
+        for variable in dict.fromkeys(record.get("remote") or []):
+            local_source = self.last_local.get(variable)
+            import_source = self.last_import.get(variable)
+            if local_source is not None or import_source is not None:
+                edges.append((variable, local_source, import_source))
+        self._edges.append(edges)
+        for variable, source in self.inputs(position):
+            self._dependents.setdefault(source, []).append((position, variable))
+
+        cell_id = record.get("cell_id", "")
+        source = record.get("cell_source", "")
+        self.cells.append(cell_id)
+        self.last_execution[cell_id] = position
+        self.source_hashes[cell_id] = source_hash(source if isinstance(source, str) else "".join(source))
+
+        for variable in record.get("local") or []:
+            self.last_local[variable] = position
+        for variable in record.get("imports") or []:
+            self.last_import[variable] = position
+
+    def edges(self, since: int = 0, imports: bool = False) -> list:
+        """Returns the edges of the executions from position ``since`` on.
+
+        An edge goes from the execution that last defined a variable to the
+        one using it. With ``imports`` the execution that imported it is used
+        if that happened later.
+        """
+        result = []
+        for target in range(since, len(self._edges)):
+            for variable, local_source, import_source in self._edges[target]:
+                if imports and import_source is not None and (local_source is None or import_source > local_source):
+                    result.append({"source": import_source, "target": target, "variable": variable, "import": True})
+                elif local_source is not None:
+                    result.append({"source": local_source, "target": target, "variable": variable, "import": False})
+        return result
+
+    def inputs(self, position: int) -> list:
+        """Returns the variables read by an execution with the execution each one came from.
+
+        Like the edges with ``imports``, the later of the defining and the
+        importing execution is the source.
+        """
+        result = []
+        for variable, local_source, import_source in self._edges[position]:
+            if import_source is not None and (local_source is None or import_source > local_source):
+                result.append((variable, import_source))
+            else:
+                result.append((variable, local_source))
+        return result
+
+    def dependents(self, position: int) -> list:
+        """Returns the later executions that read a variable from an execution, with the variable."""
+        return self._dependents.get(position, [])
+
+    def last_definition(self, variable: str):
+        """Returns the execution that defined or imported a variable last, or None."""
+        local_source = self.last_local.get(variable)
+        import_source = self.last_import.get(variable)
+        if local_source is None or (import_source is not None and import_source > local_source):
+            return import_source
+        return local_source
+
+    def lineage(self, position: int, upstream: bool = True) -> dict:
+        """Returns the executions in the lineage of an execution with the variables that connect them.
+
+        Upstream these are all executions the execution depends on, directly or
+        through others, with the variables that were read from them. Downstream
+        these are all executions that depend on it with the variables they read.
+        The execution itself is included without variables.
+        """
+        result = {position: []}
+        queue = deque([position])
+        while queue:
+            current = queue.popleft()
+            if upstream:
+                links = ((source, variable) for variable, source in self.inputs(current))
+            else:
+                links = self.dependents(current)
+            for other, variable in links:
+                if other not in result:
+                    result[other] = []
+                    queue.append(other)
+                if variable not in result[other]:
+                    result[other].append(variable)
+        return result
+
+
+class GraphService:
+    """Dependency graphs of the epochs in the provenance store.
+
+    Graphs are built from the store the first time they are requested and
+    then updated with every appended execution.
+    """
+
+    def __init__(self, store: ProvenanceStore, maxsize: int = 64):
+        self.store = store
+        self.maxsize = maxsize
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, store_id: str, epoch: int) -> DependencyGraph:
+        key = (store_id, epoch)
+        with self._lock:
+            graph = self._graphs.get(key)
+            if graph is not None:
+                self._graphs.move_to_end(key)
+                return graph
+
+        graph = DependencyGraph()
+        for record in self.store.iter_executions(store_id, epoch):
+            graph.add(record)
+
+        with self._lock:
+            self._graphs[key] = graph
+            while len(self._graphs) > self.maxsize:
+                self._graphs.popitem(last=False)
+        return graph
+
+    def append(self, store_id: str, epoch: int, position: int, record: dict):
+        """Adds an execution that was appended to the store at ``position`` of the epoch."""
+        key = (store_id, epoch)
+        with self._lock:
+            graph = self._graphs.get(key)
+            if graph is None:
+                # Built from the store once it is needed
+                return
+            if graph.version == position:
+                graph.add(record)
+            else:
+                # Missed an execution, build it again on the next request
+                del self._graphs[key]
+
+    def discard(self, store_id: str):
+        with self._lock:
+            for key in [key for key in self._graphs if key[0] == store_id]:
+                del self._graphs[key]
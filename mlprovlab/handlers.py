@@ -1,10 +1,42 @@
+import asyncio
+import gzip
 import json
 import difflib
+import multiprocessing
+import os
+import time
 
-from jupyter_server.base.handlers import APIHandler
+from jupyter_core.paths import jupyter_data_dir
+from jupyter_server.base.handlers import APIHandler, JupyterHandler
 from jupyter_server.utils import url_path_join
 import tornado
-from . import analyze
+import tornado.ioloop
+import tornado.websocket
+from . import analyze, diff, lineage, planner, wire
+from .cache import AnalysisCache
+from .export import CONTENT_TYPES, FORMATS, Export, gzip_chunks, parse_time
+from .graph import DependencyGraph, GraphService
+from .metrics import Metrics
+from .pool import AnalysisPool
+from .store import MAX_PAGE_SIZE, ProvenanceStore
+
+try:
+    from jupyter_server.base.websocket import WebSocketMixin
+except ImportError:
+    # jupyter_server before 2.0
+    from jupyter_server.base.zmqhandlers import WebSocketMixin
+
+# Seconds to wait for the full analysis of a cell before answering with the cheaper one
+ANALYSIS_TIMEOUT = 5
+
+# Sources longer than this (in characters) only get the cheaper analysis
+MAX_SOURCE_SIZE = 1000000
+
+# Seconds without a newer version of a cell before the WebSocket route analyzes it
+DEBOUNCE_SECONDS = 0.15
+
+# Bytes of an export that are written before they are flushed to the client
+EXPORT_BLOCK_SIZE = 64 * 1024
 
 
 class RouteHandler(APIHandler):
@@ -18,41 +50,697 @@ class RouteHandler(APIHandler):
         }))
 
 
-class CodeAnalyzeRoute(APIHandler):
+class AnalysisMixin:
+    """Analysis of single cells in the worker pool, used by the HTTP and the WebSocket route."""
+
+    def initialize(self, cache: AnalysisCache, pool: AnalysisPool, running: dict, metrics: Metrics):
+        self.cache = cache
+        self.pool = pool
+        self.running = running
+        self.metrics = metrics
+
+    async def analysis(self, code: str, cell_id, fingerprints: bool):
+        """Returns the result for the code, or ``None`` if a newer version of the cell superseded it."""
+        # Identical sources (undo, reopened notebooks, templated cells) are only analyzed once
+        key = self.cache.key(code, fingerprints)
+        result = self.cache.get(key)
+        if result is None and len(code) > MAX_SOURCE_SIZE:
+            self.metrics.event("too_large")
+            result = analyze_names(self.metrics, code)
+        elif result is None:
+            result = await self.analyze(key, code, cell_id, fingerprints)
+        return result
+
+    async def analyze(self, key: str, code: str, cell_id, fingerprints: bool):
+        # Run the analysis in a worker process so the server keeps responding
+        try:
+            task = self.pool.submit(analyze.analyze_cell_recorded, code, fingerprints)
+        except Exception as error:
+            self.log.warning("Could not start analysis worker: %s", error)
+            self.metrics.event("worker_failure")
+            return analyze_names(self.metrics, code)
+        # Cache the result even if the request does not wait for it anymore
+        def store(task):
+            if not task.cancelled() and task.exception() is None:
+                result, recording = task.result()
+                self.cache.put(key, result)
+                self.metrics.observe_analysis(code, recording["seconds"], "full", recording)
+
+        task.add_done_callback(store)
+        future = asyncio.wrap_future(task)
+
+        running_key = (str(self.current_user), cell_id)
+        if cell_id is not None:
+            previous = self.running.get(running_key)
+            if previous is not None:
+                previous.cancel()
+            self.running[running_key] = future
+        try:
+            result, _ = await asyncio.wait_for(asyncio.shield(future), ANALYSIS_TIMEOUT)
+            return result
+        except asyncio.CancelledError:
+            self.metrics.event("superseded")
+            self.pool.abandon(task)
+            return None
+        except asyncio.TimeoutError:
+            # Answer with the cheaper analysis instead of an error, the worker may still be busy with the cell
+            self.metrics.event("timeout")
+            self.pool.abandon(task)
+            return analyze_names(self.metrics, code)
+        except Exception as error:
+            self.log.warning("Analysis worker failed: %s", error)
+            self.metrics.event("worker_failure")
+            return analyze_names(self.metrics, code)
+        finally:
+            if self.running.get(running_key) is future:
+                del self.running[running_key]
+
+
+class CodeAnalyzeRoute(AnalysisMixin, APIHandler):
     # The following decorator should be present on all verb methods (head, get, post,
     # patch, put, delete, options) to ensure only authorized user can request the
     # Jupyter server
     @tornado.web.authenticated
-    def post(self):
-        code = tornado.escape.json_decode(self.request.body)
-        definitions ,local_vars, remote_vars, imports, modules, data_vars, data_values = analyze.analyze(
-            code)
-        self.finish(json.dumps({
-            "definitions": definitions,
-            "local": local_vars,
-            "remote": remote_vars,
-            "imports": imports,
-            "modules": modules,
-            "data_vars": data_vars,
-            "data_values": data_values
-        }))
+    async def post(self):
+        data = tornado.escape.json_decode(self.request.body)
+        # The body is either the source of the cell or an object with the source and the id of the cell
+        if isinstance(data, str):
+            cell_id, code = None, data
+        elif isinstance(data, dict) and isinstance(data.get("source"), str):
+            cell_id, code = data.get("cell_id"), data["source"]
+        else:
+            self.set_status(400)
+            self.finish()
+            return
+
+        # With ?fingerprints=1 the used local data files are hashed
+        fingerprints = query_flag(self, "fingerprints")
+        compact = accepts_compact(self)
+
+        result = await self.analysis(code, cell_id, fingerprints)
+        if result is None:
+            # A newer version of the cell was sent in the meantime
+            self.set_status(409)
+            self.finish(json.dumps({"message": "Analysis was superseded by a newer version of the cell"}))
+            return
+        if compact:
+            finish_compact(self, wire.encode(result))
+        else:
+            self.finish(json.dumps(result))
+
+    def on_finish(self):
+        self.metrics.observe_request("analyze", self.request.request_time())
+
+
+class _CellUpdates:
+    """Latest version of a cell sent over a WebSocket and the timer of its analysis."""
+
+    __slots__ = ("version", "source", "fingerprints", "received", "timer")
+
+    def __init__(self):
+        self.version = None
+        self.source = None
+        self.fingerprints = False
+        self.received = 0.0
+        self.timer = None
+
+
+class AnalysisSocket(AnalysisMixin, WebSocketMixin, tornado.websocket.WebSocketHandler, JupyterHandler):
+    """Live analysis of the cells of a notebook over one connection.
+
+    The client sends ``{"cell_id": ..., "version": ..., "source": ...}`` after
+    every edit, with versions increasing per cell. The analysis of a cell
+    starts once no newer version arrived for ``DEBOUNCE_SECONDS``, versions in
+    between are never analyzed and versions older than the latest one are
+    ignored. Results are sent as ``{"cell_id": ..., "version": ..., "result": ...}``
+    and only if no newer version of the cell arrived while it was analyzed.
+    With ``?format=compact`` the result is in the format of ``mlprovlab.wire``.
+
+    The bases are in the order of the WebSocket handlers of jupyter_server, so
+    the origin is checked and the connection kept alive like theirs.
+    """
+
+    def set_default_headers(self):
+        # The headers of JupyterHandler do not apply to the upgrade of a WebSocket
+        pass
+
+    def get(self, *args, **kwargs):
+        # The upgrade can not be redirected to the login page like the authenticated decorator does
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        return super().get(*args, **kwargs)
+
+    def open(self, *args, **kwargs):
+        self.compact = self.get_query_argument("format", "json") == "compact"
+        self.cells = {}
+        return super().open(*args, **kwargs)
+
+    def on_message(self, message):
+        try:
+            data = json.loads(message)
+        except ValueError:
+            data = None
+        if not (isinstance(data, dict) and isinstance(data.get("cell_id"), str) and
+                isinstance(data.get("source"), str) and type(data.get("version")) is int):
+            self.write_message(json.dumps({"error": "Updates must have a cell_id, an integer version and a source"}))
+            return
+
+        cell = self.cells.setdefault(data["cell_id"], _CellUpdates())
+        if cell.version is not None and data["version"] <= cell.version:
+            # Overtaken by a newer version of the cell
+            return
+        cell.version = data["version"]
+        cell.source = data["source"]
+        cell.fingerprints = bool(data.get("fingerprints"))
+        cell.received = time.perf_counter()
+        loop = tornado.ioloop.IOLoop.current()
+        if cell.timer is not None:
+            loop.remove_timeout(cell.timer)
+        cell.timer = loop.call_later(DEBOUNCE_SECONDS, self.start_analysis, data["cell_id"])
+
+    def start_analysis(self, cell_id: str):
+        cell = self.cells[cell_id]
+        cell.timer = None
+        asyncio.ensure_future(self.send_result(cell_id, cell.version, cell.source, cell.fingerprints, cell.received))
+
+    async def send_result(self, cell_id: str, version: int, source: str, fingerprints: bool, received: float):
+        # An analysis of the cell that is still running is superseded by this one
+        result = await self.analysis(source, cell_id, fingerprints)
+        cell = self.cells.get(cell_id)
+        if result is None or cell is None or cell.version != version:
+            # A newer version arrived in the meantime or the connection was closed
+            return
+        message = {"cell_id": cell_id, "version": version, "result": wire.encode(result) if self.compact else result}
+        try:
+            await self.write_message(wire.dumps(message).decode("utf-8") if self.compact else json.dumps(message))
+        except tornado.websocket.WebSocketClosedError:
+            return
+        self.metrics.observe_request("analyze_socket", time.perf_counter() - received)
+
+    def on_close(self):
+        loop = tornado.ioloop.IOLoop.current()
+        for cell in self.cells.values():
+            if cell.timer is not None:
+                loop.remove_timeout(cell.timer)
+        self.cells.clear()
+
+
+class BatchAnalyzeRoute(APIHandler):
+    def initialize(self, cache: AnalysisCache, pool: AnalysisPool, metrics: Metrics):
+        self.cache = cache
+        self.pool = pool
+        self.metrics = metrics
+
+    # The following decorator should be present on all verb methods (head, get, post,
+    # patch, put, delete, options) to ensure only authorized user can request the
+    # Jupyter server
+    @tornado.web.authenticated
+    async def post(self):
+        cells = tornado.escape.json_decode(self.request.body)
+        if not isinstance(cells, list) or not all(
+                isinstance(cell, dict) and "cell_id" in cell and isinstance(cell.get("source"), str) for cell in cells):
+            self.set_status(400)
+            self.finish()
+            return
+
+        # With ?stream=1 every result is sent as one line of NDJSON as soon as it is ready
+        stream = query_flag(self, "stream")
+        fingerprints = query_flag(self, "fingerprints")
+        self.compact = accepts_compact(self)
+        if stream:
+            self.set_header("Content-Type", "application/x-ndjson")
+
+        # Group the cells by their source so identical cells are only analyzed once
+        sources = {}
+        for cell in cells:
+            key = self.cache.key(cell["source"], fingerprints)
+            sources.setdefault(key, (cell["source"], []))[1].append(cell["cell_id"])
+
+        results = {}
+        loop = asyncio.get_event_loop()
+        # The whole batch gets as long as the analysis of a single cell
+        deadline = loop.time() + ANALYSIS_TIMEOUT
+        futures = {}
+        tasks = {}
+        for key, (source, cell_ids) in sources.items():
+            result = self.cache.get(key)
+            if result is None and len(source) > MAX_SOURCE_SIZE:
+                self.metrics.event("too_large")
+                self.add_results(results, cell_ids, analyze_names(self.metrics, source), stream)
+            elif result is None:
+                try:
+                    task = self.pool.submit(analyze.analyze_cell_recorded, source, fingerprints)
+                except Exception as error:
+                    self.log.warning("Could not start analysis worker: %s", error)
+                    self.metrics.event("worker_failure")
+                    self.add_results(results, cell_ids, analyze_names(self.metrics, source), stream)
+                    continue
+                # Cache the result even if the batch does not wait for it anymore
+                task.add_done_callback(self.store_callback(key, source))
+                futures[asyncio.wrap_future(task)] = key
+                tasks[key] = task
+            else:
+                self.add_results(results, cell_ids, result, stream)
+        if stream:
+            await self.flush()
+
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(deadline - loop.time(), 0),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                source, cell_ids = sources[futures[future]]
+                try:
+                    result, _ = future.result()
+                except Exception as error:
+                    # The worker died, answer with the cheaper analysis instead of blocking the server
+                    self.log.warning("Analysis worker failed: %s", error)
+                    self.metrics.event("worker_failure")
+                    result = analyze_names(self.metrics, source)
+                self.add_results(results, cell_ids, result, stream)
+            if stream:
+                await self.flush()
+
+        for future in pending:
+            # Answer with the cheaper analysis. Cells that did not start are cancelled, the full results of the
+            # running ones are still cached when they finish
+            self.metrics.event("timeout")
+            self.pool.abandon(tasks[futures[future]])
+            source, cell_ids = sources[futures[future]]
+            self.add_results(results, cell_ids, analyze_names(self.metrics, source), stream)
+
+        if stream:
+            self.finish()
+        elif self.compact:
+            finish_compact(self, wire.encode_batch(results))
+        else:
+            self.finish(json.dumps(results))
+
+    def on_finish(self):
+        self.metrics.observe_request("analyze_batch", self.request.request_time())
+
+    def store_callback(self, key: str, source: str):
+        def store(task):
+            if not task.cancelled() and task.exception() is None:
+                result, recording = task.result()
+                self.cache.put(key, result)
+                self.metrics.observe_analysis(source, recording["seconds"], "full", recording)
+        return store
+
+    def add_results(self, results: dict, cell_ids: list, result: dict, stream: bool):
+        for cell_id in cell_ids:
+            if stream and self.compact:
+                self.write(wire.dumps({"cell_id": cell_id, "result": wire.encode(result)}) + b"\n")
+            elif stream:
+                self.write(json.dumps({"cell_id": cell_id, "result": result}) + "\n")
+            else:
+                results[cell_id] = result
 
 
 class CodeDiffRoute(APIHandler):
+    def initialize(self, cache: AnalysisCache, metrics: Metrics):
+        self.cache = cache
+        self.metrics = metrics
+
     # The following decorator should be present on all verb methods (head, get, post,
     # patch, put, delete, options) to ensure only authorized user can request the
     # Jupyter server
     @tornado.web.authenticated
     def post(self):
         data = tornado.escape.json_decode(self.request.body)
-        if "current" in data and "old" in data:
-            diff = difflib.ndiff(data["current"].splitlines(
-                keepends=True), data["old"].splitlines(keepends=True))
-            self.finish(json.dumps(''.join(diff)))
-        self.set_status(400)
+        if not (isinstance(data, dict) and isinstance(data.get("current"), str) and isinstance(data.get("old"), str)):
+            self.set_status(400)
+            self.finish()
+            return
+
+        # ?format=hunks returns the structured diff, otherwise the ndiff text is returned as before
+        if self.get_query_argument("format", "ndiff") == "hunks":
+            result = cached_diff(self.cache, data["old"], data["current"], query_int(self, "context", 3),
+                                 query_flag(self, "intraline"))
+            self.finish(json.dumps(result))
+            return
+        ndiff = difflib.ndiff(data["current"].splitlines(
+            keepends=True), data["old"].splitlines(keepends=True))
+        self.finish(json.dumps(''.join(ndiff)))
+
+    def on_finish(self):
+        self.metrics.observe_request("diff", self.request.request_time())
+
+
+class DiffHistoryRoute(APIHandler):
+    def initialize(self, cache: AnalysisCache, store: ProvenanceStore):
+        self.cache = cache
+        self.store = store
+
+    @tornado.web.authenticated
+    def post(self):
+        # Diffs every version of a cell with the one before, the versions are either given as
+        # {"sources": [...]} or read from the provenance store with {"store": ..., "cell_id": ...}
+        data = tornado.escape.json_decode(self.request.body)
+        if isinstance(data, dict) and isinstance(data.get("sources"), list) and \
+                all(isinstance(source, str) for source in data["sources"]):
+            sources = data["sources"]
+        elif isinstance(data, dict) and isinstance(data.get("store"), str) and isinstance(data.get("cell_id"), str):
+            sources = self.store.cell_sources(data["store"], data["cell_id"])
+        else:
+            self.set_status(400)
+            self.finish()
+            return
+
+        context = query_int(self, "context", 3)
+        intraline = query_flag(self, "intraline")
+        self.finish(json.dumps({
+            "diffs": [cached_diff(self.cache, old, new, context, intraline) for old, new in zip(sources, sources[1:])]
+        }))
+
+
+def analyze_names(metrics: Metrics, code: str) -> dict:
+    # The cheaper analysis runs in the server process
+    start = time.perf_counter()
+    result = analyze.analyze_names(code)
+    metrics.observe_analysis(code, time.perf_counter() - start, "names")
+    return result
+
+
+def accepts_compact(handler: APIHandler) -> bool:
+    # Analysis results are sent in the compact format of mlprovlab.wire if the client asks for it
+    handler.set_header("Vary", "Accept")
+    return wire.MEDIA_TYPE in handler.request.headers.get("Accept", "")
+
+
+def finish_compact(handler: APIHandler, envelope: dict):
+    # Large responses are compressed if the client accepts it, the browser decompresses them transparently
+    body = wire.dumps(envelope)
+    if len(body) >= wire.GZIP_MIN_SIZE and "gzip" in handler.request.headers.get("Accept-Encoding", ""):
+        body = gzip.compress(body, wire.GZIP_LEVEL)
+        handler.set_header("Content-Encoding", "gzip")
+        handler.add_header("Vary", "Accept-Encoding")
+    handler.finish(body)
+
+
+def cached_diff(cache: AnalysisCache, old: str, new: str, context: int, intraline: bool) -> dict:
+    # Versions of a cell are diffed again and again while browsing its history
+    key = "\0".join((diff.source_hash(old), diff.source_hash(new), str(context), str(intraline)))
+    result = cache.get(key)
+    if result is None:
+        result = diff.diff(old, new, context, intraline)
+        cache.put(key, result)
+    return result
+
+
+class ProvenanceRoute(APIHandler):
+    def initialize(self, store: ProvenanceStore, graphs: GraphService):
+        self.store = store
+        self.graphs = graphs
+
+    @tornado.web.authenticated
+    def post(self, store_id=None):
+        # Creates a store, optionally with the provenance data of a notebook in the old metadata format
+        data = tornado.escape.json_decode(self.request.body) if self.request.body else None
+        if data is not None and not (isinstance(data, dict) and isinstance(data.get("epochs", []), list)):
+            self.set_status(400)
+            self.finish()
+            return
+        store_id = self.store.create(data)
+        self.finish(json.dumps({"store": store_id, "summary": self.store.summary(store_id)}))
+
+    @tornado.web.authenticated
+    def get(self, store_id):
+        try:
+            self.finish(json.dumps(self.store.summary(store_id)))
+        except KeyError:
+            raise tornado.web.HTTPError(404, "Unknown provenance store")
+
+    @tornado.web.authenticated
+    def delete(self, store_id):
+        self.store.delete(store_id)
+        self.graphs.discard(store_id)
+        self.set_status(204)
+        self.finish()
+
+
+class ProvenanceExecutionsRoute(APIHandler):
+    def initialize(self, store: ProvenanceStore, graphs: GraphService):
+        self.store = store
+        self.graphs = graphs
+
+    @tornado.web.authenticated
+    def post(self, store_id):
+        # Appends an execution, the body is {"record": ..., "environment": ..., "modules": ...}
+        # where a given environment starts a new epoch
+        data = tornado.escape.json_decode(self.request.body)
+        if not isinstance(data, dict) or not isinstance(data.get("record"), dict):
+            self.set_status(400)
+            self.finish()
+            return
+        try:
+            epoch, execution = self.store.append(store_id, data["record"], data.get("environment"),
+                                                 data.get("modules"))
+        except KeyError:
+            raise tornado.web.HTTPError(404, "Unknown provenance store")
+        self.graphs.append(store_id, epoch, execution, data["record"])
+        self.finish(json.dumps(self.store.summary(store_id)))
+
+
+class GraphRoute(APIHandler):
+    def initialize(self, store: ProvenanceStore, graphs: GraphService):
+        self.store = store
+        self.graphs = graphs
+
+    @tornado.web.authenticated
+    def get(self, store_id, epoch):
+        # Edges between the executions of an epoch, with ?since=N only those of executions N and later
+        # and with ?imports=1 also edges from the executions that imported a variable
+        epoch = int(epoch)
+        since = query_int(self, "since", 0)
+        if not self.store.has_epoch(store_id, epoch):
+            raise tornado.web.HTTPError(404, "Unknown provenance store or epoch")
+        graph = self.graphs.get(store_id, epoch)
+        self.finish(json.dumps({
+            "version": graph.version,
+            "since": min(since, graph.version),
+            "edges": graph.edges(since, query_flag(self, "imports"))
+        }))
+
+
+class PlanRoute(APIHandler):
+    def initialize(self, store: ProvenanceStore, graphs: GraphService, metrics: Metrics):
+        self.store = store
+        self.graphs = graphs
+        self.metrics = metrics
+
+    @tornado.web.authenticated
+    def post(self, store_id):
+        # Plans the executions after an edit from the recorded provenance, the body is {"edited": [cell ids],
+        # "cells": [{"cell_id": ..., "source": ...}] in notebook order, "epoch": ...} with the last epoch by default
+        data = tornado.escape.json_decode(self.request.body)
+        if not (isinstance(data, dict) and isinstance(data.get("edited", []), list) and
+                isinstance(data.get("cells", []), list)) or not all(
+                isinstance(cell, dict) and isinstance(cell.get("cell_id"), str) and
+                isinstance(cell.get("source", ""), str) for cell in data.get("cells", [])):
+            self.set_status(400)
+            self.finish()
+            return
+        try:
+            epochs = self.store.summary(store_id)["epochs"]
+        except KeyError:
+            raise tornado.web.HTTPError(404, "Unknown provenance store")
+        epoch = data.get("epoch", epochs - 1)
+        if not isinstance(epoch, int) or not 0 <= epoch < epochs:
+            # Nothing was executed yet, only the edited cells themselves
+            epoch = None
+        graph = self.graphs.get(store_id, epoch) if epoch is not None else DependencyGraph()
+
+        def names(source):
+            result = analyze_names(self.metrics, source)
+            return result["local"] + result["imports"]
+
+        self.finish(json.dumps(dict(planner.plan(graph, data.get("edited", []), data.get("cells"), names),
+                                    epoch=epoch, version=graph.version)))
+
+    def on_finish(self):
+        self.metrics.observe_request("plan", self.request.request_time())
+
+
+class FindRoute(APIHandler):
+    def initialize(self, store: ProvenanceStore):
+        self.store = store
+
+    @tornado.web.authenticated
+    def get(self, store_id):
+        # Executions with ?term= in ?field= (local, remote, imports, data_values, data_vars or modules), e.g.
+        # ?field=data_values&term=data/train.csv, paged with ?offset= and ?limit=. Without a term the terms
+        # of the field are listed
+        field = self.get_query_argument("field", "")
+        if field not in lineage.INDEXED_FIELDS:
+            raise tornado.web.HTTPError(400, f"field must be one of {', '.join(lineage.INDEXED_FIELDS)}")
+        term = self.get_query_argument("term", None)
+        offset = query_int(self, "offset", 0)
+        limit = query_int(self, "limit", 100)
+        try:
+            if term is None:
+                page = self.store.terms(store_id, field, offset, limit)
+            else:
+                page = self.store.find(store_id, field, term, offset, limit)
+        except KeyError:
+            raise tornado.web.HTTPError(404, "Unknown provenance store")
+        self.finish(json.dumps(page))
+
+
+class LineageRoute(APIHandler):
+    def initialize(self, store: ProvenanceStore, graphs: GraphService):
+        self.store = store
+        self.graphs = graphs
+
+    @tornado.web.authenticated
+    def get(self, store_id):
+        # Executions that ?variable= (its last definition) or ?execution= of ?epoch= (the last one by default)
+        # depends on, with ?direction=downstream the executions depending on it, paged with ?offset= and ?limit=
+        direction = self.get_query_argument("direction", "upstream")
+        if direction not in ("upstream", "downstream"):
+            raise tornado.web.HTTPError(400, "direction must be upstream or downstream")
+        try:
+            epochs = self.store.summary(store_id)["epochs"]
+        except KeyError:
+            raise tornado.web.HTTPError(404, "Unknown provenance store")
+        epoch = query_int(self, "epoch", max(epochs - 1, 0))
+        if not self.store.has_epoch(store_id, epoch):
+            raise tornado.web.HTTPError(404, "Unknown epoch")
+        graph = self.graphs.get(store_id, epoch)
+
+        variable = self.get_query_argument("variable", None)
+        if self.get_query_argument("execution", None) is not None:
+            position = query_int(self, "execution", 0)
+            if position >= graph.version:
+                raise tornado.web.HTTPError(404, "Unknown execution")
+        elif variable is not None:
+            position = graph.last_definition(variable)
+            if position is None:
+                raise tornado.web.HTTPError(404, "The variable is not defined in the epoch")
+        else:
+            raise tornado.web.HTTPError(400, "variable or execution is required")
+
+        executions = graph.lineage(position, direction == "upstream")
+        positions = sorted(executions)
+        offset = query_int(self, "offset", 0)
+        page = positions[offset:offset + min(query_int(self, "limit", 100), MAX_PAGE_SIZE)]
+        data_values = self.store.execution_terms(store_id, epoch, positions, "data_values")
+        self.finish(json.dumps({
+            "epoch": epoch,
+            "execution": position,
+            "version": graph.version,
+            "executions": [{"execution": execution, "cell_id": graph.cells[execution],
+                            "variables": executions[execution], "data_values": data_values.get(execution, [])}
+                           for execution in page],
+            "total": len(positions),
+            # Data sources of all executions of the lineage
+            "data_values": sorted({value for values in data_values.values() for value in values})
+        }))
+
+
+class ProvenanceEpochsRoute(APIHandler):
+    def initialize(self, store: ProvenanceStore):
+        self.store = store
+
+    @tornado.web.authenticated
+    def get(self, store_id, epoch=None):
+        # Pages through the epochs of a store or the executions of one epoch with ?offset= and ?limit=
+        offset = query_int(self, "offset", 0)
+        limit = query_int(self, "limit", 100)
+        try:
+            if epoch is None:
+                page = self.store.epochs(store_id, offset, limit)
+            else:
+                page = self.store.executions(store_id, int(epoch), offset, limit)
+        except KeyError:
+            raise tornado.web.HTTPError(404, "Unknown provenance store or epoch")
+        self.finish(json.dumps(page))
+
+
+class ExportRoute(APIHandler):
+    def initialize(self, store: ProvenanceStore):
+        self.store = store
+
+    @tornado.web.authenticated
+    async def get(self, store_id):
+        # Streams the provenance of a store as ?format=json, ndjson or prov (W3C PROV-JSON),
+        # ?epochs=0,2 and ?start= / ?end= (ISO 8601) select what is exported, ?gzip=1 compresses it
+        export_format = self.get_query_argument("format", "json")
+        if export_format not in FORMATS:
+            raise tornado.web.HTTPError(400, f"format must be one of {', '.join(FORMATS)}")
+        epochs = self.get_query_argument("epochs", "")
+        try:
+            epochs = [int(epoch) for epoch in epochs.split(",")] if epochs else None
+        except ValueError:
+            raise tornado.web.HTTPError(400, "epochs must be a list of integers")
+        times = {}
+        for name in ("start", "end"):
+            value = self.get_query_argument(name, "")
+            times[name] = parse_time(value)
+            if value and times[name] is None:
+                raise tornado.web.HTTPError(400, f"{name} must be a time")
+        if not self.store.exists(store_id):
+            raise tornado.web.HTTPError(404, "Unknown provenance store")
+
+        filename = "MLProvLabExport." + ("prov.json" if export_format == "prov" else export_format)
+        chunks = Export(self.store, store_id, epochs, times["start"], times["end"]).chunks(export_format)
+        if query_flag(self, "gzip"):
+            filename += ".gz"
+            self.set_header("Content-Type", "application/gzip")
+            chunks = gzip_chunks(chunks)
+        else:
+            self.set_header("Content-Type", CONTENT_TYPES[export_format] + "; charset=UTF-8")
+            chunks = (chunk.encode("utf-8") for chunk in chunks)
+        self.set_header("Content-Disposition", f'attachment; filename="{filename}"')
+
+        # Written in blocks, the export is never held in memory as a whole
+        size = 0
+        for chunk in chunks:
+            self.write(chunk)
+            size += len(chunk)
+            if size >= EXPORT_BLOCK_SIZE:
+                size = 0
+                await self.flush()
+        # Sends the headers before APIHandler.finish replaces the content type with JSON
+        await self.flush()
         self.finish()
 
 
+class MetricsRoute(JupyterHandler):
+    # Not an APIHandler, its finish would change the content type to JSON
+    def initialize(self, metrics: Metrics):
+        self.metrics = metrics
+
+    @tornado.web.authenticated
+    def get(self):
+        # Prometheus text format
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(self.metrics.render())
+
+
+def query_flag(handler: APIHandler, name: str) -> bool:
+    return handler.get_query_argument(name, "0").lower() in ("1", "true")
+
+
+def query_int(handler: APIHandler, name: str, default: int) -> int:
+    try:
+        value = int(handler.get_query_argument(name, str(default)))
+    except ValueError:
+        raise tornado.web.HTTPError(400, f"{name} must be an integer")
+    if value < 0:
+        raise tornado.web.HTTPError(400, f"{name} must not be negative")
+    return value
+
+
+def _cpu_count():
+    # Respect CPU affinity (e.g. in containers) where the platform supports it
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 def setup_handlers(web_app):
     host_pattern = ".*$"
 
@@ -61,9 +749,72 @@ def setup_handlers(web_app):
         base_url, "mlprovlab", "get_example")
     analyze_pattern = url_path_join(
         base_url, "mlprovlab", "analyze")
+    analyze_batch_pattern = url_path_join(
+        base_url, "mlprovlab", "analyze_batch")
+    analyze_socket_pattern = url_path_join(
+        base_url, "mlprovlab", "analyze_socket")
     diff_code = url_path_join(
         base_url, "mlprovlab", "diff")
+    diff_history_pattern = url_path_join(
+        base_url, "mlprovlab", "diff_history")
+    provenance_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance")
+    store_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance", r"(\w+)")
+    epochs_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance", r"(\w+)", "epochs")
+    executions_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance", r"(\w+)", "executions")
+    epoch_executions_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance", r"(\w+)", "epochs", r"(\d+)", "executions")
+    graph_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance", r"(\w+)", "epochs", r"(\d+)", "graph")
+    plan_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance", r"(\w+)", "plan")
+    find_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance", r"(\w+)", "find")
+    lineage_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance", r"(\w+)", "lineage")
+    export_pattern = url_path_join(
+        base_url, "mlprovlab", "provenance", r"(\w+)", "export")
+    metrics_pattern = url_path_join(
+        base_url, "mlprovlab", "metrics")
+    # One cache for the whole server so all notebooks and users share the results
+    cache = AnalysisCache()
+    # Worker processes are only started once the first batch is submitted. Spawn them instead of forking
+    # the running server with all its threads and sockets
+    pool = AnalysisPool(_cpu_count(), multiprocessing.get_context("spawn"))
+    # Running analyses by user and cell, so a newer version of a cell cancels the older one
+    running = {}
+    # Settings from c.ServerApp.tornado_settings = {"mlprovlab": {...}}
+    settings = web_app.settings.get("mlprovlab", {})
+    # Provenance of all notebooks, the notebooks only keep the id of their store. Outputs larger than
+    # "max_output_size" bytes are not stored, "source_deltas": False stores every source in full
+    store = ProvenanceStore(os.path.join(jupyter_data_dir(), "mlprovlab", "provenance.sqlite"),
+                            settings.get("source_deltas", True), settings.get("max_output_size"))
+    # Dependency graphs of the epochs, updated with every appended execution
+    graphs = GraphService(store)
+    # Diffs by the hashes of both sources
+    diff_cache = AnalysisCache(max_age=float("inf"))
+    # Durations of the analyses and their phases, slow analyses are logged if "slow_analysis_seconds" is set
+    metrics = Metrics({"analysis": cache, "diff": diff_cache}, settings.get("slow_analysis_seconds"))
     handlers = [(route_pattern, RouteHandler),
-                (analyze_pattern, CodeAnalyzeRoute),
-                (diff_code, CodeDiffRoute)]
+                (analyze_pattern, CodeAnalyzeRoute,
+                 {"cache": cache, "pool": pool, "running": running, "metrics": metrics}),
+                (analyze_batch_pattern, BatchAnalyzeRoute, {"cache": cache, "pool": pool, "metrics": metrics}),
+                (analyze_socket_pattern, AnalysisSocket,
+                 {"cache": cache, "pool": pool, "running": running, "metrics": metrics}),
+                (diff_code, CodeDiffRoute, {"cache": diff_cache, "metrics": metrics}),
+                (diff_history_pattern, DiffHistoryRoute, {"cache": diff_cache, "store": store}),
+                (provenance_pattern, ProvenanceRoute, {"store": store, "graphs": graphs}),
+                (store_pattern, ProvenanceRoute, {"store": store, "graphs": graphs}),
+                (epochs_pattern, ProvenanceEpochsRoute, {"store": store}),
+                (executions_pattern, ProvenanceExecutionsRoute, {"store": store, "graphs": graphs}),
+                (epoch_executions_pattern, ProvenanceEpochsRoute, {"store": store}),
+                (graph_pattern, GraphRoute, {"store": store, "graphs": graphs}),
+                (plan_pattern, PlanRoute, {"store": store, "graphs": graphs, "metrics": metrics}),
+                (find_pattern, FindRoute, {"store": store}),
+                (lineage_pattern, LineageRoute, {"store": store, "graphs": graphs}),
+                (export_pattern, ExportRoute, {"store": store}),
+                (metrics_pattern, MetricsRoute, {"metrics": metrics})]
     web_app.add_handlers(host_pattern, handlers)
@@ -0,0 +1,502 @@
+"""IPython extension that summarizes the variables of an execution.
+
+Load it in a kernel with ``%load_ext mlprovlab.kernel``. It registers the comm
+target ``mlprovlab``, the frontend sends ``{"request": id, "names": [...]}``
+after an execution and gets ``{"request": id, "summaries": {name: summary}}``
+for all requested names in one message, instead of one inspect request per
+variable. A summary only contains the type, the shape, dtype and length of
+the value, its size in bytes (estimated if the object does not know it) and
+a short representation of scalars, never docstrings, so its size is bounded.
+
+Optionally the extension records the files every execution opens, with an
+audit hook (``sys.addaudithook``) that is active while a cell runs. It is
+enabled with ``%mlprovlab_files on`` or the environment variable
+``MLPROVLAB_TRACK_FILES=1`` and the replies then also contain
+``"files": [{"path": ..., "mode": "r", "w" or "rw"}]`` of the last execution.
+Files opened by native code that bypasses Python's ``open`` (e.g. some HDF5
+or Arrow readers) are not seen.
+
+Every execution is also profiled, the replies contain ``"profile"`` with its
+wall and CPU time, how much it raised the peak resident set size of the
+kernel and the time the profiling itself took. ``%mlprovlab_profile
+allocations`` adds the peak of the memory allocated by Python and the lines
+that allocated most of it with tracemalloc, ``%mlprovlab_profile off`` (or
+``MLPROVLAB_PROFILE=0``) turns profiling off.
+
+Replies also contain the ``"execution_count"`` of the execution the files and
+the profile belong to, so the frontend can tell whether another execution
+ran in between. It is ``None`` for executions without history.
+"""
+import os
+import site
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+COMM_TARGET = "mlprovlab"
+
+# Most names summarized for one request
+MAX_NAMES = 500
+
+# Longest representation of a scalar and of a type or dtype name
+MAX_TEXT_LENGTH = 80
+
+# Most dimensions of a shape that are sent
+MAX_DIMENSIONS = 32
+
+# Items of a container that are measured to estimate its size
+SIZE_SAMPLE = 100
+
+# Most files that are reported for one execution
+MAX_FILES = 1000
+
+# Lines with the most allocated memory that are reported for one execution
+TOP_ALLOCATIONS = 10
+
+# Audit events of file accesses with the arguments that are read and written paths
+_FILE_EVENTS = {"open", "shutil.copyfile", "os.rename"}
+_READ = 1
+_WRITE = 2
+_WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_TRUNC
+# Modules of the import system, the sources it reads and the bytecode it caches are not data of the notebook
+_IMPORT_MODULES = {"_frozen_importlib", "_frozen_importlib_external", "importlib._bootstrap",
+                   "importlib._bootstrap_external", "zipimport"}
+
+_scalars = (bool, int, float, complex, str, bytes, type(None))
+# Types whose length is known without computing anything, len() of other (e.g. lazy) objects can be expensive
+_sized = (str, bytes, bytearray, list, tuple, dict, set, frozenset, range)
+
+
+def summarize(value) -> dict:
+    """Returns the summary of a value.
+
+    Attributes are only read where they are cheap and known (``shape``,
+    ``dtype``, ``nbytes``), any error while reading one skips it.
+    """
+    kind = type(value)
+    summary = {"type": _truncate(kind.__name__ if kind.__module__ == "builtins" else
+                                 f"{kind.__module__}.{kind.__qualname__}")}
+
+    shape = _attribute(value, "shape")
+    if isinstance(shape, tuple) and all(isinstance(size, int) for size in shape):
+        summary["shape"] = list(shape[:MAX_DIMENSIONS])
+    dtype = _attribute(value, "dtype")
+    if dtype is not None and not callable(dtype):
+        summary["dtype"] = _truncate(str(dtype))
+    if isinstance(value, _sized):
+        summary["len"] = len(value)
+    elif "shape" in summary and summary["shape"]:
+        summary["len"] = summary["shape"][0]
+
+    nbytes = _nbytes(value)
+    if nbytes is not None:
+        summary["nbytes"] = nbytes
+    else:
+        summary["nbytes"] = _estimate_size(value)
+        summary["estimated"] = True
+
+    if isinstance(value, _scalars):
+        text = repr(value[:MAX_TEXT_LENGTH + 1] if isinstance(value, (str, bytes)) else value)
+        summary["value"] = _truncate(text)
+    return summary
+
+
+def summarize_names(namespace: dict, names: list) -> dict:
+    """Summarizes the names of the namespace, names that are not defined are left out."""
+    summaries = {}
+    for name in list(dict.fromkeys(names))[:MAX_NAMES]:
+        if not isinstance(name, str):
+            continue
+        name = name.strip()
+        if name in namespace:
+            try:
+                summaries[name] = summarize(namespace[name])
+            except Exception as error:
+                summaries[name] = {"type": "unknown", "error": _truncate(type(error).__name__)}
+    return summaries
+
+
+def _attribute(value, name: str):
+    # Only attributes of the type are read, so instances with __getattr__ are not asked for them
+    try:
+        if not hasattr(type(value), name):
+            return None
+        return getattr(value, name)
+    except Exception:
+        return None
+
+
+def _nbytes(value):
+    nbytes = _attribute(value, "nbytes")
+    if isinstance(nbytes, int):
+        return nbytes
+    # pandas objects, without the deep inspection of object columns
+    memory_usage = _attribute(value, "memory_usage")
+    if callable(memory_usage) and type(value).__module__.split(".")[0] == "pandas":
+        try:
+            usage = memory_usage(index=True, deep=False)
+            return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+        except Exception:
+            return None
+    return None
+
+
+def _estimate_size(value) -> int:
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, (list, tuple, set, frozenset, dict)) and value:
+        # Size of the first items extrapolated to all of them
+        items = value.items() if isinstance(value, dict) else value
+        sample = 0
+        count = 0
+        for item in items:
+            if count == SIZE_SAMPLE:
+                break
+            if isinstance(value, dict):
+                sample += sys.getsizeof(item[0], 0) + sys.getsizeof(item[1], 0)
+            else:
+                sample += sys.getsizeof(item, 0)
+            count += 1
+        size += sample * len(value) // count
+    return size
+
+
+def _truncate(text: str) -> str:
+    return text if len(text) <= MAX_TEXT_LENGTH else text[:MAX_TEXT_LENGTH - 3] + "..."
+
+
+class FileAccessTracker:
+    """Files opened by the code of an execution.
+
+    The audit hook is called for every audit event of the interpreter and can
+    not be removed once it is installed, so it returns right away unless a
+    cell is running with tracking enabled. A path that was seen before in the
+    execution only updates its mode, so repeated reads of the same file cost
+    one dictionary lookup each. Accesses of the import system and bytecode
+    caches are left out, importing a module of the notebook is not data.
+    """
+
+    def __init__(self, excluded: list = ()):
+        self.enabled = False
+        self.installed = False
+        self._active = False
+        # Absolute path (None if excluded) by the path as it was given, and the mode by absolute path
+        self._paths = {}
+        self._files = {}
+        self._last = []
+        # With a trailing separator, so /usr does not exclude /usrdata
+        self._excluded = tuple(os.path.join(os.path.abspath(path), "") for path in excluded if path)
+
+    def enable(self):
+        if not self.installed:
+            sys.addaudithook(self._hook)
+            self.installed = True
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self._active = False
+
+    def pre_run_cell(self, info=None):
+        self._paths = {}
+        self._files = {}
+        self._active = self.enabled
+
+    def post_run_cell(self, result=None):
+        if self._active:
+            self._active = False
+            self._last = self._report()
+
+    def files(self) -> list:
+        """Returns the files accessed by the last execution."""
+        return self._last
+
+    def _hook(self, event, args):
+        if not self._active or event not in _FILE_EVENTS:
+            return
+        # The caller of the audited function, the hook is called from C without a frame of its own
+        if sys._getframe(1).f_globals.get("__name__") in _IMPORT_MODULES:
+            return
+        try:
+            self._record(event, args)
+        except Exception:
+            # Errors of an audit hook would be raised by the open call of the user
+            pass
+
+    def _record(self, event, args):
+        if event == "open":
+            path, mode, flags = args
+            if isinstance(mode, str):
+                access = _READ if mode.startswith("r") else _WRITE
+                if "+" in mode:
+                    access = _READ | _WRITE
+            elif flags & (os.O_WRONLY | os.O_RDWR):
+                access = (_READ | _WRITE) if flags & os.O_RDWR else _WRITE
+            else:
+                access = _WRITE if flags & _WRITE_FLAGS else _READ
+            self._add(path, access)
+        elif event == "shutil.copyfile":
+            self._add(args[0], _READ)
+            self._add(args[1], _WRITE)
+        else:
+            self._add(args[1], _WRITE)
+
+    def _add(self, path, access: int):
+        if isinstance(path, int):
+            # File descriptors, the file was opened before
+            return
+        if not isinstance(path, (str, bytes)):
+            path = os.fspath(path)
+        try:
+            absolute = self._paths[path]
+        except KeyError:
+            # Only new paths are resolved, relative ones against the working directory of this moment
+            try:
+                absolute = os.path.abspath(os.fsdecode(path))
+            except (TypeError, ValueError):
+                absolute = None
+            if absolute is not None and (absolute.startswith(self._excluded) or _is_bytecode(absolute)):
+                absolute = None
+            self._paths[path] = absolute
+        if absolute is not None:
+            self._files[absolute] = self._files.get(absolute, 0) | access
+
+    def _report(self) -> list:
+        cwd = os.path.join(os.getcwd(), "")
+        files = []
+        for absolute, access in self._files.items():
+            if len(files) == MAX_FILES:
+                break
+            # Failed attempts to open a file, e.g. of code that tries several locations
+            if not os.path.isfile(absolute):
+                continue
+            files.append({"path": absolute[len(cwd):] if absolute.startswith(cwd) else absolute,
+                          "mode": {_READ: "r", _WRITE: "w"}.get(access, "rw")})
+        return files
+
+
+def _is_bytecode(path: str) -> bool:
+    return path.endswith(".pyc") or os.sep + "__pycache__" + os.sep in path
+
+
+def _excluded_paths(ipython) -> list:
+    # Installed packages, the standard library, the files of IPython and caches of libraries (e.g. the fonts
+    # of matplotlib) are not data of the notebook
+    paths = [sys.prefix, sys.base_prefix, sys.exec_prefix, "/usr", "/etc", "/lib", "/dev", "/proc", "/sys",
+             os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")]
+    try:
+        paths.extend(site.getsitepackages())
+        paths.append(site.getusersitepackages())
+    except AttributeError:
+        # Old virtualenv versions of site
+        pass
+    profile_dir = getattr(ipython, "profile_dir", None)
+    if profile_dir is not None:
+        paths.append(profile_dir.location)
+    return paths
+
+
+class ExecutionProfiler:
+    """Time and memory used by an execution.
+
+    ``ru_maxrss`` is the peak resident set size of the process so far, so its
+    difference is how much an execution raised the peak, 0 if it stayed below
+    the peak of an earlier one. CPU time is the one of the whole process,
+    including other threads. tracemalloc slows every allocation down, so it
+    is only started for executions if ``allocations`` is set, and not at all
+    if it is tracing already for someone else.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        # Number of lines with the most allocated memory that are reported, 0 without tracemalloc
+        self.allocations = 0
+        self._start = None
+        self._last = None
+        self._tracing = False
+        self._overhead = 0.0
+
+    def disable(self):
+        self.enabled = False
+        self._start = None
+        if self._tracing:
+            self._tracing = False
+            tracemalloc.stop()
+
+    def pre_run_cell(self, info=None):
+        begin = time.perf_counter()
+        self._start = None
+        self._last = None
+        if not self.enabled:
+            return
+        self._tracing = bool(self.allocations) and not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+        rss = _peak_rss()
+        # Taken last, so the own time is not part of the execution
+        self._start = (rss, time.process_time(), time.perf_counter())
+        self._overhead = self._start[2] - begin
+
+    def post_run_cell(self, result=None):
+        end = time.perf_counter()
+        cpu = time.process_time()
+        if self._start is None:
+            return
+        rss, start_cpu, start = self._start
+        self._start = None
+        profile = {"wall": round(end - start, 6), "cpu": round(cpu - start_cpu, 6)}
+        peak = _peak_rss()
+        if peak is not None:
+            profile["peak_rss"] = peak
+            profile["peak_rss_delta"] = peak - rss
+        if self._tracing:
+            self._tracing = False
+            profile["python_peak"] = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            profile["allocations"] = _top_allocations(snapshot, self.allocations)
+        profile["overhead"] = round(self._overhead + time.perf_counter() - end, 6)
+        self._last = profile
+
+    def profile(self):
+        """Returns the profile of the last execution, None if it was not profiled."""
+        return self._last
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _top_allocations(snapshot, limit: int) -> list:
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+                                       tracemalloc.Filter(False, __file__)))
+    return [{"file": statistic.traceback[0].filename, "line": statistic.traceback[0].lineno,
+             "size": statistic.size, "count": statistic.count}
+            for statistic in snapshot.statistics("lineno")[:limit]]
+
+
+class LastExecution:
+    """Execution count of the last execution that ran with events.
+
+    Executions without history get the count of the next execution, they are
+    stored as ``None`` so they can not be mistaken for it.
+    """
+
+    def __init__(self):
+        self.count = None
+
+    def post_run_cell(self, result=None):
+        if getattr(getattr(result, "info", None), "store_history", True):
+            self.count = getattr(result, "execution_count", None)
+        else:
+            self.count = None
+
+
+_tracker = None
+_profiler = None
+_last_execution = None
+
+
+def load_ipython_extension(ipython):
+    global _tracker, _profiler, _last_execution
+    kernel = getattr(ipython, "kernel", None)
+    if kernel is None:
+        # Not running in a kernel, e.g. in terminal IPython
+        return
+
+    tracker = _tracker = FileAccessTracker(_excluded_paths(ipython))
+    profiler = _profiler = ExecutionProfiler()
+    last_execution = _last_execution = LastExecution()
+    # The profiler starts after and stops before the other handlers, they are called in order
+    ipython.events.register("pre_run_cell", tracker.pre_run_cell)
+    ipython.events.register("pre_run_cell", profiler.pre_run_cell)
+    ipython.events.register("post_run_cell", profiler.post_run_cell)
+    ipython.events.register("post_run_cell", tracker.post_run_cell)
+    ipython.events.register("post_run_cell", last_execution.post_run_cell)
+    if os.environ.get("MLPROVLAB_TRACK_FILES", "").lower() in ("1", "true"):
+        tracker.enable()
+    profile_setting = os.environ.get("MLPROVLAB_PROFILE", "").lower()
+    if profile_setting in ("0", "false"):
+        profiler.enabled = False
+    elif profile_setting == "allocations":
+        profiler.allocations = TOP_ALLOCATIONS
+
+    def track_files(line):
+        """Record the files that executions open: %mlprovlab_files on|off"""
+        if line.strip() in ("on", "1", "true"):
+            tracker.enable()
+        elif line.strip() in ("off", "0", "false"):
+            tracker.disable()
+        print(f"Recording opened files is {'on' if tracker.enabled else 'off'}.")
+
+    ipython.register_magic_function(track_files, "line", "mlprovlab_files")
+
+    def profile_executions(line):
+        """Profile executions: %mlprovlab_profile on|off|allocations [number of lines]"""
+        words = line.split()
+        if words and words[0] in ("on", "1", "true"):
+            profiler.enabled = True
+            profiler.allocations = 0
+        elif words and words[0] in ("off", "0", "false"):
+            profiler.disable()
+        elif words and words[0] == "allocations":
+            profiler.enabled = True
+            profiler.allocations = int(words[1]) if len(words) > 1 and words[1].isdigit() else TOP_ALLOCATIONS
+        if not profiler.enabled:
+            print("Profiling executions is off.")
+        elif profiler.allocations:
+            print(f"Profiling executions with the {profiler.allocations} lines that allocated the most memory.")
+        else:
+            print("Profiling executions is on.")
+
+    ipython.register_magic_function(profile_executions, "line", "mlprovlab_profile")
+
+    def on_open(comm, open_msg):
+        def on_msg(msg):
+            data = msg["content"]["data"]
+            names = data.get("names") if isinstance(data, dict) else None
+            reply = {
+                "request": data.get("request") if isinstance(data, dict) else None,
+                "summaries": summarize_names(ipython.user_ns, names if isinstance(names, list) else []),
+                "execution_count": last_execution.count
+            }
+            if tracker.enabled:
+                reply["files"] = tracker.files()
+            if profiler.profile() is not None:
+                reply["profile"] = profiler.profile()
+            comm.send(reply)
+
+        comm.on_msg(on_msg)
+
+    kernel.comm_manager.register_target(COMM_TARGET, on_open)
+
+
+def unload_ipython_extension(ipython):
+    global _tracker, _profiler, _last_execution
+    kernel = getattr(ipython, "kernel", None)
+    if kernel is not None:
+        kernel.comm_manager.unregister_target(COMM_TARGET, None)
+    if _tracker is not None:
+        # The audit hook stays installed but does nothing anymore
+        _tracker.disable()
+        ipython.events.unregister("pre_run_cell", _tracker.pre_run_cell)
+        ipython.events.unregister("post_run_cell", _tracker.post_run_cell)
+        _tracker = None
+    if _profiler is not None:
+        ipython.events.unregister("pre_run_cell", _profiler.pre_run_cell)
+        ipython.events.unregister("post_run_cell", _profiler.post_run_cell)
+        _profiler.disable()
+        _profiler = None
+    if _last_execution is not None:
+        ipython.events.unregister("post_run_cell", _last_execution.post_run_cell)
+        _last_execution = None
@@ -0,0 +1,67 @@
+"""Usage and lineage queries over the recorded provenance.
+
+The provenance store keeps an inverted index from the names in the records
+to the executions they occur in, one row per field, term and execution:
+
+* ``local``: variables defined by the execution (and the names of its definitions)
+* ``remote``: variables read by the execution
+* ``imports``: names bound by imports
+* ``data_values``: data sources, e.g. ``data/train.csv``, and the files the
+  kernel saw the execution open
+* ``data_vars``: variables holding data sources
+* ``modules``: imported modules, also per epoch with the execution ``-1``
+
+The rows of an execution are added in the transaction that appends it, so
+the index is always up to date. Lineage follows the edges of the dependency
+graph of an epoch from one execution (``DependencyGraph.lineage``), upstream
+to the executions it depends on or downstream to the ones depending on it.
+"""
+from .datasources import used_sources, written_files
+
+# Fields of the execution records that are indexed
+INDEXED_FIELDS = ("local", "remote", "imports", "data_values", "data_vars", "modules")
+
+
+def index_terms(record: dict, modules: dict = None) -> set:
+    """Returns the ``(field, term)`` pairs of an execution record.
+
+    ``modules`` are modules by name as in the epochs, the ones the record
+    imports (by their name, alias or imported names) are added.
+    """
+    terms = set()
+    for field in ("local", "remote", "imports", "data_vars"):
+        terms.update((field, term) for term in record.get(field) or [] if isinstance(term, str))
+    terms.update(("data_values", term) for term in used_sources(record) + written_files(record)
+                 if isinstance(term, str))
+    terms.update(("local", name) for name in _definition_names(record.get("definitions") or []))
+    imports = {name for name in record.get("imports") or [] if isinstance(name, str)}
+    for module, info in (modules or {}).items():
+        if not isinstance(module, str):
+            continue
+        info = info if isinstance(info, dict) else {}
+        if module in imports or info.get("alias") in imports or \
+                imports.intersection(_imported_names(info.get("imports") or [])):
+            terms.add(("modules", module))
+    return terms
+
+
+def _imported_names(imported: list):
+    # Names bound by a from-import, aliased ones are stored as {"name": ..., "alias": ...}
+    for item in imported:
+        if isinstance(item, dict):
+            item = item.get("alias") or item.get("name")
+        if isinstance(item, str):
+            yield item
+
+
+def _definition_names(definitions: list):
+    stack = list(definitions)
+    while stack:
+        definition = stack.pop()
+        if not isinstance(definition, dict):
+            continue
+        if isinstance(definition.get("name"), str):
+            yield definition["name"]
+        stack.extend(definition.get("body") or [])
+        stack.extend(definition.get("orelse") or [])
+
@@ -0,0 +1,242 @@
+"""Instrumentation of the analysis and the server handlers.
+
+The durations of the phases of an analysis and counts like the retries of
+the syntax recovery are collected per analysis in a ``Recording``. Analyses
+run in worker processes, so the recording is returned together with the
+result and added to the ``Metrics`` of the server, which renders them in the
+Prometheus text format.
+"""
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# Counts of a recording and the help of their counters
+COUNTS = {
+    "recovery_retries": "Statements parsed again after blanking the lines with a syntax error.",
+    "recovered_cells": "Cells that could only be parsed with the syntax recovery.",
+    "dropped_lines": "Lines dropped because they are magics or contain syntax errors.",
+    "memo_hits": "Top level statements whose analysis was taken from the statement memo.",
+    "memo_misses": "Top level statements that were analyzed.",
+    "version_lookups": "Lookups of the version of an imported module."
+}
+
+_local = threading.local()
+
+
+class Recording:
+    """Durations of the phases and counts of one analysis."""
+
+    def __init__(self):
+        self.phases = {}
+        self.counts = {}
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def count(self, name: str, amount: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def to_dict(self) -> dict:
+        return {"phases": dict(self.phases), "counts": dict(self.counts)}
+
+
+def current():
+    """Returns the recording of the running analysis of this thread or ``None``."""
+    return getattr(_local, "recording", None)
+
+
+@contextmanager
+def record():
+    """Collects the phases and counts of the code run in the block."""
+    previous = current()
+    recording = _local.recording = Recording()
+    try:
+        yield recording
+    finally:
+        _local.recording = previous
+
+
+@contextmanager
+def phase(name: str):
+    """Adds the duration of the block to the phase of the current recording."""
+    recording = current()
+    if recording is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recording.add(name, time.perf_counter() - start)
+
+
+def count(name: str, amount: int = 1):
+    recording = current()
+    if recording is not None:
+        recording.count(name, amount)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=DURATION_BUCKETS, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # Per label values: count per bucket, sum and count
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][index] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (buckets, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + (_number(bound),))} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Metrics:
+    """Metrics of the analyses and requests of the server.
+
+    Parameters
+    ----------
+    caches:
+        Caches by name whose statistics are exported.
+    slow_threshold:
+        Analyses that take longer (in seconds) are logged with the hash of
+        the cell and the durations of their phases, ``None`` disables it.
+    """
+
+    def __init__(self, caches: dict = None, slow_threshold: float = None, log: logging.Logger = None):
+        self.caches = caches or {}
+        self.slow_threshold = slow_threshold
+        self.log = log or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self.analysis_seconds = Histogram(
+            "mlprovlab_analysis_seconds", "Duration of the analysis of a cell by tier.", labelnames=("tier",))
+        self.phase_seconds = Histogram(
+            "mlprovlab_analysis_phase_seconds",
+            "Duration of the phases of an analysis. analyze_ast contains check_files and versions, "
+            "parse contains recovery.", labelnames=("phase",))
+        self.source_bytes = Histogram(
+            "mlprovlab_analysis_source_bytes", "Size of the analyzed cells.", buckets=SIZE_BUCKETS)
+        self.counts = {name: Counter(f"mlprovlab_analysis_{name}_total", help) for name, help in COUNTS.items()}
+        self.events = Counter(
+            "mlprovlab_analysis_events_total",
+            "Analyses that timed out, were superseded by a newer version of the cell, failed in a worker, "
+            "were too large for the full analysis or were slow.", labelnames=("event",))
+        self.request_seconds = Histogram(
+            "mlprovlab_request_seconds",
+            "Duration of the requests by route, for analyze_socket from the update of a cell to its result.",
+            labelnames=("route",))
+
+    def observe_analysis(self, code: str, seconds: float, tier: str, recording: dict = None):
+        """Adds an analysis of ``code`` and the recording of its phases and counts."""
+        recording = recording or {}
+        with self._lock:
+            self.analysis_seconds.observe(seconds, tier=tier)
+            self.source_bytes.observe(len(code))
+            for name, value in recording.get("phases", {}).items():
+                self.phase_seconds.observe(value, phase=name)
+            for name, value in recording.get("counts", {}).items():
+                if name in self.counts:
+                    self.counts[name].inc(value)
+            slow = self.slow_threshold is not None and seconds > self.slow_threshold
+            if slow:
+                self.events.inc(event="slow")
+        if slow:
+            # Imported here, the diff module is not needed by the workers
+            from .diff import source_hash
+            phases = ", ".join(f"{name}={value:.3f}s" for name, value in recording.get("phases", {}).items())
+            self.log.warning("Slow analysis of cell %s (%d characters, tier %s) took %.3fs: %s",
+                             source_hash(code), len(code), tier, seconds, phases or "no phases recorded")
+
+    def event(self, name: str):
+        with self._lock:
+            self.events.inc(event=name)
+
+    def observe_request(self, route: str, seconds: float):
+        with self._lock:
+            self.request_seconds.observe(seconds, route=route)
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text format."""
+        with self._lock:
+            lines = []
+            for metric in [self.analysis_seconds, self.phase_seconds, self.source_bytes, *self.counts.values(),
+                           self.events, self.request_seconds]:
+                lines.extend(metric.render())
+        lines.extend(self._render_caches())
+        return "\n".join(lines) + "\n"
+
+    def _render_caches(self) -> list:
+        stats = {name: cache.stats() for name, cache in self.caches.items()}
+        lines = ["# HELP mlprovlab_cache_entries Entries in the result caches.",
+                 "# TYPE mlprovlab_cache_entries gauge"]
+        lines.extend(f"mlprovlab_cache_entries{_labels(('cache',), (name,))} {value['size']}"
+                     for name, value in stats.items())
+        for field, help in (("hits", "Lookups that found a result in the cache."),
+                            ("misses", "Lookups that did not find a result in the cache."),
+                            ("evictions", "Results removed because the cache was full."),
+                            ("expirations", "Results removed because they were too old.")):
+            lines.append(f"# HELP mlprovlab_cache_{field}_total {help}")
+            lines.append(f"# TYPE mlprovlab_cache_{field}_total counter")
+            lines.extend(f"mlprovlab_cache_{field}_total{_labels(('cache',), (name,))} {value[field]}"
+                         for name, value in stats.items())
+        return lines
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
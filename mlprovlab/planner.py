@@ -0,0 +1,127 @@
+"""Minimal re-execution of a notebook after some of its cells were edited.
+
+The plan is computed from the dependency graph of the recorded executions of
+an epoch, nothing is executed. Only the last execution of every cell counts,
+it is what the kernel state and the outputs of the cell are based on. A cell
+depends on the cells its last execution read variables from, so after an
+edit the edited cells and all cells that depend on them (directly or through
+other such cells) have to be executed again, every cell after the cells it
+depends on and otherwise in the order of the notebook.
+
+Independently of the edits a cell is stale if a variable it read was defined
+again after its last execution, or if it depends on a stale cell.
+
+The graph is kept up to date by ``GraphService``, a plan only looks at the
+last execution of every cell, so its cost grows with the number of cells and
+not with the number of executions.
+"""
+import heapq
+
+from .diff import source_hash
+from .graph import DependencyGraph
+
+
+def plan(graph: DependencyGraph, edited=(), cells: list = None, names=None) -> dict:
+    """Returns the cells to execute again after ``edited`` changed and the stale cells.
+
+    ``cells`` are the code cells of the notebook in order as
+    ``{"cell_id": ..., "source": ...}``. Cells whose source differs from their
+    last execution are edited too, cells that are not in the notebook anymore
+    are left out. ``names`` returns the names the current source of an edited
+    cell defines, cells after it that read one of them from another cell
+    depend on it as well. Without ``cells`` the order of the last executions is
+    used.
+    """
+    if cells is None:
+        order = {cell_id: position for position, cell_id in
+                 enumerate(sorted(graph.last_execution, key=graph.last_execution.get))}
+        sources = {}
+    else:
+        order = {}
+        sources = {}
+        for cell in cells:
+            order.setdefault(cell["cell_id"], len(order))
+            sources[cell["cell_id"]] = cell.get("source", "")
+
+    edited = {cell_id for cell_id in edited if cell_id in order}
+    for cell_id, source in sources.items():
+        if cell_id in graph.source_hashes and graph.source_hashes[cell_id] != source_hash(source):
+            edited.add(cell_id)
+
+    # Cells that read from a cell, with the variables, and the variables that were defined again since
+    dependents = {}
+    readers = {}
+    redefined = {}
+    for cell_id, position in graph.last_execution.items():
+        if cell_id not in order:
+            continue
+        for variable, source in graph.inputs(position):
+            if graph.last_definition(variable) > position:
+                redefined.setdefault(cell_id, []).append(variable)
+            source_cell = graph.cells[source]
+            if source_cell != cell_id:
+                dependents.setdefault(source_cell, {}).setdefault(cell_id, []).append(variable)
+                readers.setdefault(variable, []).append(cell_id)
+
+    if names is not None:
+        for cell_id in edited:
+            if cell_id not in sources:
+                continue
+            for variable in names(sources[cell_id]):
+                for reader in readers.get(variable, []):
+                    if order[reader] > order[cell_id] and reader != cell_id:
+                        dependents.setdefault(cell_id, {}).setdefault(reader, []).append(variable)
+
+    execute = _closure(edited, dependents)
+    stale = _closure(redefined, dependents)
+    return {
+        "edited": sorted(edited, key=order.get),
+        "execute": [{"cell_id": cell_id, "edited": cell_id in edited, "variables": execute[cell_id]}
+                    for cell_id in _sort(execute, dependents, order)],
+        # Cells that are executed again anyway are not listed as stale
+        "stale": [{"cell_id": cell_id, "redefined": redefined.get(cell_id, []),
+                   "variables": stale[cell_id]}
+                  for cell_id in _sort(stale, dependents, order) if cell_id not in execute]
+    }
+
+
+def _closure(start, dependents: dict) -> dict:
+    # All cells that depend on the start cells, with the variables they read from cells of the closure
+    result = {cell_id: [] for cell_id in start}
+    queue = list(result)
+    while queue:
+        cell_id = queue.pop()
+        for dependent, variables in dependents.get(cell_id, {}).items():
+            if dependent not in result:
+                result[dependent] = []
+                queue.append(dependent)
+            result[dependent].extend(variable for variable in variables if variable not in result[dependent])
+    return result
+
+
+def _sort(selected: dict, dependents: dict, order: dict) -> list:
+    # Every cell after the cells it depends on, otherwise (and in cycles of out of order executions) in notebook order
+    waiting = dict.fromkeys(selected, 0)
+    for cell_id in selected:
+        for dependent in dependents.get(cell_id, {}):
+            if dependent in waiting:
+                waiting[dependent] += 1
+    ready = [(order[cell_id], cell_id) for cell_id, count in waiting.items() if count == 0]
+    heapq.heapify(ready)
+    result = []
+    while waiting:
+        if not ready:
+            # A cycle, the first remaining cell of the notebook breaks it
+            cell_id = min(waiting, key=order.get)
+            waiting[cell_id] = 0
+            ready.append((order[cell_id], cell_id))
+        _, cell_id = heapq.heappop(ready)
+        if waiting.pop(cell_id, None) is None:
+            continue
+        result.append(cell_id)
+        for dependent in dependents.get(cell_id, {}):
+            if dependent in waiting and waiting[dependent] > 0:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    heapq.heappush(ready, (order[dependent], dependent))
+    return result
@@ -0,0 +1,105 @@
+"""Worker processes for the analysis of cells.
+
+A ``concurrent.futures.ProcessPoolExecutor`` is broken for good once one of
+its workers dies (e.g. killed for its memory), every later submit raises
+``BrokenProcessPool``. ``AnalysisPool`` replaces a broken executor with a new
+one, so the full analysis is back with the next request instead of only the
+cheaper one until the server is restarted.
+
+A request that timed out answers with the cheaper analysis, but its call keeps
+running in a worker (the result is still cached). Cells that never finish
+would occupy all workers this way, so the pool counts the running calls that
+nobody waits for anymore and terminates the workers when there are
+``max_abandoned`` of them.
+"""
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class AnalysisPool:
+    """Process pool that is started again when it broke.
+
+    Workers are only started once the first call is submitted.
+    """
+
+    def __init__(self, max_workers: int, mp_context=None, max_abandoned: int = None):
+        self.max_workers = max_workers
+        self.mp_context = mp_context
+        self.max_abandoned = max_workers if max_abandoned is None else max_abandoned
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = self._create()
+        # Running calls nobody waits for anymore
+        self._abandoned = set()
+
+    def _create(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self.mp_context)
+
+    def submit(self, fn, *args):
+        """Runs ``fn(*args)`` in a worker and returns its ``concurrent.futures.Future``.
+
+        A broken executor is replaced and the call submitted to the new one,
+        as well as one whose workers are busy with too many abandoned calls.
+        """
+        executor = self._executor
+        if len(self._abandoned) >= self.max_abandoned:
+            self.restart(executor, terminate=True)
+            executor = self._executor
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.restart(executor)
+        return self._executor.submit(fn, *args)
+
+    def abandon(self, task):
+        """Marks a call whose result nobody waits for anymore.
+
+        It is cancelled if it did not start yet, otherwise it counts towards
+        ``max_abandoned`` until it is done.
+        """
+        if task.cancel() or task.done():
+            return
+        with self._lock:
+            self._abandoned.add(task)
+        task.add_done_callback(self._discard)
+
+    @property
+    def abandoned(self) -> int:
+        return len(self._abandoned)
+
+    def _discard(self, task):
+        with self._lock:
+            self._abandoned.discard(task)
+
+    def restart(self, executor: ProcessPoolExecutor = None, terminate: bool = False):
+        """Replaces the executor with a new one.
+
+        With ``executor`` nothing happens if it was replaced already, e.g. by
+        another request that found it broken at the same time. With
+        ``terminate`` the workers of the old executor are terminated, calls
+        that are still running fail with ``BrokenProcessPool``.
+        """
+        with self._lock:
+            if executor is not None and executor is not self._executor:
+                return
+            old = self._executor
+            self._executor = self._create()
+            self._abandoned.clear()
+            self.restarts += 1
+        _shutdown(old, terminate)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+def _shutdown(executor: ProcessPoolExecutor, terminate: bool = False):
+    # Calls that did not start yet are cancelled, their requests answer with the cheaper analysis
+    processes = list((executor._processes or {}).values()) if terminate else []
+    try:
+        executor.shutdown(wait=False, cancel_futures=True)
+    except TypeError:
+        # Python before 3.9
+        executor.shutdown(wait=False)
+    for process in processes:
+        process.terminate()
@@ -0,0 +1,268 @@
+"""Parsing of notebook cells that contain IPython syntax or syntax errors.
+
+Cells are parsed once. Only if that fails the cell is split into its top
+level statements with the tokenizer and every statement is parsed on its own.
+In a broken statement the offending logical line (and the block it opens) is
+blanked and the statement is parsed again, at most ``MAX_RETRIES`` times.
+Every line is therefore parsed a bounded number of times and the cost of the
+recovery stays linear in the size of the cell.
+Blanked lines are kept as empty lines so line numbers of the analysis still
+match the cell.
+"""
+import ast
+import io
+import re
+import tokenize
+
+from . import metrics
+
+# How often a single statement is repaired before it is dropped completely
+MAX_RETRIES = 20
+
+# Cell magics that execute their body as python code in the kernel
+PYTHON_CELL_MAGICS = {"time", "timeit", "capture", "prun"}
+
+# First characters of IPython escaped commands (line magics, shell commands and help)
+ESCAPES = ("%", "!", "?")
+
+# Keywords that continue the statement of the line before
+CONTINUATIONS = {"else", "elif", "except", "finally"}
+
+_assign_magic = re.compile(r"^(\s*)([\w.\[\], *]+?)\s*=\s*[!%]")
+# Matches at least once in every cell that contains a magic
+_magic_candidate = re.compile(r"^\s*[%!?]|=\s*[!%]", re.M)
+_skipped_tokens = {tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT,
+                   tokenize.ENCODING, tokenize.ENDMARKER}
+
+
+def parse(code: str):
+    """Parses the code of a cell.
+
+    Returns
+    -------
+    tuple
+        The ``ast.Module`` of everything that could be parsed and the sorted
+        line numbers (1-based) that were dropped because they are IPython
+        magics or contain syntax errors.
+    """
+    tree, dropped, _ = parse_lines(code)
+    return tree, dropped
+
+
+def parse_lines(code: str):
+    """Same as ``parse`` but also returns the lines the tree was parsed from.
+
+    Magics and lines with syntax errors are blanked in these lines, the
+    positions of the nodes refer to them.
+    """
+    lines = io.StringIO(code).readlines()
+    dropped = strip_magics(lines)
+    try:
+        return ast.parse("".join(lines), "<string>", mode='exec'), sorted(dropped), lines
+    except SyntaxError:
+        pass
+
+    metrics.count("recovered_cells")
+    body = []
+    with metrics.phase("recovery"):
+        for start, end in split_statements(lines):
+            body.extend(_parse_statement(lines, start, end, dropped))
+    return ast.Module(body=body, type_ignores=[]), sorted(dropped), lines
+
+
+def strip_magics(lines: list) -> set:
+    """Blanks IPython specific lines in place and returns their line numbers.
+
+    Works like the escaped command transformers of IPython: a line is a
+    magic if its first character is an escape and it does not continue a
+    string or bracket of an earlier line. Assignments from magics (``x = !ls``)
+    keep their target.
+    """
+    dropped = set()
+    if _magic_candidate.search("".join(lines)) is None:
+        # Plain python, no need to scan the lines
+        return dropped
+    first = next((i for i, line in enumerate(lines) if line.strip()), None)
+    if first is not None and lines[first].lstrip().startswith("%%"):
+        # Cell magics either run their body as python or are not python at all
+        magic = lines[first].lstrip()[2:].split(None, 1)
+        if magic and magic[0] in PYTHON_CELL_MAGICS:
+            _blank(lines, first, first + 1, "")
+            dropped.add(first + 1)
+        else:
+            _blank(lines, first, len(lines), "")
+            dropped.update(i + 1 for i in range(first, len(lines)))
+        return dropped
+
+    string = None
+    depth = 0
+    continued = False
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.lstrip()
+        if string is None and depth == 0 and not continued:
+            indent = line[:len(line) - len(stripped)]
+            assign = _assign_magic.match(line)
+            if stripped.startswith(ESCAPES):
+                # Magics can be continued with a backslash like normal lines
+                end = i + 1
+                while end < len(lines) and lines[end - 1].rstrip("\r\n").endswith("\\"):
+                    end += 1
+                _blank(lines, i, end, indent + "pass" if indent else "")
+                dropped.update(range(i + 1, end + 1))
+                i = end
+                continue
+            elif assign:
+                end = i + 1
+                while end < len(lines) and lines[end - 1].rstrip("\r\n").endswith("\\"):
+                    end += 1
+                _blank(lines, i, end, "")
+                lines[i] = assign.group(1) + assign.group(2) + " = ...\n"
+                i = end
+                continue
+        string, depth, continued = _scan(line, string, depth)
+        i += 1
+    return dropped
+
+
+def _scan(line: str, string, depth: int):
+    # Tracks open strings and brackets at the end of a line
+    i = 0
+    length = len(line)
+    while i < length:
+        char = line[i]
+        if string is not None:
+            if char == "\\":
+                i += 2
+                continue
+            if line.startswith(string, i):
+                i += len(string)
+                string = None
+                continue
+            if len(string) == 1 and char in "\r\n":
+                # Unterminated single quoted string
+                string = None
+        elif char == "#":
+            break
+        elif char in "'\"":
+            string = line[i:i + 3] if line.startswith(char * 3, i) else char
+            i += len(string)
+            continue
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth = max(depth - 1, 0)
+        i += 1
+    continued = string is None and line.rstrip("\r\n").endswith("\\")
+    return string, depth, continued
+
+
+def logical_lines(lines: list) -> list:
+    """Returns ``(start, end, indent, first_token)`` for every logical line.
+
+    ``start`` and ``end`` are 0-based and inclusive. If the tokenizer fails
+    (unclosed brackets or strings, broken indentation) the remaining lines are
+    returned as one logical line each.
+    """
+    result = []
+    start = None
+    first = None
+    readline = io.StringIO("".join(lines)).readline
+    try:
+        for token in tokenize.generate_tokens(readline):
+            if token.type in _skipped_tokens:
+                continue
+            if start is None:
+                start = token.start[0] - 1
+                first = token
+            if token.type == tokenize.NEWLINE:
+                result.append((start, token.start[0] - 1, first.start[1], first.string))
+                start = None
+    except (tokenize.TokenError, SyntaxError):
+        if start is None:
+            start = result[-1][1] + 1 if result else 0
+        for i in range(start, len(lines)):
+            stripped = lines[i].lstrip()
+            if stripped.strip() and not stripped.startswith("#"):
+                word = re.match(r"\w*", stripped).group() or stripped[0]
+                result.append((i, i, len(lines[i]) - len(stripped), word))
+    return result
+
+
+def split_statements(lines: list) -> list:
+    """Returns the ``[start, end)`` line ranges of the top level statements."""
+    statements = []
+    decorator = False
+    for start, end, indent, first in logical_lines(lines):
+        if statements and (indent != 0 or first in CONTINUATIONS or decorator):
+            statements[-1][1] = end + 1
+        else:
+            statements.append([start, end + 1])
+        if indent == 0:
+            decorator = first == "@"
+    return statements
+
+
+def _parse_statement(lines: list, start: int, end: int, dropped: set) -> list:
+    # The repaired statement is written back to lines
+    statement = lines[start:end]
+    for _ in range(MAX_RETRIES):
+        try:
+            tree = ast.parse("".join(statement), "<string>", mode='exec')
+        except SyntaxError as error:
+            metrics.count("recovery_retries")
+            offending = _offending_lines(statement, error)
+            if offending is None:
+                break
+            first, last, placeholder = offending
+            _blank(statement, first, last + 1, placeholder)
+            dropped.update(range(start + first + 1, start + last + 2))
+            continue
+        ast.increment_lineno(tree, start)
+        lines[start:end] = statement
+        return tree.body
+
+    # Could not be repaired, drop the whole statement
+    dropped.update(i + 1 for i in range(start, end) if lines[i].strip())
+    _blank(lines, start, end, "")
+    return []
+
+
+def _offending_lines(statement: list, error: SyntaxError):
+    # Returns the lines that have to be blanked to get rid of the error and the placeholder for them
+    lineno = error.lineno
+    if lineno is None or not 1 <= lineno <= len(statement) + 1:
+        return None
+    logical = logical_lines(statement)
+
+    if isinstance(error, IndentationError) and error.msg.startswith("expected an indented block"):
+        # The error points to the line after a block header without body
+        index = max((i for i, line in enumerate(logical) if line[0] < lineno - 1), default=None)
+        indentation_error = False
+    else:
+        index = next((i for i, line in enumerate(logical) if line[0] <= lineno - 1 <= line[1]), None)
+        indentation_error = isinstance(error, IndentationError)
+    if index is None:
+        if lineno > len(statement):
+            return None
+        return lineno - 1, lineno - 1, ""
+
+    first, last, indent, _ = logical[index]
+    # Also remove the block that is opened by the line
+    for line in logical[index + 1:]:
+        if line[2] <= indent:
+            break
+        last = line[1]
+
+    if indentation_error:
+        # The indentation of the line itself is wrong, a placeholder would have the same problem
+        return first, last, ""
+    return first, last, statement[first][:indent] + "pass"
+
+
+def _blank(lines: list, start: int, end: int, placeholder: str):
+    for i in range(start, min(end, len(lines))):
+        lines[i] = "\n"
+    if start < len(lines) and placeholder:
+        lines[start] = placeholder + "\n"
@@ -0,0 +1,512 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+
+from .compaction import MAX_DELTA_DEPTH, MAX_DELTA_RATIO, apply_delta, cap_output, content_hash, dumps, make_delta
+from .lineage import INDEXED_FIELDS, index_terms
+
+# Largest page that is returned by one request
+MAX_PAGE_SIZE = 1000
+
+# Most blobs or executions that are read with one query, below the limit of SQLite for parameters
+BLOB_BATCH_SIZE = 500
+
+_schema = """
+CREATE TABLE IF NOT EXISTS notebooks (
+    store TEXT PRIMARY KEY,
+    cells TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    store TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    environment TEXT NOT NULL,
+    modules TEXT NOT NULL,
+    cells TEXT NOT NULL,
+    executions INTEGER NOT NULL,
+    PRIMARY KEY (store, epoch)
+);
+CREATE TABLE IF NOT EXISTS executions (
+    store TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    execution INTEGER NOT NULL,
+    cell_id TEXT NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (store, epoch, execution)
+);
+CREATE INDEX IF NOT EXISTS executions_cell ON executions (store, cell_id);
+CREATE TABLE IF NOT EXISTS blobs (
+    store TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    data TEXT NOT NULL,
+    base TEXT,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (store, hash)
+);
+CREATE TABLE IF NOT EXISTS terms (
+    store TEXT NOT NULL,
+    field TEXT NOT NULL,
+    term TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    execution INTEGER NOT NULL,
+    PRIMARY KEY (store, field, term, epoch, execution)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS indexed (
+    store TEXT PRIMARY KEY
+);
+"""
+
+
+class ProvenanceStore:
+    """Append only store for the provenance data of notebooks.
+
+    Before, the whole provenance of a notebook was kept in its metadata and
+    written back on every execution, so each execution cost as much as the
+    history before it. Here every execution is one row that is never changed
+    again, only the small rows describing the notebook and its epochs are
+    updated. The notebook metadata only keeps the id of its store and a
+    summary. Records are paged by epoch and execution.
+
+    Sources and outputs of the records are kept as blobs, see
+    ``mlprovlab.compaction``. With ``deltas`` sources are stored as deltas
+    against the last source of their cell, with ``max_output_size`` larger
+    outputs are not stored.
+
+    The names in the records are indexed to find executions by them, see
+    ``mlprovlab.lineage``.
+    """
+
+    def __init__(self, path: str, deltas: bool = True, max_output_size: int = None):
+        self.path = path
+        self.options = {"deltas": deltas, "max_output_size": max_output_size}
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_schema)
+        self._lock = threading.Lock()
+
+    def create(self, provenance: dict = None) -> str:
+        """Creates a new store and returns its id.
+
+        ``provenance`` is the data of a notebook in the old metadata format
+        (``{"epochs": [...], "cells": [...]}``) that is imported.
+        """
+        store = uuid.uuid4().hex
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute("INSERT INTO notebooks VALUES (?, ?)",
+                                     (store, json.dumps((provenance or {}).get("cells", []))))
+            sources = {}
+            for index, epoch in enumerate((provenance or {}).get("epochs", [])):
+                data = epoch.get("data", [])
+                self._connection.execute("INSERT INTO epochs VALUES (?, ?, ?, ?, ?, ?)",
+                                         (store, index, json.dumps(epoch.get("environment", {})),
+                                          json.dumps(epoch.get("modules", {})), json.dumps(epoch.get("cells", [])),
+                                          len(data)))
+                self._connection.executemany("INSERT INTO executions VALUES (?, ?, ?, ?, ?)",
+                                             ((store, index, i, record.get("cell_id", ""),
+                                               json.dumps(self._compact(store, record, sources)))
+                                              for i, record in enumerate(data)))
+                self._index_epoch(store, index, epoch.get("modules"), data)
+            self._connection.execute("INSERT INTO indexed VALUES (?)", (store,))
+        return store
+
+    def exists(self, store: str) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM notebooks WHERE store = ?", (store,)).fetchone() is not None
+
+    def has_epoch(self, store: str, epoch: int) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM epochs WHERE store = ? AND epoch = ?",
+                                            (store, epoch)).fetchone() is not None
+
+    def append(self, store: str, record: dict, environment: dict = None, modules: dict = None) -> tuple:
+        """Appends the record of an execution and returns its epoch and position in the epoch.
+
+        A new epoch is started if ``environment`` is given or the store has no
+        epoch yet. ``modules`` are added to the modules of the epoch.
+        """
+        cell_id = record.get("cell_id", "")
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            row = self._connection.execute("SELECT cells FROM notebooks WHERE store = ?", (store,)).fetchone()
+            if row is None:
+                raise KeyError(store)
+            cells = json.loads(row[0])
+            if cell_id not in cells:
+                cells.append(cell_id)
+                self._connection.execute("UPDATE notebooks SET cells = ? WHERE store = ?", (json.dumps(cells), store))
+
+            last = self._connection.execute(
+                "SELECT epoch, modules, cells, executions FROM epochs WHERE store = ? ORDER BY epoch DESC LIMIT 1",
+                (store,)).fetchone()
+            if environment is not None or last is None:
+                epoch = 0 if last is None else last[0] + 1
+                execution = 0
+                self._connection.execute("INSERT INTO epochs VALUES (?, ?, ?, ?, ?, 1)",
+                                         (store, epoch, json.dumps(environment or {}), json.dumps(modules or {}),
+                                          json.dumps([cell_id])))
+            else:
+                epoch, epoch_modules, epoch_cells, execution = last
+                epoch_modules = json.loads(epoch_modules)
+                epoch_modules.update(modules or {})
+                epoch_cells = json.loads(epoch_cells)
+                if cell_id not in epoch_cells:
+                    epoch_cells.append(cell_id)
+                self._connection.execute(
+                    "UPDATE epochs SET modules = ?, cells = ?, executions = ? WHERE store = ? AND epoch = ?",
+                    (json.dumps(epoch_modules), json.dumps(epoch_cells), execution + 1, store, epoch))
+
+            self._connection.execute("INSERT INTO executions VALUES (?, ?, ?, ?, ?)",
+                                     (store, epoch, execution, cell_id, json.dumps(self._compact(store, record))))
+            # The modules are the ones of this execution
+            terms = index_terms(record) | {("modules", module) for module in modules or {} if isinstance(module, str)}
+            self._connection.executemany("INSERT OR IGNORE INTO terms VALUES (?, ?, ?, ?, ?)",
+                                         ((store, field, term, epoch, execution) for field, term in terms))
+            self._index_epoch(store, epoch, modules, [])
+            return epoch, execution
+
+    def _index_epoch(self, store: str, epoch: int, modules: dict, records):
+        # Index rows of the modules of an epoch and of its records, in the running transaction
+        self._connection.executemany("INSERT OR IGNORE INTO terms VALUES (?, 'modules', ?, ?, -1)",
+                                     ((store, module, epoch) for module in modules or {} if isinstance(module, str)))
+        self._connection.executemany("INSERT OR IGNORE INTO terms VALUES (?, ?, ?, ?, ?)",
+                                     ((store, field, term, epoch, execution)
+                                      for execution, record in enumerate(records)
+                                      for field, term in index_terms(record, modules)))
+
+    def _ensure_index(self, store: str):
+        # Stores that were created before the index are indexed once, when they are queried first
+        if self._connection.execute("SELECT 1 FROM indexed WHERE store = ?", (store,)).fetchone() is not None:
+            return
+        if self._connection.execute("SELECT 1 FROM notebooks WHERE store = ?", (store,)).fetchone() is None:
+            raise KeyError(store)
+        with self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.execute("DELETE FROM terms WHERE store = ?", (store,))
+            for epoch, modules in self._connection.execute(
+                    "SELECT epoch, modules FROM epochs WHERE store = ? ORDER BY epoch", (store,)).fetchall():
+                rows = self._connection.execute(
+                    "SELECT record FROM executions WHERE store = ? AND epoch = ? ORDER BY execution",
+                    (store, epoch)).fetchall()
+                self._index_epoch(store, epoch, json.loads(modules), (json.loads(record) for record, in rows))
+            self._connection.execute("INSERT INTO indexed VALUES (?)", (store,))
+
+    def find(self, store: str, field: str, term: str, offset: int = 0, limit: int = 100) -> dict:
+        """Returns a page of the executions with a term in one of the ``INDEXED_FIELDS``.
+
+        Also returns the cells of all these executions with their number of
+        executions and the epochs the term occurs in.
+        """
+        if field not in INDEXED_FIELDS:
+            raise ValueError(field)
+        limit = min(limit, MAX_PAGE_SIZE)
+        with self._lock:
+            self._ensure_index(store)
+            total, = self._connection.execute(
+                "SELECT COUNT(*) FROM terms WHERE store = ? AND field = ? AND term = ? AND execution >= 0",
+                (store, field, term)).fetchone()
+            rows = self._connection.execute(
+                "SELECT terms.epoch, terms.execution, executions.cell_id FROM terms JOIN executions "
+                "ON executions.store = terms.store AND executions.epoch = terms.epoch "
+                "AND executions.execution = terms.execution "
+                "WHERE terms.store = ? AND field = ? AND term = ? AND terms.execution >= 0 "
+                "ORDER BY terms.epoch, terms.execution LIMIT ? OFFSET ?",
+                (store, field, term, limit, offset)).fetchall()
+            cells = self._connection.execute(
+                "SELECT executions.cell_id, COUNT(*) FROM terms JOIN executions "
+                "ON executions.store = terms.store AND executions.epoch = terms.epoch "
+                "AND executions.execution = terms.execution "
+                "WHERE terms.store = ? AND field = ? AND term = ? AND terms.execution >= 0 "
+                "GROUP BY executions.cell_id ORDER BY COUNT(*) DESC, executions.cell_id",
+                (store, field, term)).fetchall()
+            epochs = self._connection.execute(
+                "SELECT DISTINCT epoch FROM terms WHERE store = ? AND field = ? AND term = ? ORDER BY epoch",
+                (store, field, term)).fetchall()
+        return {
+            "executions": [{"epoch": epoch, "execution": execution, "cell_id": cell_id}
+                           for epoch, execution, cell_id in rows],
+            "total": total,
+            "cells": [{"cell_id": cell_id, "executions": count} for cell_id, count in cells],
+            "epochs": [epoch for epoch, in epochs]
+        }
+
+    def terms(self, store: str, field: str, offset: int = 0, limit: int = 100) -> dict:
+        """Returns a page of the terms of a field with the number of executions they occur in."""
+        if field not in INDEXED_FIELDS:
+            raise ValueError(field)
+        limit = min(limit, MAX_PAGE_SIZE)
+        with self._lock:
+            self._ensure_index(store)
+            total, = self._connection.execute(
+                "SELECT COUNT(DISTINCT term) FROM terms WHERE store = ? AND field = ?", (store, field)).fetchone()
+            rows = self._connection.execute(
+                "SELECT term, SUM(execution >= 0) FROM terms WHERE store = ? AND field = ? "
+                "GROUP BY term ORDER BY term LIMIT ? OFFSET ?", (store, field, limit, offset)).fetchall()
+        return {"terms": [{"term": term, "executions": count} for term, count in rows], "total": total}
+
+    def execution_terms(self, store: str, epoch: int, executions: list, field: str) -> dict:
+        """Returns the terms of a field by execution for executions of an epoch."""
+        result = {}
+        with self._lock:
+            self._ensure_index(store)
+            for start in range(0, len(executions), BLOB_BATCH_SIZE):
+                batch = executions[start:start + BLOB_BATCH_SIZE]
+                for execution, term in self._connection.execute(
+                        f"SELECT execution, term FROM terms WHERE store = ? AND field = ? AND epoch = ? "
+                        f"AND execution IN ({', '.join('?' * len(batch))}) ORDER BY term",
+                        (store, field, epoch, *batch)):
+                    result.setdefault(execution, []).append(term)
+        return result
+
+    def _compact(self, store: str, record: dict, sources: dict = None) -> dict:
+        # Moves the source and outputs of a record into blobs, in the running transaction. ``sources``
+        # keeps the hash, source and delta depth of the last execution by cell while a store is written
+        compacted = {}
+        for key, value in record.items():
+            if key == "cell_source":
+                compacted["cell_source_blob"] = self._put_source(store, record.get("cell_id", ""), value, sources)
+            elif key == "cell_outputs" and isinstance(value, list):
+                compacted["cell_outputs_blobs"] = [
+                    self._put_blob(store, cap_output(output, self.options["max_output_size"])) for output in value]
+            else:
+                compacted[key] = value
+        return compacted
+
+    def _put_blob(self, store: str, value) -> str:
+        data = dumps(value)
+        blob = content_hash(data)
+        self._connection.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, NULL, 0)", (store, blob, data))
+        return blob
+
+    def _put_source(self, store: str, cell_id: str, source, sources: dict = None) -> str:
+        data = dumps(source)
+        blob = content_hash(data)
+        if sources is not None and cell_id in sources:
+            previous = sources[cell_id]
+        else:
+            previous = self._last_source(store, cell_id)
+        row = self._connection.execute("SELECT depth FROM blobs WHERE store = ? AND hash = ?",
+                                       (store, blob)).fetchone()
+        if row is not None:
+            depth = row[0]
+        else:
+            delta = None
+            if self.options["deltas"] and isinstance(source, str) and previous is not None and \
+                    isinstance(previous[1], str) and previous[2] < MAX_DELTA_DEPTH:
+                delta = dumps(make_delta(previous[1], source))
+            if delta is not None and len(delta) <= MAX_DELTA_RATIO * len(data):
+                depth = previous[2] + 1
+                self._connection.execute("INSERT INTO blobs VALUES (?, ?, ?, ?, ?)",
+                                         (store, blob, delta, previous[0], depth))
+            else:
+                depth = 0
+                self._connection.execute("INSERT INTO blobs VALUES (?, ?, ?, NULL, 0)", (store, blob, data))
+        if sources is not None:
+            sources[cell_id] = (blob, source, depth)
+        return blob
+
+    def _last_source(self, store: str, cell_id: str):
+        # Hash, source and delta depth of the last execution of a cell, if its source is a blob
+        row = self._connection.execute(
+            "SELECT record FROM executions WHERE store = ? AND cell_id = ? ORDER BY epoch DESC, execution DESC "
+            "LIMIT 1", (store, cell_id)).fetchone()
+        blob = json.loads(row[0]).get("cell_source_blob") if row is not None else None
+        if blob is None:
+            return None
+        values, depths = self._load_blobs(store, [blob])
+        return blob, values[blob], depths[blob]
+
+    def _load_blobs(self, store: str, blobs) -> tuple:
+        # Values and delta depths of blobs by hash, deltas are applied to their bases
+        rows = {}
+        missing = set(blobs)
+        while missing:
+            missing = list(missing)
+            for start in range(0, len(missing), BLOB_BATCH_SIZE):
+                batch = missing[start:start + BLOB_BATCH_SIZE]
+                rows.update((blob, (data, base, depth)) for blob, data, base, depth in self._connection.execute(
+                    f"SELECT hash, data, base, depth FROM blobs WHERE store = ? AND hash IN "
+                    f"({', '.join('?' * len(batch))})", (store, *batch)))
+            missing = {rows[blob][1] for blob in missing if blob in rows and rows[blob][1] is not None} - rows.keys()
+
+        values = {}
+        for blob in sorted(rows, key=lambda blob: rows[blob][2]):
+            data, base, depth = rows[blob]
+            values[blob] = json.loads(data) if base is None else apply_delta(values[base], json.loads(data))
+        return values, {blob: row[2] for blob, row in rows.items()}
+
+    def _expand(self, store: str, records: list, sources: bool = True, outputs: bool = True) -> list:
+        # Restores the sources and outputs of records read from the store, the ones that are not wanted are dropped
+        blobs = set()
+        for record in records:
+            if sources and "cell_source_blob" in record:
+                blobs.add(record["cell_source_blob"])
+            if outputs:
+                blobs.update(record.get("cell_outputs_blobs") or [])
+        if not blobs and sources and outputs:
+            return records
+        values = self._load_blobs(store, blobs)[0] if blobs else {}
+        expanded = []
+        for record in records:
+            restored = {}
+            for key, value in record.items():
+                if key in ("cell_source", "cell_source_blob") and not sources:
+                    continue
+                if key in ("cell_outputs", "cell_outputs_blobs") and not outputs:
+                    continue
+                if key == "cell_source_blob":
+                    restored["cell_source"] = values[value]
+                elif key == "cell_outputs_blobs":
+                    restored["cell_outputs"] = [values[blob] for blob in value]
+                else:
+                    restored[key] = value
+            expanded.append(restored)
+        return expanded
+
+    def summary(self, store: str) -> dict:
+        with self._lock:
+            return self._summary(store)
+
+    def _summary(self, store: str) -> dict:
+        row = self._connection.execute("SELECT cells FROM notebooks WHERE store = ?", (store,)).fetchone()
+        if row is None:
+            raise KeyError(store)
+        epochs, executions = self._connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(executions), 0) FROM epochs WHERE store = ?", (store,)).fetchone()
+        return {"epochs": epochs, "executions": executions, "cells": json.loads(row[0])}
+
+    def epochs(self, store: str, offset: int = 0, limit: int = 100) -> dict:
+        """Returns a page of the epochs without their execution records."""
+        limit = min(limit, MAX_PAGE_SIZE)
+        with self._lock:
+            summary = self._summary(store)
+            rows = self._connection.execute(
+                "SELECT epoch, environment, modules, cells, executions FROM epochs "
+                "WHERE store = ? AND epoch >= ? ORDER BY epoch LIMIT ?", (store, offset, limit)).fetchall()
+        return {
+            "epochs": [{"epoch": epoch, "environment": json.loads(environment), "modules": json.loads(modules),
+                        "cells": json.loads(cells), "executions": executions}
+                       for epoch, environment, modules, cells, executions in rows],
+            "total": summary["epochs"]
+        }
+
+    def iter_epochs(self, store: str, batch_size: int = MAX_PAGE_SIZE):
+        """Yields all epochs without their execution records, reading ``batch_size`` epochs at a time."""
+        offset = 0
+        while True:
+            page = self.epochs(store, offset, batch_size)
+            yield from page["epochs"]
+            if len(page["epochs"]) < batch_size:
+                return
+            offset = page["epochs"][-1]["epoch"] + 1
+
+    def executions(self, store: str, epoch: int, offset: int = 0, limit: int = 100) -> dict:
+        """Returns a page of the execution records of an epoch."""
+        limit = min(limit, MAX_PAGE_SIZE)
+        with self._lock:
+            row = self._connection.execute("SELECT executions FROM epochs WHERE store = ? AND epoch = ?",
+                                           (store, epoch)).fetchone()
+            if row is None:
+                raise KeyError(store)
+            # The primary key makes this a range scan, the cost does not grow with the offset
+            records = self._connection.execute(
+                "SELECT record FROM executions WHERE store = ? AND epoch = ? AND execution >= ? "
+                "ORDER BY execution LIMIT ?", (store, epoch, offset, limit)).fetchall()
+            records = self._expand(store, [json.loads(record) for record, in records])
+        return {"executions": records, "total": row[0]}
+
+    def iter_executions(self, store: str, epoch: int, batch_size: int = MAX_PAGE_SIZE, sources: bool = True,
+                        outputs: bool = True):
+        """Yields all execution records of an epoch, reading ``batch_size`` records at a time.
+
+        Without ``sources`` or ``outputs`` the records leave out the sources or
+        outputs of the cells, which are then not read from the store.
+        """
+        offset = 0
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT record FROM executions WHERE store = ? AND epoch = ? AND execution >= ? "
+                    "ORDER BY execution LIMIT ?", (store, epoch, offset, batch_size)).fetchall()
+                records = self._expand(store, [json.loads(record) for record, in rows], sources, outputs)
+            yield from records
+            if len(rows) < batch_size:
+                return
+            offset += len(rows)
+
+    def cell_sources(self, store: str, cell_id: str) -> list:
+        """Returns the sources of all executions of a cell in the order they were executed."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT record FROM executions WHERE store = ? AND cell_id = ? ORDER BY epoch, execution",
+                (store, cell_id)).fetchall()
+            records = self._expand(store, [json.loads(record) for record, in rows])
+        sources = []
+        for record in records:
+            source = record.get("cell_source", "")
+            # Sources are stored as in the notebook format, a string or a list of lines
+            sources.append(source if isinstance(source, str) else "".join(source))
+        return sources
+
+    def delete(self, store: str):
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            for table in ("executions", "epochs", "notebooks", "blobs", "terms", "indexed"):
+                self._connection.execute(f"DELETE FROM {table} WHERE store = ?", (store,))
+
+    def stores(self) -> list:
+        with self._lock:
+            return [store for store, in self._connection.execute("SELECT store FROM notebooks ORDER BY store")]
+
+    def size(self, store: str) -> int:
+        """Returns the bytes of the records and blobs of a store."""
+        with self._lock:
+            return self._size(store)
+
+    def _size(self, store: str) -> int:
+        records, = self._connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(CAST(record AS BLOB))), 0) FROM executions WHERE store = ?",
+            (store,)).fetchone()
+        blobs, = self._connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(CAST(data AS BLOB))), 0) FROM blobs WHERE store = ?", (store,)).fetchone()
+        return records + blobs
+
+    def compact(self, store: str, dry_run: bool = False) -> dict:
+        """Moves the sources and outputs of records that were stored before blobs into blobs.
+
+        Returns the number of rewritten records and the bytes of the store
+        before and after. With ``dry_run`` the changes are rolled back.
+        """
+        rewritten = 0
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            before = self._size(store)
+            sources = {}
+            rows = self._connection.execute(
+                "SELECT epoch, execution, record FROM executions WHERE store = ? ORDER BY epoch, execution",
+                (store,)).fetchall()
+            for epoch, execution, record in rows:
+                record = json.loads(record)
+                if "cell_source" not in record and not isinstance(record.get("cell_outputs"), list):
+                    continue
+                self._connection.execute(
+                    "UPDATE executions SET record = ? WHERE store = ? AND epoch = ? AND execution = ?",
+                    (json.dumps(self._compact(store, record, sources)), store, epoch, execution))
+                rewritten += 1
+            after = self._size(store)
+            if dry_run:
+                self._connection.execute("ROLLBACK")
+        return {"records": rewritten, "before": before, "after": after}
+
+    def vacuum(self):
+        # The database file only shrinks after the space of the rewritten rows is given back
+        with self._lock:
+            self._connection.execute("VACUUM")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
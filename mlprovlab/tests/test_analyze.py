@@ -0,0 +1,150 @@
+import ast
+import json
+import random
+import threading
+from pathlib import Path
+
+import pytest
+
+from mlprovlab import analyze, datasources, recovery
+
+BASELINE = json.loads((Path(__file__).parent / "data" / "analyzer_baseline.json").read_text())
+FIELDS = ("definitions", "local", "remote", "imports", "modules", "data_vars", "data_values")
+POSITIONS = ("lineno", "end_lineno", "col_offset", "end_col_offset")
+
+
+@pytest.fixture
+def data_files(tmp_path, monkeypatch):
+    # The data sources of the cases are found relative to the working directory
+    for path in BASELINE["files"]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).touch()
+    monkeypatch.chdir(tmp_path)
+    datasources.stat_cache.clear()
+    yield tmp_path
+    datasources.stat_cache.clear()
+
+
+def normalize(values, positions: bool = True) -> dict:
+    # Results as they are sent as JSON, without the versions of the installed modules
+    result = json.loads(json.dumps(dict(zip(FIELDS, values))))
+    result["modules"] = {module: {key: value for key, value in info.items() if key != "version"}
+                         for module, info in result["modules"].items()}
+    if not positions:
+        result["definitions"] = [{key: value for key, value in definition.items() if key not in POSITIONS}
+                                 for definition in result["definitions"]]
+    return result
+
+
+def analyze_full(code: str) -> dict:
+    tree, _ = recovery.parse(code)
+    analyzer, _, data_values, data_vars = analyze.analyze_tree(tree)
+    return normalize((analyzer.definitions, analyzer.local_vars, analyzer.remote_vars, analyzer.imports,
+                      analyzer.modules, data_vars, data_values))
+
+
+@pytest.mark.parametrize("case", BASELINE["cases"], ids=range(len(BASELINE["cases"])))
+def test_baseline(case, data_files):
+    # The old analyzer removed lines with syntax errors, which moved the lines after them.
+    # They are blanked now, so only the positions of these cells differ.
+    try:
+        ast.parse(case["source"])
+        positions = True
+    except SyntaxError:
+        positions = False
+    expected = normalize([case[field] for field in FIELDS], positions)
+    assert normalize(analyze.analyze(case["source"])[:7], positions) == expected
+    # Again, with the statements of the cell in the memo
+    assert normalize(analyze.analyze(case["source"])[:7], positions) == expected
+
+
+def test_memo_matches_full_analysis(data_files):
+    sources = [case["source"] for case in BASELINE["cases"]]
+    pool = [line for source in sources for line in source.splitlines(keepends=True)]
+    generator = random.Random(4)
+    for source in sources:
+        lines = source.splitlines(keepends=True)
+        for _ in range(5):
+            edited = list(lines)
+            position = generator.randrange(len(edited) + 1)
+            operation = generator.choice(("insert", "replace", "delete"))
+            if operation == "insert" or not edited:
+                edited.insert(position, generator.choice(pool))
+            elif operation == "replace":
+                edited[min(position, len(edited) - 1)] = generator.choice(pool)
+            else:
+                del edited[min(position, len(edited) - 1)]
+            code = "".join(edited)
+            assert normalize(analyze.analyze(code)[:7]) == analyze_full(code)
+
+
+def test_memo_state_of_names():
+    memo = analyze.StatementMemo()
+    first = "x = 1\ny = x + 1\n"
+    second = "y = x + 1\n"
+    for code in (first, second, first):
+        tree, _, lines = recovery.parse_lines(code)
+        analyzer, _, _ = memo.run(tree, lines)
+        expected = analyze.analyze_tree(tree)[0]
+        assert analyzer.remote_vars == expected.remote_vars
+        assert analyzer.definitions == expected.definitions
+    assert len(memo) == 2
+
+
+def test_recovery_drops_magics():
+    tree, dropped = recovery.parse("%matplotlib inline\nimport os\n!ls\nfiles = !ls\nx = os.sep\n")
+    assert dropped == [1, 3]
+    assert [type(element) for element in tree.body] == [ast.Import, ast.Assign, ast.Assign]
+    # Assignments from magics keep their target
+    assert tree.body[1].targets[0].id == "files"
+    assert tree.body[2].lineno == 5
+
+
+def test_recovery_keeps_statements_around_errors():
+    code = "a = 1\nb = (\nc = a +\ndef f(:\n    return 1\nd = a\n"
+    tree, dropped = recovery.parse(code)
+    assert dropped
+    assigned = {target.id for element in tree.body if isinstance(element, ast.Assign)
+                for target in element.targets}
+    assert {"a", "d"} <= assigned
+    definitions, local_vars = analyze.analyze(code)[:2]
+    assert "a" in local_vars and "d" in local_vars
+
+
+def test_analyze_names():
+    code = "import numpy as np\nfrom os import path as p\nx, y = 1, 2\ndef f():\n    z = 3\nclass C: pass\n"
+    result = analyze.analyze_names(code)
+    assert result["tier"] == "names"
+    assert result["local"] == ["x", "y", "f", "C"]
+    assert result["imports"] == ["np", "p"]
+
+
+def test_memo_shared_by_threads():
+    # Every statement has more states than results are kept, so the threads evict results all the time
+    memo = analyze.StatementMemo(max_results=1)
+    cells = []
+    for index in range(8):
+        defined = "".join(f"v{name} = 1\n" for name in range(8) if (index >> name) % 2 == 0 or name == index)
+        cells.append(defined + "".join(f"w{name} = v{name} + v{(name + 1) % 8}\n" for name in range(8)))
+    expected = {}
+    for code in cells:
+        tree, _, lines = recovery.parse_lines(code)
+        expected[code] = analyze.analyze_tree(tree)[0].definitions
+    errors = []
+
+    def work(seed):
+        generator = random.Random(seed)
+        try:
+            for _ in range(200):
+                code = generator.choice(cells)
+                tree, _, lines = recovery.parse_lines(code)
+                assert memo.run(tree, lines)[0].definitions == expected[code]
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
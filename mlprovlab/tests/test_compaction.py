@@ -0,0 +1,51 @@
+import random
+
+from mlprovlab.compaction import apply_delta, cap_output, dumps, make_delta
+
+
+def edit(generator: random.Random, lines: list) -> list:
+    lines = list(lines)
+    for _ in range(generator.randrange(1, 4)):
+        position = generator.randrange(len(lines) + 1)
+        operation = generator.choice(("insert", "replace", "delete"))
+        if operation == "insert" or not lines:
+            lines.insert(position, generator.choice(["a = 1\n", "\n", "b = a\n", "c", "d = (\n", "    e)\n"]))
+        elif operation == "replace":
+            lines[min(position, len(lines) - 1)] = f"x = {generator.random()}\n"
+        else:
+            del lines[min(position, len(lines) - 1)]
+    return lines
+
+
+def test_delta_round_trip():
+    generator = random.Random(7)
+    for _ in range(500):
+        old = [f"line {generator.randrange(20)}\n" for _ in range(generator.randrange(30))]
+        new = edit(generator, old)
+        # Sources without a line break at the end and with other line breaks
+        if generator.random() < 0.3 and new:
+            new[-1] = new[-1].rstrip("\n")
+        if generator.random() < 0.2:
+            new = [line.replace("\n", "\r\n") for line in new]
+        old_source = "".join(old)
+        new_source = "".join(new)
+        assert apply_delta(old_source, make_delta(old_source, new_source)) == new_source
+
+
+def test_delta_copies_unchanged_lines():
+    old = "".join(f"x{i} = {i}\n" for i in range(100))
+    new = old.replace("x50 = 50\n", "x50 = 0\n")
+    delta = make_delta(old, new)
+    assert delta == [[0, 50], "x50 = 0\n", [51, 100]]
+    assert len(dumps(delta)) < len(dumps(new)) / 10
+
+
+def test_cap_output():
+    output = {"output_type": "stream", "name": "stdout", "text": "x" * 100}
+    assert cap_output(output, None) is output
+    assert cap_output(output, 1000) is output
+    capped = cap_output(output, 50)
+    removed = capped["metadata"]["mlprovlab"]["removed"]
+    assert removed["output_type"] == "stream"
+    assert removed["size"] == len(dumps(output))
+    assert str(removed["size"]) in capped["data"]["text/plain"]
@@ -0,0 +1,56 @@
+import difflib
+import random
+
+from mlprovlab.diff import diff, get_opcodes
+
+
+def apply_opcodes(old: list, new: list, opcodes: list) -> list:
+    result = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            assert old[i1:i2] == new[j1:j2]
+            result.extend(old[i1:i2])
+        else:
+            result.extend(new[j1:j2])
+    return result
+
+
+def test_opcodes_reproduce_new_lines():
+    generator = random.Random(11)
+    for _ in range(300):
+        old = [f"line {generator.randrange(15)}" for _ in range(generator.randrange(40))]
+        new = list(old)
+        for _ in range(generator.randrange(5)):
+            position = generator.randrange(len(new) + 1)
+            if generator.random() < 0.5 or not new:
+                new.insert(position, f"line {generator.randrange(30)}")
+            else:
+                del new[min(position, len(new) - 1)]
+        opcodes = get_opcodes(old, new)
+        # Opcodes cover both lists without gaps, like the ones of difflib
+        if not opcodes:
+            assert old == new == []
+            continue
+        assert opcodes[0][1] == opcodes[0][3] == 0
+        for (_, _, i2, _, j2), (_, i1, _, j1, _) in zip(opcodes, opcodes[1:]):
+            assert (i2, j2) == (i1, j1)
+        assert (opcodes[-1][2], opcodes[-1][4]) == (len(old), len(new))
+        assert apply_opcodes(old, new, opcodes) == new
+
+
+def test_opcodes_of_moved_block():
+    old = ["a", "b", "c", "d", "e"]
+    new = ["d", "e", "a", "b", "c"]
+    equal = sum(i2 - i1 for tag, i1, i2, _, _ in get_opcodes(old, new) if tag == "equal")
+    assert equal == max(block.size for block in difflib.SequenceMatcher(None, old, new).get_matching_blocks())
+
+
+def test_diff_hunks():
+    old = "".join(f"x{i} = {i}\n" for i in range(20))
+    new = old.replace("x10 = 10\n", "x10 = 0\n")
+    result = diff(old, new, context=1, intraline=True)
+    assert (result["added"], result["removed"]) == (1, 1)
+    hunk, = result["hunks"]
+    assert (hunk["old_start"], hunk["old_lines"], hunk["new_start"], hunk["new_lines"]) == (10, 3, 10, 3)
+    assert [line["type"] for line in hunk["lines"]] == ["context", "delete", "insert", "context"]
+    assert diff(old, old)["hunks"] == []
@@ -0,0 +1,35 @@
+import json
+
+from mlprovlab.export import Export, parse_time
+from mlprovlab.store import ProvenanceStore
+from mlprovlab.tests.test_store import make_record
+
+
+def test_parse_time():
+    assert parse_time("2024-05-01T10:00:00+00:00").isoformat() == "2024-05-01T10:00:00+00:00"
+    assert parse_time("Wed, 01 May 2024 10:00:00 GMT").isoformat() == "2024-05-01T10:00:00+00:00"
+    assert parse_time("yesterday") is None
+    # Records are written by the frontend, a time of another type must not abort the export
+    assert parse_time(1714557600) is None
+    assert parse_time(["2024-05-01"]) is None
+
+
+def test_prov_reads_outputs_never():
+    provenance = ProvenanceStore(":memory:")
+    store = provenance.create()
+    for index in range(3):
+        provenance.append(store, make_record("cell", f"x{index} = {index}\n",
+                                             [{"output_type": "stream", "name": "stdout", "text": f"{index}\n"}],
+                                             local=[f"x{index}"], remote=[f"x{index - 1}"] if index else [],
+                                             time=index))
+    loaded = []
+    load_blobs = provenance._load_blobs
+    provenance._load_blobs = lambda store, blobs: loaded.append(len(blobs)) or load_blobs(store, blobs)
+
+    document = json.loads("".join(Export(provenance, store).chunks("prov")))
+    # Only the pass of the entities reads blobs, the sources of the three executions
+    assert loaded == [3]
+    assert [document["entity"][f"mlprov:code/0/{index}"]["prov:value"] for index in range(3)] == \
+        [f"x{index} = {index}\n" for index in range(3)]
+    assert len(document["activity"]) == len(document["wasAssociatedWith"]) == 3
+    assert "prov:startTime" not in document["activity"]["mlprov:execution/0/0"]
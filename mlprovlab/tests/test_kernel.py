@@ -0,0 +1,57 @@
+import importlib
+import os
+import sys
+
+from mlprovlab.kernel import FileAccessTracker
+
+
+def run_cell(tracker: FileAccessTracker, code) -> list:
+    tracker.pre_run_cell()
+    try:
+        code()
+    finally:
+        tracker.post_run_cell()
+    return tracker.files()
+
+
+def test_import_is_not_recorded(tmp_path, monkeypatch):
+    (tmp_path / "tracked_helper.py").write_text("value = 1\n")
+    (tmp_path / "data.csv").write_text("a,b\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    # The first import writes the bytecode to __pycache__, the second one reads it
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
+    tracker = FileAccessTracker()
+    tracker.enable()
+    try:
+        assert run_cell(tracker, lambda: importlib.import_module("tracked_helper")) == []
+        assert (tmp_path / "__pycache__").is_dir()
+        del sys.modules["tracked_helper"]
+        assert run_cell(tracker, lambda: importlib.import_module("tracked_helper")) == []
+
+        def read():
+            with open("data.csv") as file:
+                file.read()
+            with open("tracked_helper.py") as file:
+                file.read()
+        assert run_cell(tracker, read) == [{"path": "data.csv", "mode": "r"},
+                                           {"path": "tracked_helper.py", "mode": "r"}]
+    finally:
+        tracker.disable()
+        sys.modules.pop("tracked_helper", None)
+
+
+def test_excluded_prefix_is_a_directory(tmp_path):
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "module.txt").write_text("")
+    (tmp_path / "library.txt").write_text("")
+    tracker = FileAccessTracker([str(tmp_path / "lib")])
+    tracker.enable()
+    try:
+        def read():
+            for path in ("lib/module.txt", "library.txt"):
+                with open(os.path.join(tmp_path, path)) as file:
+                    file.read()
+        assert run_cell(tracker, read) == [{"path": str(tmp_path / "library.txt"), "mode": "r"}]
+    finally:
+        tracker.disable()
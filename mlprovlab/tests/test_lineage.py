@@ -0,0 +1,22 @@
+from mlprovlab import analyze
+from mlprovlab.lineage import index_terms
+
+CODE = "from sklearn.model_selection import train_test_split as tts, KFold\nimport numpy as np\n" \
+       "X_train, X_test = tts(X, y)\n"
+
+
+def test_index_terms():
+    result = analyze.analyze_cell(CODE)
+    terms = index_terms(result, result["modules"])
+    assert {("imports", "tts"), ("imports", "KFold"), ("imports", "np"), ("local", "X_train"),
+            ("remote", "X"), ("modules", "sklearn.model_selection"), ("modules", "numpy")} <= terms
+
+
+def test_aliased_from_import():
+    modules = {"sklearn.model_selection": {"imports": [{"name": "train_test_split", "alias": "tts"}]},
+               "os": {"imports": ["path", None, {"name": "sep"}, 1]}}
+    assert index_terms({"imports": ["tts"]}, modules) == {("imports", "tts"), ("modules", "sklearn.model_selection")}
+    # The alias is bound, not the name
+    assert index_terms({"imports": ["train_test_split"]}, modules) == {("imports", "train_test_split")}
+    assert ("modules", "os") in index_terms({"imports": ["sep"]}, modules)
+    assert index_terms({"imports": [{"name": "path"}, "path"]}, modules) == {("imports", "path"), ("modules", "os")}
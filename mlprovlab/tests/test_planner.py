@@ -0,0 +1,63 @@
+from mlprovlab.graph import DependencyGraph
+from mlprovlab.planner import plan
+
+
+def make_graph(executions: list) -> DependencyGraph:
+    graph = DependencyGraph()
+    for cell_id, source, local_vars, remote_vars in executions:
+        graph.add({"cell_id": cell_id, "cell_source": source, "local": local_vars, "remote": remote_vars})
+    return graph
+
+
+EXECUTIONS = [
+    ("load", "x = 1", ["x"], []),
+    ("other", "w = 2", ["w"], []),
+    ("use", "y = x + w", ["y"], ["x", "w"]),
+    ("show", "print(y)", [], ["y"]),
+]
+CELLS = [{"cell_id": cell_id, "source": source} for cell_id, source, _, _ in EXECUTIONS]
+
+
+def test_edited_cell_and_dependents():
+    result = plan(make_graph(EXECUTIONS), ["load"], CELLS)
+    assert result["edited"] == ["load"]
+    assert result["execute"] == [{"cell_id": "load", "edited": True, "variables": []},
+                                 {"cell_id": "use", "edited": False, "variables": ["x"]},
+                                 {"cell_id": "show", "edited": False, "variables": ["y"]}]
+    assert result["stale"] == []
+
+
+def test_changed_source_is_edited():
+    cells = [dict(cell, source="w = 3") if cell["cell_id"] == "other" else cell for cell in CELLS]
+    result = plan(make_graph(EXECUTIONS), (), cells)
+    assert [item["cell_id"] for item in result["execute"]] == ["other", "use", "show"]
+
+
+def test_dependencies_before_notebook_order():
+    # "show" is above "use" in the notebook but reads a variable defined there
+    cells = [CELLS[0], CELLS[3], CELLS[1], CELLS[2]]
+    result = plan(make_graph(EXECUTIONS), ["load"], cells)
+    assert [item["cell_id"] for item in result["execute"]] == ["load", "use", "show"]
+
+
+def test_stale_cells():
+    # "load" was executed again after "use" read x
+    graph = make_graph(EXECUTIONS + [("load", "x = 1", ["x"], [])])
+    result = plan(graph, (), CELLS)
+    assert result["execute"] == []
+    assert result["stale"] == [{"cell_id": "use", "redefined": ["x"], "variables": []},
+                               {"cell_id": "show", "redefined": [], "variables": ["y"]}]
+
+
+def test_names_of_edited_source():
+    # The new source of "other" defines x as well, "use" reads it from "load" so far
+    cells = [dict(cell, source="w = 2\nx = 3") if cell["cell_id"] == "other" else cell for cell in CELLS]
+    names = {"w = 2\nx = 3": ["w", "x"]}.get
+    result = plan(make_graph(EXECUTIONS), (), cells, names)
+    assert [item["cell_id"] for item in result["execute"]] == ["other", "use", "show"]
+    assert result["execute"][1]["variables"] == ["w", "x"]
+
+
+def test_removed_cells_are_left_out():
+    result = plan(make_graph(EXECUTIONS), ["load", "gone"], CELLS[:3])
+    assert [item["cell_id"] for item in result["execute"]] == ["load", "use"]
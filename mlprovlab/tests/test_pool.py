@@ -0,0 +1,73 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from mlprovlab.pool import AnalysisPool
+
+
+@pytest.fixture
+def pool():
+    pool = AnalysisPool(2, multiprocessing.get_context("spawn"))
+    yield pool
+    pool.shutdown()
+
+
+def test_submit(pool):
+    assert pool.submit(divmod, 7, 2).result(timeout=60) == (3, 1)
+    assert pool.restarts == 0
+
+
+def test_broken_pool_is_replaced(pool):
+    # A worker that dies breaks the executor
+    with pytest.raises(BrokenProcessPool):
+        pool.submit(os._exit, 1).result(timeout=60)
+    assert pool.submit(divmod, 7, 2).result(timeout=60) == (3, 1)
+    assert pool.restarts == 1
+
+
+def test_restart_once(pool):
+    executor = pool._executor
+    pool.restart(executor)
+    pool.restart(executor)
+    assert pool.restarts == 1
+    assert pool.submit(abs, -1).result(timeout=60) == 1
+
+
+def wait_for(condition, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_abandoned_calls_are_counted(pool):
+    task = pool.submit(time.sleep, 0.5)
+    wait_for(task.running)
+    pool.abandon(task)
+    assert pool.abandoned == 1
+    task.result(timeout=60)
+    wait_for(lambda: pool.abandoned == 0)
+
+    done = pool.submit(abs, -1)
+    done.result(timeout=60)
+    pool.abandon(done)
+    assert pool.abandoned == 0
+
+
+def test_abandoned_calls_restart_the_pool():
+    pool = AnalysisPool(1, multiprocessing.get_context("spawn"))
+    try:
+        task = pool.submit(time.sleep, 600)
+        wait_for(task.running)
+        pool.abandon(task)
+        # The only worker is busy with a call nobody waits for, it is terminated
+        assert pool.submit(divmod, 7, 2).result(timeout=60) == (3, 1)
+        assert pool.restarts == 1
+        assert pool.abandoned == 0
+        with pytest.raises(BrokenProcessPool):
+            task.result(timeout=60)
+    finally:
+        pool.shutdown()
@@ -0,0 +1,152 @@
+import json
+import random
+
+import pytest
+
+from mlprovlab.store import ProvenanceStore
+
+
+def make_record(cell_id: str, source, outputs=None, **fields) -> dict:
+    record = {"cell_id": cell_id, "cell_source": source, "cell_outputs": outputs or [],
+              "local": [], "remote": [], "imports": [], "definitions": []}
+    record.update(fields)
+    return record
+
+
+def make_sources(count: int, seed: int = 1) -> list:
+    # Versions of one cell, each a small edit of the one before
+    generator = random.Random(seed)
+    lines = [f"x{i} = {i}\n" for i in range(40)]
+    sources = []
+    for version in range(count):
+        position = generator.randrange(len(lines))
+        operation = generator.choice(("insert", "replace", "delete"))
+        if operation == "insert":
+            lines.insert(position, f"y = {version}\n")
+        elif operation == "replace":
+            lines[position] = f"z = {version}  # edited\n"
+        elif len(lines) > 1:
+            del lines[position]
+        sources.append("".join(lines))
+    return sources
+
+
+@pytest.mark.parametrize("deltas", [True, False])
+def test_append_round_trip(deltas):
+    provenance = ProvenanceStore(":memory:", deltas=deltas)
+    store = provenance.create()
+    sources = make_sources(40)
+    records = []
+    for index, source in enumerate(sources):
+        record = make_record(f"cell-{index % 2}", source if index % 3 else source.splitlines(keepends=True),
+                             [{"output_type": "stream", "name": "stdout", "text": f"{index}\n"}],
+                             local=[f"x{index}"], execution_count=index)
+        records.append(record)
+        assert provenance.append(store, record, environment={"python": "3"} if index == 20 else None) == \
+            (0 if index < 20 else 1, index if index < 20 else index - 20)
+
+    assert provenance.executions(store, 0)["executions"] == records[:20]
+    assert list(provenance.iter_executions(store, 1, batch_size=7)) == records[20:]
+    # Sources are returned as strings, whatever format they were recorded in
+    assert provenance.cell_sources(store, "cell-0") == sources[0::2]
+
+
+def test_create_round_trip():
+    provenance = ProvenanceStore(":memory:")
+    sources = make_sources(10, seed=2)
+    data = [make_record("cell", source, execution_count=index) for index, source in enumerate(sources)]
+    store = provenance.create({"cells": ["cell"], "epochs": [
+        {"environment": {"python": "3"}, "modules": {"os": {"version": ""}}, "cells": ["cell"], "data": data}]})
+    assert provenance.executions(store, 0)["executions"] == data
+    assert provenance.cell_sources(store, "cell") == sources
+
+
+def test_deltas_are_smaller():
+    sizes = {}
+    for deltas in (True, False):
+        provenance = ProvenanceStore(":memory:", deltas=deltas)
+        store = provenance.create()
+        for source in make_sources(30, seed=3):
+            provenance.append(store, make_record("cell", source))
+        sizes[deltas] = provenance.size(store)
+    assert sizes[True] < sizes[False]
+
+
+def test_max_output_size():
+    provenance = ProvenanceStore(":memory:", max_output_size=100)
+    store = provenance.create()
+    small = {"output_type": "stream", "name": "stdout", "text": "small"}
+    large = {"output_type": "stream", "name": "stdout", "text": "x" * 1000}
+    provenance.append(store, make_record("cell", "print()", [small, large]))
+    outputs = provenance.executions(store, 0)["executions"][0]["cell_outputs"]
+    assert outputs[0] == small
+    assert outputs[1]["metadata"]["mlprovlab"]["removed"]["output_type"] == "stream"
+
+
+def test_compact_keeps_records():
+    provenance = ProvenanceStore(":memory:")
+    store = provenance.create()
+    records = [make_record("cell", source, [{"output_type": "stream", "name": "stdout", "text": "same"}])
+               for source in make_sources(5, seed=4)]
+    for index, record in enumerate(records):
+        # Records as they were stored before blobs
+        provenance._connection.execute("INSERT INTO executions VALUES (?, 0, ?, ?, ?)",
+                                       (store, index, record["cell_id"], json.dumps(record)))
+    provenance._connection.execute("INSERT INTO epochs VALUES (?, 0, '{}', '{}', '[\"cell\"]', ?)",
+                                   (store, len(records)))
+
+    dry_run = provenance.compact(store, dry_run=True)
+    assert dry_run["records"] == len(records)
+    assert provenance.compact(store, dry_run=True)["after"] == dry_run["after"]
+    result = provenance.compact(store)
+    assert result["after"] < result["before"]
+    assert provenance.executions(store, 0)["executions"] == records
+    assert provenance.compact(store)["records"] == 0
+
+
+def test_find():
+    provenance = ProvenanceStore(":memory:")
+    store = provenance.create()
+    provenance.append(store, make_record("a", "import pandas as pd\ndf = pd.read_csv(path)",
+                                         local=["df"], remote=["path"], imports=["pd"]),
+                      modules={"pandas": {"alias": "pd"}})
+    provenance.append(store, make_record("b", "df.head()", remote=["df"]))
+    provenance.append(store, make_record("b", "df.tail()", remote=["df"]))
+
+    found = provenance.find(store, "remote", "df")
+    assert found["executions"] == [{"epoch": 0, "execution": 1, "cell_id": "b"},
+                                   {"epoch": 0, "execution": 2, "cell_id": "b"}]
+    assert found["cells"] == [{"cell_id": "b", "executions": 2}]
+    assert provenance.find(store, "modules", "pandas")["total"] == 1
+    with pytest.raises(ValueError):
+        provenance.find(store, "cell_source", "df")
+
+
+def test_aliased_from_import():
+    source = "from sklearn.model_selection import train_test_split as tts\nparts = tts(df)"
+    modules = {"sklearn.model_selection": {"imports": [{"name": "train_test_split", "alias": "tts"}]}}
+    record = make_record("a", source, local=["parts"], remote=["df"], imports=["tts"])
+    provenance = ProvenanceStore(":memory:")
+    store = provenance.create({"cells": ["a"], "epochs": [
+        {"environment": {}, "modules": modules, "cells": ["a"], "data": [record]}]})
+    assert provenance.executions(store, 0)["executions"] == [record]
+    assert provenance.find(store, "modules", "sklearn.model_selection")["total"] == 1
+
+    provenance.append(store, record, modules=modules)
+    assert provenance.find(store, "imports", "tts")["total"] == 2
+
+    # Stores from before the index are indexed when they are queried first
+    provenance._connection.execute("DELETE FROM indexed WHERE store = ?", (store,))
+    assert provenance.find(store, "modules", "sklearn.model_selection")["total"] == 2
+
+
+def test_iter_executions_without_contents():
+    provenance = ProvenanceStore(":memory:")
+    store = provenance.create()
+    record = make_record("cell", "x = 1\n", [{"output_type": "stream", "name": "stdout", "text": "1\n"}],
+                         local=["x"])
+    provenance.append(store, record)
+    assert list(provenance.iter_executions(store, 0, outputs=False)) == \
+        [{key: value for key, value in record.items() if key != "cell_outputs"}]
+    assert list(provenance.iter_executions(store, 0, sources=False, outputs=False)) == \
+        [{key: value for key, value in record.items() if key not in ("cell_source", "cell_outputs")}]
@@ -0,0 +1,29 @@
+import json
+
+from mlprovlab import analyze, wire
+
+CELLS = {
+    "a": "import pandas as pd\nfrom os import path as p\ndf = pd.read_csv('x.csv')\n",
+    "b": "for row in df.itertuples():\n    if row.x:\n        total = row.x\n    else:\n        total = 0\n",
+    "c": "def f(a, b=df):\n    return a + b\nclass C:\n    pass\nlambda: total\n",
+}
+
+
+def test_round_trip():
+    for source in CELLS.values():
+        result = analyze.analyze_cell(source)
+        envelope = wire.encode(result)
+        assert envelope["format"] == wire.FORMAT
+        assert wire.decode(json.loads(json.dumps(envelope))) == json.loads(json.dumps(result))
+
+
+def test_batch_shares_names():
+    results = {cell_id: analyze.analyze_cell(source) for cell_id, source in CELLS.items()}
+    envelope = wire.encode_batch(results)
+    assert len(envelope["names"]) == len(set(envelope["names"]))
+    assert envelope["names"].count("df") == 1
+    assert wire.decode_batch(json.loads(json.dumps(envelope))) == json.loads(json.dumps(results))
+
+
+def test_dumps():
+    assert json.loads(wire.dumps({"a": [1, "b"]})) == {"a": [1, "b"]}
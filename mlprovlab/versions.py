@@ -0,0 +1,103 @@
+import os
+import re
+import sys
+import threading
+import time
+
+
+def normalize(name: str) -> str:
+    """Normalizes a distribution name as described in PEP 503."""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+class VersionResolver:
+    """Versions of the installed distributions by distribution or module name.
+
+    The index maps distribution names and the top level modules they provide
+    (``sklearn`` -> ``scikit-learn``) to their version. It is built on the
+    first lookup and rebuilt only when the directories on ``sys.path``
+    change, e.g. because a package was installed. The directories are
+    checked at most every ``check_interval`` seconds.
+    """
+
+    def __init__(self, check_interval: float = 5):
+        self.check_interval = check_interval
+        self._distributions = None
+        self._modules = None
+        self._stamp = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def get_version(self, module: str) -> str:
+        if not module:
+            return ""
+        with self._lock:
+            self._update()
+            version = self._distributions.get(normalize(module))
+            if version is None:
+                version = self._modules.get(module.split(".")[0], "")
+            return version
+
+    def _update(self):
+        now = time.monotonic()
+        if self._distributions is not None and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        stamp = self._path_stamp()
+        if stamp != self._stamp:
+            self._build()
+            self._stamp = stamp
+
+    @staticmethod
+    def _path_stamp():
+        stamp = []
+        for path in sys.path:
+            try:
+                stamp.append((path, os.stat(path or ".").st_mtime_ns))
+            except OSError:
+                stamp.append((path, None))
+        return tuple(stamp)
+
+    def _build(self):
+        # Imported here because importlib.metadata is only needed once the first import is analyzed
+        from importlib import metadata
+
+        distributions = {}
+        modules = {}
+        for distribution in metadata.distributions():
+            name = distribution.metadata["Name"]
+            if not name:
+                continue
+            # The first distribution found on sys.path is the one that gets imported
+            distributions.setdefault(normalize(name), distribution.version)
+            for module in self._top_level(distribution):
+                modules.setdefault(module, distribution.version)
+        self._distributions = distributions
+        self._modules = modules
+
+    @staticmethod
+    def _top_level(distribution) -> set:
+        top_level = distribution.read_text("top_level.txt")
+        if top_level:
+            return {line.strip() for line in top_level.splitlines() if line.strip()}
+
+        # Distributions without top_level.txt (e.g. built with flit or poetry) only list their files
+        modules = set()
+        for file in distribution.files or []:
+            parts = file.parts
+            if not parts or parts[0] == ".." or parts[0].endswith((".dist-info", ".egg-info", ".data")):
+                continue
+            if len(parts) > 1:
+                if parts[0] != "__pycache__" and parts[0].isidentifier():
+                    modules.add(parts[0])
+            elif file.suffix in (".py", ".so", ".pyd"):
+                modules.add(parts[0].split(".")[0])
+        return modules
+
+
+resolver = VersionResolver()
+
+
+def get_version(module: str) -> str:
+    """Returns the version of the distribution providing ``module`` or an empty string."""
+    return resolver.get_version(module)
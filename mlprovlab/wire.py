@@ -0,0 +1,131 @@
+"""Compact encoding of analysis results for the frontend.
+
+Clients opt in with ``Accept: application/vnd.mlprovlab.compact+json``. Every
+definition is sent as a tuple instead of an object repeating its keys::
+
+    [type, name, lineno, end_lineno, col_offset, end_col_offset, dependencies]
+
+and loops and conditions add ``body`` and ``orelse`` with definitions in the
+same format. Types, variable names and imports are interned in a ``names``
+table and referenced by their index (``-1`` for definitions without a name).
+The table is shared by all results of a batch, so names used in many cells
+are only sent once. All other fields of a result are sent unchanged.
+"""
+import itertools
+import json
+from collections import defaultdict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MEDIA_TYPE = "application/vnd.mlprovlab.compact+json"
+
+FORMAT = "compact"
+VERSION = 1
+
+# Fields of a result that are lists of names
+NAME_FIELDS = ("local", "remote", "imports", "data_vars")
+
+# Responses that are at least this long (in bytes) are compressed if the client accepts gzip
+GZIP_MIN_SIZE = 4096
+
+# The fastest level, higher ones take several times longer for a few percent smaller responses
+GZIP_LEVEL = 1
+
+
+class Encoder:
+    """Encodes results with one table of names."""
+
+    def __init__(self):
+        # Looking up a new name gives it the next index, the keys are the table in the order of the indexes
+        self._indexes = defaultdict(itertools.count().__next__)
+
+    @property
+    def names(self) -> list:
+        return list(self._indexes)
+
+    def result(self, result: dict) -> dict:
+        indexes = self._indexes
+        encoded = dict(result)
+        encoded["definitions"] = self.definitions(result.get("definitions", []))
+        for field in NAME_FIELDS:
+            if field in result:
+                encoded[field] = [indexes[name] for name in result[field]]
+        return encoded
+
+    def definitions(self, definitions: list) -> list:
+        indexes = self._indexes
+        encoded = []
+        append = encoded.append
+        for definition in definitions:
+            name = definition.get("name")
+            item = [indexes[definition["type"]], -1 if name is None else indexes[name],
+                    definition["lineno"], definition["end_lineno"], definition["col_offset"],
+                    definition["end_col_offset"], [indexes[dependency] for dependency in definition["dependencies"]]]
+            if "body" in definition:
+                item.append(self.definitions(definition["body"]))
+                item.append(self.definitions(definition.get("orelse", [])))
+            append(item)
+        return encoded
+
+    def envelope(self, **content) -> dict:
+        return {"format": FORMAT, "version": VERSION, "names": self.names, **content}
+
+
+def encode(result: dict) -> dict:
+    """Returns the compact form of one result."""
+    encoder = Encoder()
+    encoded = encoder.result(result)
+    return encoder.envelope(result=encoded)
+
+
+def encode_batch(results: dict) -> dict:
+    """Returns the compact form of results by cell id, with one table of names for all of them."""
+    encoder = Encoder()
+    encoded = {cell_id: encoder.result(result) for cell_id, result in results.items()}
+    return encoder.envelope(results=encoded)
+
+
+def decode(envelope: dict) -> dict:
+    """Inverse of ``encode``."""
+    return _decode_result(envelope["result"], envelope["names"])
+
+
+def decode_batch(envelope: dict) -> dict:
+    """Inverse of ``encode_batch``."""
+    names = envelope["names"]
+    return {cell_id: _decode_result(result, names) for cell_id, result in envelope["results"].items()}
+
+
+def _decode_result(encoded: dict, names: list) -> dict:
+    result = dict(encoded)
+    result["definitions"] = _decode_definitions(encoded.get("definitions", []), names)
+    for field in NAME_FIELDS:
+        if field in encoded:
+            result[field] = [names[index] for index in encoded[field]]
+    return result
+
+
+def _decode_definitions(encoded: list, names: list) -> list:
+    definitions = []
+    for item in encoded:
+        definition = {"type": names[item[0]]}
+        if item[1] >= 0:
+            definition["name"] = names[item[1]]
+        definition.update(lineno=item[2], end_lineno=item[3], col_offset=item[4], end_col_offset=item[5],
+                          dependencies=[names[index] for index in item[6]])
+        if len(item) > 7:
+            definition["body"] = _decode_definitions(item[7], names)
+            definition["orelse"] = _decode_definitions(item[8], names)
+        definitions.append(definition)
+    return definitions
+
+
+def dumps(value) -> bytes:
+    """Serializes to JSON, with orjson if it is installed."""
+    if orjson is not None:
+        # Modules of relative imports are stored under None
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
@@ -74,6 +74,9 @@ setup_args = dict(
     install_requires=[
         "jupyterlab~=3.0",
     ],
+    extras_require={
+        "test": ["pytest"],
+    },
     zip_safe=False,
     include_package_data=True,
     python_requires=">=3.6",
@@ -0,0 +1,152 @@
+import { RecordingQueue, withTimeout } from '../queue';
+
+function delay(milliseconds: number): Promise<void> {
+  return new Promise(resolve => setTimeout(resolve, milliseconds));
+}
+
+// setImmediate of node, the fake timers replace the global one
+const immediate = setImmediate;
+
+// Advance the fake timers 1 ms at a time until the promise settled, returns the number of ticks
+async function ticksUntil(promise: Promise<void>): Promise<number> {
+  var settled = false;
+  promise.then(() => {
+    settled = true;
+  });
+  var ticks = 0;
+  // Callbacks of settled promises run before the immediate
+  await new Promise(resolve => immediate(resolve));
+  while (!settled) {
+    jest.advanceTimersByTime(1);
+    ticks += 1;
+    await new Promise(resolve => immediate(resolve));
+  }
+  return ticks;
+}
+
+// Inputs of a burst of executions (e.g. "Run All"), ready after random delays
+function burst(count: number, maxDelay: number): Array<Promise<number>> {
+  return Array.from({ length: count }, (_, index) =>
+    delay(Math.random() * maxDelay).then(() => index)
+  );
+}
+
+// Recording before the queue: every execution polled a counter of recorded executions every 100 ms
+async function recordWithPolling(
+  inputs: Array<Promise<number>>,
+  record: (value: number) => Promise<void>
+): Promise<void> {
+  var lock = 0;
+  await Promise.all(
+    inputs.map(async (input, position) => {
+      const value = await input;
+      while (lock < position) {
+        await delay(100);
+      }
+      await record(value);
+      lock += 1;
+    })
+  );
+}
+
+async function recordWithQueue(
+  inputs: Array<Promise<number>>,
+  record: (value: number) => Promise<void>
+): Promise<void> {
+  const queue = new RecordingQueue();
+  const steps = inputs.map(input => queue.add(() => input.then(record)));
+  await Promise.all(steps);
+}
+
+describe('RecordingQueue', () => {
+  it('records in the order the steps were added', async () => {
+    const recorded: Array<number> = [];
+    await recordWithQueue(burst(50, 20), async value => {
+      await delay(Math.random() * 2);
+      recorded.push(value);
+    });
+    expect(recorded).toEqual(Array.from({ length: 50 }, (_, index) => index));
+  });
+
+  it('continues after a failed step', async () => {
+    const error = jest.spyOn(console, 'error').mockImplementation(() => undefined);
+    const queue = new RecordingQueue();
+    const recorded: Array<number> = [];
+    queue.add(async () => {
+      recorded.push(0);
+    });
+    const failed = queue.add(() => Promise.reject(new Error('failed')));
+    await queue.add(async () => {
+      recorded.push(2);
+    });
+    await expect(failed).resolves.toBeUndefined();
+    expect(recorded).toEqual([0, 2]);
+    expect(error).toHaveBeenCalledTimes(1);
+    error.mockRestore();
+  });
+
+  it('records a burst without waiting for polls', async () => {
+    jest.useFakeTimers();
+    try {
+      const count = 10;
+      const order = Array.from({ length: count }, (_, index) => index);
+      // The inputs of later executions are ready first, the one of the first execution after 2 * count ms
+      const inputs = () =>
+        order.map(index => delay(2 * (count - index)).then(() => index));
+
+      const polled: Array<number> = [];
+      const pollingTicks = await ticksUntil(
+        recordWithPolling(inputs(), async value => {
+          await delay(1);
+          polled.push(value);
+        })
+      );
+      const queued: Array<number> = [];
+      const queueTicks = await ticksUntil(
+        recordWithQueue(inputs(), async value => {
+          await delay(1);
+          queued.push(value);
+        })
+      );
+
+      expect(polled).toEqual(order);
+      expect(queued).toEqual(order);
+      // The queue records right after the slowest input, polling waits for a poll for every execution before
+      expect(queueTicks).toBe(2 * count + count);
+      expect(pollingTicks).toBeGreaterThanOrEqual(100 * (count - 1));
+    } finally {
+      jest.useRealTimers();
+    }
+  });
+});
+
+describe('withTimeout', () => {
+  it('resolves with the value of the promise', async () => {
+    await expect(withTimeout(delay(1).then(() => 'done'), 1000)).resolves.toBe(
+      'done'
+    );
+  });
+
+  it('rejects with the error of the promise', async () => {
+    await expect(
+      withTimeout(Promise.reject(new Error('failed')), 1000)
+    ).rejects.toThrow('failed');
+  });
+
+  it('rejects if the promise does not settle in time', async () => {
+    await expect(withTimeout(new Promise(() => undefined), 10)).rejects.toThrow(
+      'No result after 10 ms.'
+    );
+  });
+
+  it('does not hold up the queue with a missing analysis', async () => {
+    const error = jest.spyOn(console, 'error').mockImplementation(() => undefined);
+    const queue = new RecordingQueue();
+    const recorded: Array<string> = [];
+    const stalled = withTimeout(new Promise<string>(() => undefined), 10);
+    queue.add(() => stalled.then(value => void recorded.push(value)));
+    await queue.add(async () => void recorded.push('next'));
+    expect(recorded).toEqual(['next']);
+    error.mockRestore();
+  });
+});
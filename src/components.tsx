@@ -6,6 +6,8 @@
  import { CellData, ProvenanceData } from './interfaces';
  
  import { download, exportProvenance } from './functions';
+ import { deleteProvenance, getProvenance } from './provenance';
+ import { formatProfile } from './kernel';
  
  import { JupyterFrontEnd } from '@jupyterlab/application';
  
@@ -21,7 +23,9 @@
  import ReactDiffViewer from 'react-diff-viewer';
  import { useHookstate } from '@hookstate/core';
  import {
+   collapseThreshold,
    displayedExecutions,
+   heatOverlay,
    renderImports,
    rendermimeInstanceGet,
    renderOnUpdate,
@@ -103,7 +107,7 @@
  export function ProvReactComponent(props: ProvReactComponentProps) {
    //@ts-ignore
    const prov: ProvenanceData =
-     props.notebook.context.model.metadata.toJSON()['provenance'];
+     getProvenance(props.notebook);
    const menuStyle = {
      flexGrow: 0,
      userSelect: 'none',
@@ -191,7 +195,9 @@
            style={menuStyle}
            onClick={() => {
              if (prov)
-               download('MLPovLabExport.json', exportProvenance(props.notebook));
+               exportProvenance(props.notebook).then(url => {
+                 if (url) download('MLProvLabExport.json', url);
+               });
            }}
          >
            Export
@@ -270,7 +276,7 @@
  function SliderComponent(props: SliderComponentProps) {
    //@ts-ignore
    const prov: ProvenanceData =
-     props.notebook.context.model.metadata.toJSON()['provenance'];
+     getProvenance(props.notebook);
    const slider = useHookstate(sliderValues[props.notebook.id]);
  
    return (
@@ -412,7 +418,7 @@
  export function EnvironmentMenuReact(props: EnvironmentMenuReactProps) {
    //@ts-ignore
    const prov: ProvenanceData =
-     props.notebook.context.model.metadata.toJSON()['provenance'];
+     getProvenance(props.notebook);
    const environmentData = prov.epochs[props.epoch].environment;
    const padding = '10px';
    const paddingLines = '5px';
@@ -460,7 +466,7 @@
  export function ImportMenuReact(props: ImportMenuReactProps) {
    //@ts-ignore
    const prov: ProvenanceData =
-     props.notebook.context.model.metadata.toJSON()['provenance'];
+     getProvenance(props.notebook);
  
    const modules = prov.epochs[props.epoch].modules;
    const data = prov.epochs[props.epoch].data;
@@ -693,6 +699,50 @@
            ></input>
            <label>Only show dependencies of the selected execution</label>
          </div>
+         <div
+           style={{
+             width: '100%',
+             padding: '10px',
+             borderBottom: '1px solid grey',
+             boxSizing: 'border-box'
+           }}
+         >
+           <select
+             style={{ marginRight: '10px' }}
+             defaultValue={heatOverlay.get()}
+             onChange={ev => heatOverlay.set(ev.target.value as any)}
+           >
+             <option value={''}>None</option>
+             <option value={'wall'}>Wall time</option>
+             <option value={'cpu'}>CPU time</option>
+             <option value={'memory'}>Peak memory increase</option>
+           </select>
+           <label>Color executions in the graph by their profile</label>
+         </div>
+         <div
+           style={{
+             width: '100%',
+             padding: '10px',
+             borderBottom: '1px solid grey',
+             boxSizing: 'border-box'
+           }}
+         >
+           <input
+             style={{ marginRight: '10px', width: '60px' }}
+             type={'number'}
+             min={0}
+             defaultValue={collapseThreshold.get()}
+             onChange={ev =>
+               collapseThreshold.set(
+                 Math.max(0, parseInt(ev.target.value) || 0)
+               )
+             }
+           ></input>
+           <label>
+             Collapse executions with few dependencies in graphs with more
+             executions (0 never)
+           </label>
+         </div>
          <div
            style={{
              width: '100%',
@@ -721,8 +771,11 @@
                  'Are you sure you want to delete the collected provenance data for your notebook?\n\nIf so be sure that you exported the collected data first!'
                )
              ) {
-               props.notebook.model.metadata.delete('provenance');
-               props.notebook.context.save();
+               deleteProvenance(props.notebook)
+                 .then(() => props.notebook.context.save())
+                 .catch(reason => {
+                   console.error(`Error deleting provenance data.\n${reason}`);
+                 });
                props.menuToggle(false);
              } else {
              }
@@ -779,6 +832,20 @@
              Execution info of execution <b> {props.cell.execution_count} </b> at
              epoch <b> {props.epoch} </b>
            </div>
+           {props.cell.profile ? (
+             <pre
+               style={{
+                 width: '100%',
+                 boxSizing: 'border-box',
+                 padding: '10px',
+                 margin: 0,
+                 borderTop: '1px solid grey',
+                 whiteSpace: 'pre-wrap'
+               }}
+             >
+               {formatProfile(props.cell.profile)}
+             </pre>
+           ) : null}
          </div>
          {toggleInfo.length != 0
            ? props.infoElements.map((el, i) => {
@@ -876,7 +943,7 @@
    useEffect(() => {
      //@ts-ignore
      var data: ProvenanceData =
-       props.notebookPanel.context.model.metadata.toJSON()['provenance'];
+       getProvenance(props.notebookPanel);
  
      var epoch = data.epochs[localSliderValues.get().epoch.value];
  
@@ -970,7 +1037,7 @@
    useEffect(() => {
      //@ts-ignore
      var data: ProvenanceData =
-       props.notebook.context.model.metadata.toJSON()['provenance'];
+       getProvenance(props.notebook);
  
      var list: Array<any> = [];
  
@@ -984,6 +1051,16 @@
            });
          });
        }
+       // Files the kernel saw the execution open, also if their path was built at runtime
+       (cell.files || []).forEach(file => {
+         if (!cell.data_values.includes(file.path)) {
+           list.push({
+             execution: cell.execution_count,
+             source: file.path,
+             mode: file.mode
+           });
+         }
+       });
      });
  
      setSources(list);
@@ -1009,8 +1086,20 @@
                borderBottom: i == source.length - 1 ? '1px solid grey' : ''
              }}
            >
-             Source <b>{source.source}</b> was first used in execution{' '}
-             <b>{source.execution}</b> in variable <b>{source.variable}</b>
+             {source.mode ? (
+               <>
+                 File <b>{source.source}</b> was{' '}
+                 {{ r: 'read', w: 'written', rw: 'read and written' }[
+                   source.mode as 'r' | 'w' | 'rw'
+                 ]}{' '}
+                 in execution <b>{source.execution}</b>
+               </>
+             ) : (
+               <>
+                 Source <b>{source.source}</b> was first used in execution{' '}
+                 <b>{source.execution}</b> in variable <b>{source.variable}</b>
+               </>
+             )}
            </div>
          );
        })}
@@ -1,63 +1,82 @@
+import { URLExt } from '@jupyterlab/coreutils';
+
 import { NotebookPanel } from '@jupyterlab/notebook';
 
-import { ProvenanceData } from './interfaces';
+import { ServerConnection } from '@jupyterlab/services';
+
+import { ProvenancePointer, loadProvenance } from './provenance';
+
+/**
+ * Options of the provenance export
+ */
+export interface ExportOptions {
+  // json (same structure as before), ndjson or prov (W3C PROV-JSON)
+  format?: 'json' | 'ndjson' | 'prov';
+  // Indices of the exported epochs, all if not given
+  epochs?: Array<number>;
+  // Only executions in this time range (ISO 8601) are exported
+  start?: string;
+  end?: string;
+  gzip?: boolean;
+}
 
-export function exportProvenance(notebook: NotebookPanel): string {
+/**
+ * Get the URL of the provenance export of a notebook
+ *
+ * The export is streamed by the server from the provenance store, so it is
+ * never built in the browser.
+ *
+ * @param notebook
+ * @param options
+ * @returns The URL or undefined if nothing was recorded yet
+ */
+export async function exportProvenance(
+  notebook: NotebookPanel,
+  options: ExportOptions = {}
+): Promise<string | undefined> {
+  // Provenance data in the old format is imported into the store on load
+  await loadProvenance(notebook);
   //@ts-ignore
-  var prov_data: ProvenanceData =
-    notebook.context.model.metadata.toJSON()['provenance'];
-  var prov_export: { used_data: Array<string>; epochs: Array<any> } = {
-    used_data: [],
-    epochs: []
-  };
-  for (let indexEpoch = 0; indexEpoch < prov_data.epochs.length; indexEpoch++) {
-    const epoch = prov_data.epochs[indexEpoch];
-    var newEpoch: any = {
-      kernel_start_time: epoch.environment.time,
-      language: epoch.environment.language_info.name,
-      language_version: epoch.environment.language_info.version,
-      language_mimetype: epoch.environment.language_info.mimetype,
-      kernel: epoch.environment.kernel.implementation,
-      kernel_version: epoch.environment.kernel.version,
-      user_agent: epoch.environment.user_agent,
-      modules: epoch.modules,
-      execution_data: []
-    };
-    for (let indexCell = 0; indexCell < epoch.data.length; indexCell++) {
-      const cell = epoch.data[indexCell];
-      cell.data_values.forEach(el =>
-        prov_export.used_data.includes(el)
-          ? null
-          : prov_export.used_data.push(el)
-      );
-      var newCell: any = {
-        execution_count: cell.execution_count,
-        used_data: cell.data_values,
-        data_vars: cell.data_vars,
-        execution_info: cell.definitions,
-        code: cell.cell_source,
-        cell_id: cell.cell_id,
-        dependencies: cell.remote,
-        imports: cell.imports,
-        outputs: cell.cell_outputs,
-        definitions: cell.local,
-        definition_info: cell.local_info,
-        time: cell.time
-      };
-      newEpoch.execution_data.push(newCell);
-    }
-    prov_export.epochs.push(newEpoch);
+  const pointer: ProvenancePointer = notebook.model.metadata.toJSON()[
+    'provenance'
+  ];
+  if (!pointer || !pointer.store) {
+    return undefined;
   }
 
-  return JSON.stringify(prov_export);
+  const settings = ServerConnection.makeSettings();
+  const query: { [key: string]: string } = {
+    format: options.format || 'json'
+  };
+  if (options.epochs) {
+    query.epochs = options.epochs.join(',');
+  }
+  if (options.start) {
+    query.start = options.start;
+  }
+  if (options.end) {
+    query.end = options.end;
+  }
+  if (options.gzip) {
+    query.gzip = '1';
+  }
+  if (settings.token) {
+    query.token = settings.token;
+  }
+  return (
+    URLExt.join(
+      settings.baseUrl,
+      'mlprovlab',
+      'provenance',
+      pointer.store,
+      'export'
+    ) + URLExt.objectToQueryString(query)
+  );
 }
 
-export function download(filename: string, text: string) {
+export function download(filename: string, url: string) {
   var element = document.createElement('a');
-  element.setAttribute(
-    'href',
-    'data:text/plain;charset=utf-8,' + encodeURIComponent(text)
-  );
+  element.setAttribute('href', url);
   element.setAttribute('download', filename);
 
   element.style.display = 'none';
@@ -17,7 +17,7 @@
    INotebookTracker
  } from '@jupyterlab/notebook';
  
- import { Cell } from '@jupyterlab/cells';
+ import { Cell, ICellModel } from '@jupyterlab/cells';
  
  import { IDisposable } from '@lumino/disposable';
  
@@ -30,9 +30,19 @@
    ReactWidget
  } from '@jupyterlab/apputils';
  import { requestAPI } from './handler';
+ import {
+   formatSummary,
+   summarizeExecution,
+   ExecutionSummary,
+   VariableSummary
+ } from './kernel';
+ import { LiveAnalysis } from './live';
+ import { ANALYSIS_WAIT_TIMEOUT, RecordingQueue, withTimeout } from './queue';
+ import { COMPACT_REQUEST, decodeBatch } from './wire';
+ import { appendExecution, getProvenance, loadProvenance } from './provenance';
  import { Widget } from '@lumino/widgets';
  
- import { CellData, ProvenanceData } from './interfaces';
+ import { CellData, Dictionary, ProvenanceData } from './interfaces';
  import {
    InitCytoscape,
    InitialRender,
@@ -60,6 +70,15 @@
    zoomOnSelect
  } from './states';
  
+ /**
+  * Execution of a cell whose reply has not been recorded yet
+  */
+ interface PendingExecution {
+   cell: ICellModel;
+   analysis: Promise<any>;
+   summary: Promise<ExecutionSummary>;
+ }
+
  class ButtonExtension
    implements DocumentRegistry.IWidgetExtension<NotebookPanel, INotebookModel>
  {
@@ -153,26 +172,114 @@
  
      rendermimeInstanceSet(rendermime);
  
-     var counter = 0;
-     var lock = 0;
- 
      //#region Error tracking
- 
-     // Dictionaries for info requests
-     var msgDict: any = {};
-     var infoDict: any = {};
-     var cellDict: any = {};
-     var promiseDict: any = {};
+
+     // Info of the kernel for the environment of new epochs
      var kernelInfo: any = {};
- 
+
      const attachTracker = function (nbPanel: NotebookPanel) {
+       // Edits are sent over one WebSocket per notebook, only results of the latest versions arrive
+       const liveAnalysis = new LiveAnalysis();
+       nbPanel.disposed.connect(() => liveAnalysis.dispose());
+
+       // Executions of cells by the message id of their execute request
+       var executions: Dictionary<PendingExecution> = {};
+       // Executions are recorded one after the other in the order of their replies
+       const recording = new RecordingQueue();
+
+       // Records an execution as soon as its analysis and the summary of its variables are there
+       const recordExecution = async function (
+         execution: PendingExecution,
+         reply: any,
+         timestamp: string
+       ) {
+         const cell = execution.cell;
+         if (cell.toJSON().cell_type !== 'code') {
+           return;
+         }
+         const [data, summary] = await Promise.all([
+           execution.analysis,
+           execution.summary
+         ]);
+         var local_info: Dictionary<VariableSummary | string> = {};
+         data['local'].forEach((element: string) => {
+           local_info[element] = summary.variables[element.trim()] || '';
+         });
+
+         // Without provenance data the execution starts the first epoch
+         const prov_init = !nbPanel.model.metadata.has('provenance');
+
+         var cell_id: string;
+         if (cell.metadata.has('prov_id')) {
+           cell_id = cell.metadata.get('prov_id').toString();
+         } else {
+           cell.metadata.set('prov_id', cell.id);
+           cell_id = cell.id;
+         }
+
+         // General structure of provenance data
+         var prov_data: CellData = {
+           cell_id: cell_id,
+           cell_source: cell.toJSON().source,
+           //@ts-ignore
+           cell_outputs: cell.toJSON().outputs,
+           execution_count: reply.execution_count,
+           type: reply.status == 'ok' ? 'execution' : 'error',
+           local: data['local'],
+           remote: data['remote'],
+           imports: data['imports'],
+           local_info: local_info,
+           data_values: data['data_values'],
+           data_vars: data['data_vars'],
+           definitions: data['definitions'],
+           time: timestamp
+         };
+         // Files and profile belong to another execution if the kernel ran something in between
+         if (summary.execution_count === reply.execution_count) {
+           if (summary.files) {
+             prov_data.files = summary.files;
+           }
+           if (summary.profile) {
+             prov_data.profile = summary.profile;
+           }
+         }
+
+         var environment: any = undefined;
+         if (reply.execution_count == 1 || prov_init) {
+           environment = {
+             time: new Date().toUTCString(),
+             user_agent: navigator.userAgent,
+             kernel: {
+               //@ts-ignore
+               implementation: kernelInfo.implementation,
+               //@ts-ignore
+               version: kernelInfo.implementation_version
+             },
+             language_info: {
+               //@ts-ignore
+               name: kernelInfo.language_info.name,
+               //@ts-ignore
+               version: kernelInfo.language_info.version,
+               //@ts-ignore
+               mimetype: kernelInfo.language_info.mimetype
+             }
+           };
+         }
+
+         // Only the new record is sent to the provenance store, the metadata keeps a pointer to it
+         await appendExecution(nbPanel, prov_data, data['modules'], environment);
+       };
+
        const trackExecution = function (
          _: Kernel.IKernelConnection,
          message: Kernel.IAnyMessageArgs
        ) {
          if (
            message.direction == 'send' &&
-           message.msg.header.msg_type == 'execute_request'
+           message.msg.header.msg_type == 'execute_request' &&
+           // Silent requests like the one loading the kernel extension are not executions of cells
+           !(message.msg.content as any).silent &&
+           message.msg.metadata.cellId
          ) {
            var iter = nbPanel.content.model.cells.iter();
            var cell = iter.next();
@@ -182,235 +289,49 @@
              }
              cell = iter.next();
            }
- 
-           msgDict[cell.id] = [];
-           cellDict[message.msg.header.msg_id] = cell.id;
- 
-           var local: string[];
- 
-           // Get the local variables of the execution
-           while (!local) local = infoDict[cell.id]['local'];
- 
-           var inspectPromises: Array<Promise<any>> = [];
- 
-           // Execute the inspect requests for the execution
-           if (local != []) {
-             for (let index = 0; index < local.length; index++) {
-               const element = local[index];
-               inspectPromises.push(
-                 nbPanel.sessionContext.session.kernel.requestInspect({
-                   code: element.trim(),
-                   cursor_pos: 0,
-                   detail_level: 1
-                 })
-               );
-             }
+           if (!cell) {
+             return;
            }
- 
-           // Get expect results and put them in storage
-           const inspectWait = async function () {
-             for await (var val of inspectPromises) {
-               //@ts-ignore
-               if (val.content.data['text/plain']) {
-                 //@ts-ignore
-                 var data: any = val.content.data['text/plain'].split(
-                   /(\u001b\[1;31m[\w\s]+:\u001b\[0m)/
-                 );
- 
-                 //@ts-ignore
-                 var str: string = '';
- 
-                 for (let index = 1; index < data.length; index += 2) {
-                   const regex = data[index];
- 
-                   if (
-                     regex.search('Source:') == -1 &&
-                     regex.search('Class docstring:') == -1
-                   ) {
-                     str += regex + data[index + 1];
-                   }
-                 }
-                 //@ts-ignore
-                 msgDict[cell.id].push(str);
-               } else {
-                 msgDict[cell.id].push('');
-               }
-             }
+
+           // The analysis of the executed version, it is usually there already. Without it the
+           // execution is not recorded, instead of holding up the recording of all later ones
+           const analysis = withTimeout(
+             liveAnalysis.analyzed(cell.id, cell.toJSON().source.toString()),
+             ANALYSIS_WAIT_TIMEOUT
+           );
+           const latest = liveAnalysis.latest(cell.id);
+           executions[message.msg.header.msg_id] = {
+             cell: cell,
+             analysis: analysis,
+             // Requested right away so the kernel answers it after this execution
+             summary: summarizeExecution(
+               nbPanel.sessionContext.session.kernel,
+               latest ? latest['local'] : undefined,
+               analysis.then(data => data['local'])
+             )
            };
-           promiseDict[message.msg.header.msg_id] = inspectWait();
          }
- 
+
          // If error message is there find corresponding cell in the notebook panel
          if (
            message.direction == 'recv' &&
            message.msg.header.msg_type == 'execute_reply' &&
            //@ts-ignore
+           message.msg.parent_header.msg_id in executions &&
+           //@ts-ignore
            (message.msg.content.status == 'error' ||
              //@ts-ignore
              message.msg.content.status == 'ok')
          ) {
-           //Set counter so that other possible connections wait
-           var local_counter = counter;
-           counter += 1;
- 
-           // Attach to contentChanged because the modelDB does update later
-           const getExecutionCount = async function getExecutionCountFunc() {
-             var iter = nbPanel.content.model.cells.iter();
-             var cell = iter.next();
-             //@ts-ignore
-             var execution_count = message.msg.content.execution_count;
-             while (cell) {
-               if (
-                 //@ts-ignore
-                 cell.id == cellDict[message.msg.parent_header.msg_id]
-               ) {
-                 break;
-               }
-               cell = iter.next();
-             }
- 
-             var prov: any;
-             var prov_init = false;
- 
-             var local: string[] = [];
-             var remote: string[] = [];
-             var imports: string[] = [];
-             var modules: string[] = [];
-             var local_info: {} = {};
-             var cell_id: string;
-             var data_vars: string[] = [];
-             var data_values: string[] = [];
-             var definitions: Array<any>;
-             var timestamp = new Date().toUTCString();
- 
-             if (cell.toJSON().cell_type === 'code') {
-               var data = infoDict[cell.id];
-               definitions = data['definitions'];
-               local = data['local'];
-               remote = data['remote'];
-               imports = data['imports'];
-               modules = data['modules'];
-               data_vars = data['data_vars'];
-               data_values = data['data_values'];
- 
-               //@ts-ignore
-               await promiseDict[message.msg.parent_header.msg_id];
-               if (local != []) {
-                 for (let index = 0; index < local.length; index++) {
-                   const element = local[index];
-                   //@ts-ignore
-                   local_info[element] = msgDict[cell.id][index];
-                 }
-               }
- 
-               while (lock < local_counter) {
-                 await new Promise(r => setTimeout(r, 100));
-               }
- 
-               if (nbPanel.model.metadata.has('provenance')) {
-                 prov = nbPanel.model.metadata.toJSON().provenance;
-               } else {
-                 prov = { epochs: [], cells: [] };
-                 prov_init = true;
-               }
- 
-               if (cell.metadata.has('prov_id')) {
-                 cell_id = cell.metadata.get('prov_id').toString();
-               } else {
-                 cell.metadata.set('prov_id', cell.id);
-                 cell_id = cell.id;
-               }
- 
-               if (!prov['cells'].includes(cell_id)) {
-                 prov.cells.push(cell_id);
-               }
- 
-               // General structure of provenance data
-               var prov_data: CellData = {
-                 cell_id: cell_id,
-                 cell_source: cell.toJSON().source,
-                 //@ts-ignore
-                 cell_outputs: cell.toJSON().outputs,
-                 execution_count: execution_count,
-                 type:
-                   //@ts-ignore
-                   message.msg.content.status == 'ok' ? 'execution' : 'error',
-                 local: local,
-                 remote: remote,
-                 imports: imports,
-                 local_info: local_info,
-                 data_values: data_values,
-                 data_vars: data_vars,
-                 definitions: definitions,
-                 time: timestamp
-               };
- 
-               if (lock === local_counter) {
-                 if (execution_count == 1 || prov_init) {
-                   prov.epochs.push({
-                     modules: modules,
-                     data: [prov_data],
-                     cells: [cell_id],
-                     environment: {
-                       time: new Date().toUTCString(),
-                       user_agent: navigator.userAgent,
-                       kernel: {
-                         //@ts-ignore
-                         implementation: kernelInfo.implementation,
-                         //@ts-ignore
-                         version: kernelInfo.implementation_version
-                       },
-                       language_info: {
-                         //@ts-ignore
-                         name: kernelInfo.language_info.name,
-                         //@ts-ignore
-                         version: kernelInfo.language_info.version,
-                         //@ts-ignore
-                         mimetype: kernelInfo.language_info.mimetype
-                       }
-                     }
-                   });
- 
-                   nbPanel.model.metadata.set('provenance', prov);
-                 } else {
-                   // Add cell to used cell in the epoch if its not already there
-                   if (
-                     !prov.epochs[prov.epochs.length - 1]['cells'].includes(
-                       cell_id
-                     )
-                   ) {
-                     prov.epochs[prov.epochs.length - 1].cells.push(cell_id);
-                   }
- 
-                   // Add new collected provenance data
-                   prov.epochs[prov.epochs.length - 1].data.push(prov_data);
- 
-                   // Add new imported modules if any
-                   if (modules) {
-                     prov.epochs[prov.epochs.length - 1].modules = {
-                       ...prov.epochs[prov.epochs.length - 1].modules,
-                       ...modules
-                     };
-                   }
- 
-                   nbPanel.model.metadata.set('provenance', prov);
-                 }
- 
-                 //nbPanel.context.save();
-                 lock += 1;
-               }
-             } else {
-               while (lock < local_counter) {
-                 await new Promise(r => setTimeout(r, 100));
-               }
- 
-               lock += 1;
-             }
-           };
- 
-           getExecutionCount();
+           //@ts-ignore
+           const msg_id: string = message.msg.parent_header.msg_id;
+           const execution = executions[msg_id];
+           delete executions[msg_id];
+           const reply: any = message.msg.content;
+           const timestamp = new Date().toUTCString();
+           recording.add(() => recordExecution(execution, reply, timestamp));
          }
- 
+
          if (
            message.direction == 'recv' &&
            message.msg.header.msg_type == 'kernel_info_reply'
@@ -418,7 +339,7 @@
            kernelInfo = message.msg.content;
          }
        };
- 
+
        const focusNode = async function focusNodeFunc(_: any, cell: Cell) {
          if (typeof cell != 'undefined') {
            var cellData = cell.model.metadata.toJSON();
@@ -437,36 +358,58 @@
        };
        nbPanel.content.activeCellChanged.connect(focusNode);
  
+       const analyzeCell = function (cell: ICellModel) {
+         liveAnalysis.update(cell.id, cell.toJSON().source.toString());
+       };
+
+       // Cells added while the notebook is loaded are analyzed with one batch request below
+       var initialLoad = true;
+
        // We need to execute AST Analyze after every cell change because we cant do it if a cell is executed
        nbPanel.model.cells.changed.connect((_, args) => {
          if (args.newValues[0]) {
-           requestAPI<any>('analyze', {
-             body: JSON.stringify(args.newValues[0].toJSON().source.toString()),
-             method: 'POST'
-           })
-             .then(data => {
-               infoDict[args.newValues[0].id] = data;
-             })
-             .catch(reason => {
-               console.error(
-                 `Error analyzing code (probably because you used ipython magic).\n${reason}`
-               );
+           if (!initialLoad) {
+             analyzeCell(args.newValues[0]);
+           }
+           args.newValues[0].contentChanged.connect(analyzeCell);
+         }
+       });
+
+       nbPanel.context.ready.then(() => {
+         initialLoad = false;
+         loadProvenance(nbPanel).catch(reason => {
+           console.error(`Error loading provenance data.\n${reason}`);
+         });
+         var cells: Array<{ cell_id: string; source: string }> = [];
+         var iter = nbPanel.model.cells.iter();
+         var cell = iter.next();
+         while (cell) {
+           // Already connected cells are ignored by the signal
+           cell.contentChanged.connect(analyzeCell);
+           if (cell.type === 'code') {
+             cells.push({
+               cell_id: cell.id,
+               source: cell.toJSON().source.toString()
              });
-           args.newValues[0].contentChanged.connect(cell => {
-             requestAPI<any>('analyze', {
-               body: JSON.stringify(cell.toJSON().source.toString()),
-               method: 'POST'
-             })
-               .then(data => {
-                 infoDict[cell.id] = data;
-               })
-               .catch(reason => {
-                 console.error(
-                   `Error analyzing code (probably because you used ipython magic).\n${reason}`
-                 );
-               });
-           });
+           }
+           cell = iter.next();
          }
+
+         requestAPI<any>('analyze_batch', {
+           body: JSON.stringify(cells),
+           method: 'POST',
+           ...COMPACT_REQUEST
+         })
+           .then(response => {
+             const data = decodeBatch(response);
+             for (const cell_id in data) {
+               // Results of edits made while the batch was running are not overwritten
+               liveAnalysis.set(cell_id, data[cell_id]);
+             }
+           })
+           .catch(reason => {
+             console.error(`Error analyzing notebook.\n${reason}`);
+           });
        });
  
        // Attach function to kernel to get error messages
@@ -487,7 +430,7 @@
      //#region Main widget open command
      const ProvenanceCommand: string = 'prov-tracking:open';
      app.commands.addCommand(ProvenanceCommand, {
-       execute: args => {
+       execute: async args => {
          var { title, id, path } = args;
  
          //@ts-ignore
@@ -498,6 +441,9 @@
          } else {
            notebookPanel = nbTracker.find(nb => nb.context.path === path);
          }
+
+         // Provenance data is loaded from the store once per notebook
+         await loadProvenance(notebookPanel);
          var widget_id: any;
          if (id) {
            //@ts-ignore
@@ -525,7 +471,7 @@
  
            //@ts-ignore
            let prov: ProvenanceData =
-             notebookPanel.context.model.metadata.toJSON()['provenance'];
+             getProvenance(notebookPanel);
  
            // This need to be called before the prov component is created so the sliders and values of them are displayed properly
            if (typeof prov != 'undefined') {
@@ -601,14 +547,14 @@
  
            //@ts-ignore
            var prov =
-             notebookPanel.context.model.metadata.toJSON()['provenance'];
+             getProvenance(notebookPanel);
  
            epoch_slider.addEventListener('input', ev => {
              EpochChangeRender(
                //@ts-ignore
                epoch_slider,
                cell_slider,
-               notebookPanel.context.model.metadata.toJSON()['provenance'],
+               getProvenance(notebookPanel),
                cy,
                notebookPanel
              );
@@ -619,7 +565,7 @@
                //@ts-ignore
                epoch_slider,
                cell_slider,
-               notebookPanel.context.model.metadata.toJSON()['provenance'],
+               getProvenance(notebookPanel),
                cy,
                notebookPanel
              );
@@ -632,7 +578,7 @@
                    //@ts-ignore
                    epoch_slider,
                    cell_slider,
-                   args.newValue,
+                   getProvenance(notebookPanel),
                    cy,
                    notebookPanel,
                    true
@@ -646,7 +592,7 @@
                    //@ts-ignore
                    epoch_slider,
                    cell_slider,
-                   args.newValue,
+                   getProvenance(notebookPanel),
                    cy,
                    notebookPanel
                  );
@@ -659,7 +605,7 @@
                    //@ts-ignore
                    epoch_slider,
                    cell_slider,
-                   args.newValue,
+                   getProvenance(notebookPanel),
                    cy,
                    notebookPanel
                  );
@@ -690,7 +636,7 @@
      //#region Diff widget open command
      const DiffCommand: string = 'prov-diff:open';
      app.commands.addCommand(DiffCommand, {
-       execute: args => {
+       execute: async args => {
          //@ts-ignore
          var { title, id, path, cell_id, execution_count, epoch } = args;
  
@@ -702,6 +648,9 @@
          } else {
            notebookPanel = nbTracker.find(nb => nb.context.path === path);
          }
+
+         // Provenance data is loaded from the store once per notebook
+         await loadProvenance(notebookPanel);
  
          var widget_id: string;
          if (id) {
@@ -736,7 +685,7 @@
  
            //@ts-ignore
            var data: ProvenanceData =
-             notebookPanel.context.model.metadata.toJSON()['provenance'];
+             getProvenance(notebookPanel);
  
            if (data) {
              var source = data.epochs[parseInt(epoch.toString())].data.find(
@@ -847,7 +796,7 @@
      //#region Info widget command
      const InfoCommand: string = 'prov-info:open';
      app.commands.addCommand(InfoCommand, {
-       execute: args => {
+       execute: async args => {
          //@ts-ignore
          var {
            title,
@@ -868,6 +817,9 @@
          } else {
            notebookPanel = nbTracker.find(nb => nb.context.path === path);
          }
+
+         // Provenance data is loaded from the store once per notebook
+         await loadProvenance(notebookPanel);
  
          var widget_id: string;
          if (id) {
@@ -900,7 +852,7 @@
  
            //@ts-ignore
            var data: ProvenanceData =
-             notebookPanel.context.model.metadata.toJSON()['provenance'];
+             getProvenance(notebookPanel);
  
            if (data) {
              var cell = data.epochs[parseInt(epoch.toString())].data.find(
@@ -914,7 +866,7 @@
                var text: string = '';
                text =
                  //@ts-ignore
-                 cell.local_info[variable];
+                 formatSummary(cell.local_info[variable]);
  
                var mimeType = rendermime.preferredMimeType(
                  {
@@ -947,7 +899,7 @@
                  var text: string = '';
                  text +=
                    //@ts-ignore
-                   cell.local_info[key];
+                   formatSummary(cell.local_info[key]);
  
                  var mimeType = rendermime.preferredMimeType(
                    {
@@ -1064,7 +1016,7 @@
  
      const NotebookCommand: string = 'prov-notebook:open';
      app.commands.addCommand(NotebookCommand, {
-       execute: args => {
+       execute: async args => {
          //@ts-ignore
          var { path } = args;
  
@@ -1076,6 +1028,9 @@
          } else {
            notebookPanel = nbTracker.find(nb => nb.context.path === path);
          }
+
+         // Provenance data is loaded from the store once per notebook
+         await loadProvenance(notebookPanel);
  
          var widget_id: string;
          widget_id = 'provenance-notebook-widget-' + notebookPanel.context.path;
@@ -1105,7 +1060,7 @@
  
            //@ts-ignore
            var data: ProvenanceData =
-             notebookPanel.context.model.metadata.toJSON()['provenance'];
+             getProvenance(notebookPanel);
  
            if (data) {
              content = ReactWidget.create(
@@ -42,6 +42,37 @@ export interface BodyDefinition {
   orelse: Array<Definition | BodyDefinition>;
 }
 
+/**
+ * File opened by an execution, recorded by the kernel extension
+ */
+export interface FileAccess {
+  // Relative to the working directory of the kernel if the file is in it
+  path: string;
+  mode: 'r' | 'w' | 'rw';
+}
+
+/**
+ * Time and memory used by an execution, measured by the kernel extension
+ */
+export interface ExecutionProfile {
+  // Seconds
+  wall: number;
+  cpu: number;
+  // Bytes, not known on Windows
+  peak_rss?: number;
+  peak_rss_delta?: number;
+  // Only with tracemalloc (%mlprovlab_profile allocations)
+  python_peak?: number;
+  allocations?: Array<{
+    file: string;
+    line: number;
+    size: number;
+    count: number;
+  }>;
+  // Seconds spent profiling
+  overhead: number;
+}
+
 export interface CellData {
   cell_id: string;
   cell_source: MultilineString;
@@ -54,6 +85,8 @@ export interface CellData {
   local_info: {};
   data_vars: string[];
   data_values: string[];
+  files?: Array<FileAccess>;
+  profile?: ExecutionProfile;
   time: string;
   type: 'error' | 'execution';
 }
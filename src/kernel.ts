@@ -0,0 +1,329 @@
+import { Kernel, KernelMessage } from '@jupyterlab/services';
+
+import { Dictionary, ExecutionProfile, FileAccess } from './interfaces';
+
+/**
+ * Comm target registered by the IPython extension mlprovlab.kernel
+ */
+const COMM_TARGET = 'mlprovlab';
+
+/**
+ * Summary of a variable as sent by the kernel
+ */
+export interface VariableSummary {
+  type: string;
+  shape?: Array<number>;
+  dtype?: string;
+  len?: number;
+  nbytes?: number;
+  // nbytes is an estimate from the size of the object (and its first items)
+  estimated?: boolean;
+  // Representation of scalars
+  value?: string;
+  error?: string;
+}
+
+/**
+ * What the kernel knows about an execution after it ran
+ */
+export interface ExecutionSummary {
+  // Summaries of the defined names or the inspect texts
+  variables: Dictionary<VariableSummary | string>;
+  // Files the execution opened, if recording them is enabled in the kernel
+  files?: Array<FileAccess>;
+  // Time and memory of the execution, if the kernel profiles it
+  profile?: ExecutionProfile;
+  // Execution the files and the profile belong to, null for executions without history
+  execution_count?: number | null;
+}
+
+/**
+ * Connection to the comm of the extension in one kernel
+ */
+interface SummaryConnection {
+  comm: Kernel.IComm | undefined;
+  closed: boolean;
+  requests: number;
+  pending: Dictionary<(reply: any | undefined) => void>;
+}
+
+var connections: Dictionary<SummaryConnection> = {};
+
+/**
+ * Summarize variables of the kernel after the running execution
+ *
+ * All names are requested with one comm message to the IPython extension of
+ * mlprovlab. Kernels where the extension can not be loaded (other languages
+ * or mlprovlab not installed in the environment of the kernel) are asked
+ * with one inspect request per variable instead. Messages are handled by the
+ * kernel in order, so the summaries describe the variables after an
+ * execution that was requested before. The extension also sends the files
+ * the execution opened if it records them (``%mlprovlab_files on``) and the
+ * profile of the execution, with the execution count of the execution they
+ * belong to.
+ *
+ * @param kernel
+ * @param names Names of the variables
+ */
+export function summarizeVariables(
+  kernel: Kernel.IKernelConnection,
+  names: Array<string>
+): Promise<ExecutionSummary> {
+  const connection = connect(kernel);
+  if (connection.closed) {
+    return inspectVariables(kernel, names).then(texts => ({
+      variables: texts
+    }));
+  }
+
+  // Also sent without names, for the files of the execution
+  const request = connection.requests++;
+  return new Promise<any | undefined>(resolve => {
+    connection.pending[request] = resolve;
+    connection.comm.send({ request: request, names: names });
+  }).then(async reply =>
+    reply
+      ? {
+          variables: reply.summaries || {},
+          files: reply.files,
+          profile: reply.profile,
+          execution_count: reply.execution_count
+        }
+      : { variables: await inspectVariables(kernel, names) }
+  );
+}
+
+/**
+ * Summarize an execution that was just requested
+ *
+ * The kernel has to get the request before the next execution, so it is
+ * sent right away with the names of an earlier analysis of the cell, or
+ * without names if there is none. The files and the profile of the
+ * execution are taken from its reply. Names that only the analysis of the
+ * executed version defines are requested once it arrives.
+ *
+ * @param kernel
+ * @param names Names of an earlier analysis of the cell, if there is one
+ * @param analyzed Names of the analysis of the executed version
+ */
+export async function summarizeExecution(
+  kernel: Kernel.IKernelConnection,
+  names: Array<string> | undefined,
+  analyzed: Promise<Array<string>>
+): Promise<ExecutionSummary> {
+  const requested = names || [];
+  const summary = summarizeVariables(kernel, requested);
+  const missing = (await analyzed).filter(
+    name => requested.indexOf(name) === -1
+  );
+  if (missing.length === 0) {
+    return summary;
+  }
+  const [first, second] = await Promise.all([
+    summary,
+    summarizeVariables(kernel, missing)
+  ]);
+  return {
+    ...first,
+    variables: { ...first.variables, ...second.variables }
+  };
+}
+
+function connect(kernel: Kernel.IKernelConnection): SummaryConnection {
+  var connection = connections[kernel.id];
+  if (connection) {
+    return connection;
+  }
+  connection = connections[kernel.id] = {
+    comm: undefined,
+    closed: false,
+    requests: 0,
+    pending: {}
+  };
+
+  const close = () => {
+    connection.closed = true;
+    // Outstanding requests fall back to inspect requests
+    for (const request in connection.pending) {
+      connection.pending[request](undefined);
+    }
+    connection.pending = {};
+  };
+
+  if (!kernel.handleComms) {
+    close();
+    return connection;
+  }
+
+  // The extension is loaded before the comm is opened, the kernel handles both in order
+  kernel.requestExecute({
+    code: [
+      'try:',
+      "    get_ipython().extension_manager.load_extension('mlprovlab.kernel')",
+      'except Exception:',
+      '    pass'
+    ].join('\n'),
+    silent: true,
+    store_history: false
+  });
+  const comm = kernel.createComm(COMM_TARGET);
+  comm.onMsg = (msg: KernelMessage.ICommMsgMsg) => {
+    const data: any = msg.content.data;
+    const resolve = connection.pending[data.request];
+    if (resolve) {
+      delete connection.pending[data.request];
+      resolve(data);
+    }
+  };
+  // The kernel closes the comm right away if the target is not registered
+  comm.onClose = close;
+  comm.open({});
+  connection.comm = comm;
+
+  // A restarted kernel has to load the extension again
+  const reset = (_: Kernel.IKernelConnection, status: Kernel.Status) => {
+    if (
+      status === 'restarting' ||
+      status === 'autorestarting' ||
+      status === 'dead'
+    ) {
+      kernel.statusChanged.disconnect(reset);
+      delete connections[kernel.id];
+      close();
+    }
+  };
+  kernel.statusChanged.connect(reset);
+  kernel.disposed.connect(() => {
+    delete connections[kernel.id];
+    close();
+  });
+  return connection;
+}
+
+/**
+ * Get the inspect texts of variables without docstrings and source
+ *
+ * @param kernel
+ * @param names
+ */
+async function inspectVariables(
+  kernel: Kernel.IKernelConnection,
+  names: Array<string>
+): Promise<Dictionary<string>> {
+  if (names.length === 0) {
+    return {};
+  }
+  const replies = await Promise.all(
+    names.map(name =>
+      kernel
+        .requestInspect({ code: name.trim(), cursor_pos: 0, detail_level: 1 })
+        .catch(() => undefined)
+    )
+  );
+  const texts: Dictionary<string> = {};
+  names.forEach((name, index) => {
+    const reply: any = replies[index];
+    const text: string =
+      reply && reply.content.status === 'ok' && reply.content.data
+        ? reply.content.data['text/plain']
+        : undefined;
+    if (!text) {
+      texts[name] = '';
+      return;
+    }
+    // Sections start with an ANSI colored title like "Docstring:"
+    const sections = text.split(/(\u001b\[1;31m[\w\s]+:\u001b\[0m)/);
+    var info = '';
+    for (let index = 1; index < sections.length; index += 2) {
+      const title = sections[index];
+      if (
+        title.search('Source:') == -1 &&
+        title.search('Class docstring:') == -1
+      ) {
+        info += title + sections[index + 1];
+      }
+    }
+    texts[name] = info;
+  });
+  return texts;
+}
+
+/**
+ * Text of a variable summary for the execution info
+ *
+ * @param summary Summary or inspect text of older provenance data
+ */
+export function formatSummary(summary: VariableSummary | string): string {
+  if (!summary || typeof summary === 'string') {
+    return summary || '';
+  }
+  const lines = [`Type: ${summary.type}`];
+  if (summary.shape) {
+    lines.push(`Shape: (${summary.shape.join(', ')})`);
+  }
+  if (summary.dtype) {
+    lines.push(`Dtype: ${summary.dtype}`);
+  }
+  if (summary.len !== undefined) {
+    lines.push(`Length: ${summary.len}`);
+  }
+  if (summary.nbytes !== undefined) {
+    lines.push(
+      `Size: ${summary.estimated ? '~' : ''}${formatBytes(summary.nbytes)}`
+    );
+  }
+  if (summary.value !== undefined) {
+    lines.push(`Value: ${summary.value}`);
+  }
+  if (summary.error) {
+    lines.push(`Error: ${summary.error}`);
+  }
+  return lines.join('\n');
+}
+
+/**
+ * Text of the profile of an execution for the execution info
+ *
+ * @param profile
+ */
+export function formatProfile(profile: ExecutionProfile): string {
+  const lines = [
+    `Wall time: ${formatSeconds(profile.wall)}`,
+    `CPU time: ${formatSeconds(profile.cpu)}`
+  ];
+  if (profile.peak_rss_delta !== undefined) {
+    lines.push(
+      `Peak memory: ${formatBytes(profile.peak_rss)} (+${formatBytes(
+        profile.peak_rss_delta
+      )})`
+    );
+  }
+  if (profile.python_peak !== undefined) {
+    lines.push(`Peak Python allocations: ${formatBytes(profile.python_peak)}`);
+  }
+  (profile.allocations || []).forEach(allocation =>
+    lines.push(
+      `  ${allocation.file}:${allocation.line}: ${formatBytes(
+        allocation.size
+      )} in ${allocation.count} blocks`
+    )
+  );
+  lines.push(`Profiling overhead: ${formatSeconds(profile.overhead)}`);
+  return lines.join('\n');
+}
+
+function formatSeconds(seconds: number): string {
+  return seconds < 1
+    ? `${(seconds * 1000).toFixed(1)} ms`
+    : `${seconds.toFixed(2)} s`;
+}
+
+function formatBytes(bytes: number): string {
+  const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+  var index = 0;
+  while (bytes >= 1024 && index < units.length - 1) {
+    bytes /= 1024;
+    index++;
+  }
+  return `${index === 0 ? bytes : bytes.toFixed(1)} ${units[index]}`;
+}
@@ -0,0 +1,267 @@
+import { URLExt } from '@jupyterlab/coreutils';
+
+import { ServerConnection } from '@jupyterlab/services';
+
+import { requestAPI } from './handler';
+import { Dictionary } from './interfaces';
+import { COMPACT_REQUEST, decodeResult } from './wire';
+
+// Connection attempts that fail in a row before edits are analyzed with HTTP requests instead
+const MAX_FAILED_CONNECTIONS = 3;
+
+// Milliseconds before connecting again, doubled with every failed attempt
+const RECONNECT_DELAY = 1000;
+
+/**
+ * Live analysis of the cells of a notebook over the WebSocket /mlprovlab/analyze_socket
+ *
+ * Every edit is sent with a version that increases per cell. The server
+ * debounces the versions of a cell and only answers with the result of the
+ * latest one, results of older versions than one that was applied already
+ * are ignored, so a slow analysis can never overwrite a newer result.
+ * Executions wait for the result of the version they ran with ``analyzed``.
+ */
+export class LiveAnalysis {
+  /**
+   * @param onResult Called with the result of the latest analyzed version of a cell
+   */
+  constructor(onResult?: (cellId: string, result: any) => void) {
+    this.onResult = onResult;
+  }
+
+  /**
+   * Result of the analysis of the current version of a cell
+   *
+   * Resolves right away if it was analyzed already, otherwise as soon as the
+   * result of this or a newer version arrives. Cells that were not edited
+   * since the notebook was loaded and are not in the result of the analysis of
+   * the whole notebook (``set``) yet are analyzed now.
+   *
+   * @param cellId
+   * @param source Current source of the cell
+   */
+  analyzed(cellId: string, source: string): Promise<any> {
+    if (!(cellId in this.versions) && !(cellId in this.results)) {
+      this.update(cellId, source);
+    }
+    const version = this.versions[cellId] || 0;
+    if ((this.applied[cellId] || 0) >= version && cellId in this.results) {
+      return Promise.resolve(this.results[cellId]);
+    }
+    if (this.disposed) {
+      return Promise.reject(new Error('The analysis was disposed.'));
+    }
+    return new Promise<any>((resolve, reject) => {
+      (this.waiting[cellId] = this.waiting[cellId] || []).push({
+        version: version,
+        resolve: resolve,
+        reject: reject
+      });
+    });
+  }
+
+  /**
+   * Latest result of a cell, possibly of an older version than the current one
+   *
+   * @param cellId
+   */
+  latest(cellId: string): any {
+    return this.results[cellId];
+  }
+
+  /**
+   * Set the result of a cell that was analyzed with the whole notebook
+   *
+   * It is ignored if the cell was edited since the notebook was loaded.
+   *
+   * @param cellId
+   * @param result
+   */
+  set(cellId: string, result: any): void {
+    if (!(cellId in this.versions)) {
+      this.apply(cellId, 0, result);
+    }
+  }
+
+  /**
+   * Analyze a new version of a cell
+   *
+   * @param cellId
+   * @param source
+   */
+  update(cellId: string, source: string): void {
+    if (this.disposed) {
+      return;
+    }
+    const version = (this.versions[cellId] || 0) + 1;
+    this.versions[cellId] = version;
+    if (this.http) {
+      this.request(cellId, version, source);
+    } else if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+      this.send(cellId, version, source);
+    } else {
+      // Only the latest version is sent once the connection is open
+      this.unsent[cellId] = source;
+      this.connect();
+    }
+  }
+
+  dispose(): void {
+    this.disposed = true;
+    for (const cellId in this.waiting) {
+      this.settle(cellId, Infinity, new Error('The analysis was disposed.'));
+    }
+    window.clearTimeout(this.reconnect);
+    if (this.socket) {
+      this.socket.close();
+      this.socket = undefined;
+    }
+  }
+
+  private connect(): void {
+    if (this.socket || this.reconnect !== undefined) {
+      return;
+    }
+    const settings = ServerConnection.makeSettings();
+    const query: Dictionary<string> = { format: 'compact' };
+    if (settings.token) {
+      query.token = settings.token;
+    }
+    const url =
+      URLExt.join(settings.wsUrl, 'mlprovlab', 'analyze_socket') +
+      URLExt.objectToQueryString(query);
+
+    var opened = false;
+    const socket = (this.socket = new settings.WebSocket(url));
+    socket.onopen = () => {
+      opened = true;
+      this.failures = 0;
+      for (const cellId in this.unsent) {
+        this.send(cellId, this.versions[cellId], this.unsent[cellId]);
+      }
+      this.unsent = {};
+    };
+    socket.onmessage = (event: MessageEvent) => this.receive(event.data);
+    socket.onclose = () => {
+      if (this.socket === socket) {
+        this.socket = undefined;
+      }
+      if (this.disposed) {
+        return;
+      }
+      // Versions without a result are sent again
+      this.unsent = { ...this.pending, ...this.unsent };
+      this.pending = {};
+      if (!opened) {
+        this.failures++;
+      }
+      if (this.failures >= MAX_FAILED_CONNECTIONS) {
+        // E.g. a proxy that does not pass WebSockets
+        console.warn(
+          'Analyzing cells with HTTP requests, the WebSocket is not available.'
+        );
+        this.http = true;
+        for (const cellId in this.unsent) {
+          this.request(cellId, this.versions[cellId], this.unsent[cellId]);
+        }
+        this.unsent = {};
+        return;
+      }
+      this.reconnect = window.setTimeout(() => {
+        this.reconnect = undefined;
+        this.connect();
+      }, RECONNECT_DELAY * 2 ** this.failures);
+    };
+  }
+
+  private send(cellId: string, version: number, source: string): void {
+    this.pending[cellId] = source;
+    this.socket.send(
+      JSON.stringify({ cell_id: cellId, version: version, source: source })
+    );
+  }
+
+  private receive(message: string): void {
+    const data = JSON.parse(message);
+    if (data.error) {
+      console.error(`Error analyzing code.\n${data.error}`);
+      // The error does not say which update it is about, no result may come for any waiting execution
+      const error = new Error(data.error);
+      for (const cellId in this.waiting) {
+        this.settle(cellId, Infinity, error);
+      }
+      return;
+    }
+    this.apply(data.cell_id, data.version, decodeResult(data.result));
+  }
+
+  private request(cellId: string, version: number, source: string): void {
+    requestAPI<any>('analyze', {
+      body: JSON.stringify({ cell_id: cellId, source: source }),
+      method: 'POST',
+      ...COMPACT_REQUEST
+    })
+      .then(data => this.apply(cellId, version, decodeResult(data)))
+      .catch(reason => {
+        // 409 means a newer version of the cell is analyzed already
+        if (reason.response?.status !== 409) {
+          console.error(`Error analyzing code.\n${reason}`);
+          this.settle(cellId, version, reason);
+        }
+      });
+  }
+
+  private apply(cellId: string, version: number, result: any): void {
+    if (version === this.versions[cellId]) {
+      delete this.pending[cellId];
+    }
+    if (version > (this.applied[cellId] || 0) || !(cellId in this.results)) {
+      this.applied[cellId] = version;
+      this.results[cellId] = result;
+      if (this.onResult) {
+        this.onResult(cellId, result);
+      }
+      this.settle(cellId, version, undefined, result);
+    }
+  }
+
+  // Resolves (or rejects with the error) the executions waiting for a version up to the given one
+  private settle(
+    cellId: string,
+    version: number,
+    error: any,
+    result?: any
+  ): void {
+    const waiting = this.waiting[cellId] || [];
+    const settled = waiting.filter(waiter => waiter.version <= version);
+    this.waiting[cellId] = waiting.filter(waiter => waiter.version > version);
+    if (this.waiting[cellId].length === 0) {
+      delete this.waiting[cellId];
+    }
+    settled.forEach(waiter =>
+      error === undefined ? waiter.resolve(result) : waiter.reject(error)
+    );
+  }
+
+  private onResult: ((cellId: string, result: any) => void) | undefined;
+  private socket: WebSocket | undefined = undefined;
+  private reconnect: number | undefined = undefined;
+  private failures = 0;
+  private http = false;
+  private disposed = false;
+  // Latest sent and applied version by cell id
+  private versions: Dictionary<number> = {};
+  private applied: Dictionary<number> = {};
+  // Sources of the latest versions that wait for the connection or for their result by cell id
+  private unsent: Dictionary<string> = {};
+  private pending: Dictionary<string> = {};
+  // Latest applied result and the executions waiting for a version by cell id
+  private results: Dictionary<any> = {};
+  private waiting: Dictionary<
+    Array<{
+      version: number;
+      resolve: (result: any) => void;
+      reject: (reason: any) => void;
+    }>
+  > = {};
+}
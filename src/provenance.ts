@@ -0,0 +1,294 @@
+import { NotebookPanel } from '@jupyterlab/notebook';
+
+import { requestAPI } from './handler';
+import { CellData, Dictionary, ProvenanceData } from './interfaces';
+
+/**
+ * Number of epochs or executions that are requested at once
+ */
+const PAGE_SIZE = 500;
+
+/**
+ * Summary of the provenance data in the server side store
+ */
+export interface ProvenanceSummary {
+  epochs: number;
+  executions: number;
+  cells: string[];
+}
+
+/**
+ * What is kept in the notebook metadata instead of the provenance data
+ */
+export interface ProvenancePointer {
+  store: string;
+  summary: ProvenanceSummary;
+}
+
+/**
+ * Edge of the dependency graph between two executions of an epoch
+ */
+export interface GraphEdge {
+  source: number;
+  target: number;
+  variable: string;
+  import: boolean;
+}
+
+/**
+ * Edges of the dependency graphs that were already requested by store, epoch and import option
+ */
+var graphs: Dictionary<{
+  version: number;
+  edges: Array<GraphEdge>;
+  update: Promise<void>;
+}> = {};
+
+/**
+ * Provenance data of the open notebooks by the id of their store
+ */
+var provenanceInstances: Dictionary<ProvenanceData> = {};
+
+/**
+ * Loading provenance data by the id of the notebook panel
+ */
+var loading: Dictionary<Promise<ProvenanceData | undefined>> = {};
+
+/**
+ * Get the provenance data of a notebook
+ *
+ * @param notebook
+ * @returns The provenance data or undefined if nothing was recorded (or loaded) yet
+ */
+export function getProvenance(
+  notebook: NotebookPanel
+): ProvenanceData | undefined {
+  //@ts-ignore
+  const metadata: any = notebook.model.metadata.toJSON()['provenance'];
+  if (!metadata) {
+    return undefined;
+  }
+  if (metadata.epochs) {
+    // Old format that is not imported to the store yet
+    return metadata;
+  }
+  return provenanceInstances[metadata.store];
+}
+
+/**
+ * Load the provenance data of a notebook from the store
+ *
+ * Provenance data in the old format (all of it in the notebook metadata) is
+ * imported into the store and replaced by a pointer.
+ *
+ * @param notebook
+ */
+export function loadProvenance(
+  notebook: NotebookPanel
+): Promise<ProvenanceData | undefined> {
+  if (!loading[notebook.id]) {
+    const promise = fetchProvenance(notebook);
+    loading[notebook.id] = promise;
+    // A failed load is tried again the next time instead of failing forever
+    promise.catch(() => {
+      if (loading[notebook.id] === promise) {
+        delete loading[notebook.id];
+      }
+    });
+  }
+  return loading[notebook.id];
+}
+
+async function fetchProvenance(
+  notebook: NotebookPanel
+): Promise<ProvenanceData | undefined> {
+  await notebook.context.ready;
+  //@ts-ignore
+  const metadata: any = notebook.model.metadata.toJSON()['provenance'];
+  if (!metadata) {
+    return undefined;
+  }
+
+  if (metadata.epochs) {
+    const pointer = await requestAPI<ProvenancePointer>('provenance', {
+      body: JSON.stringify(metadata),
+      method: 'POST'
+    });
+    provenanceInstances[pointer.store] = metadata;
+    notebook.model.metadata.set('provenance', pointer as any);
+    return metadata;
+  }
+
+  const store: string = metadata.store;
+  const prov: ProvenanceData = { epochs: [], cells: [] };
+  const summary = await requestAPI<ProvenanceSummary>('provenance/' + store);
+  prov.cells = summary.cells;
+
+  var total = summary.epochs;
+  while (prov.epochs.length < total) {
+    const page = await requestAPI<any>(
+      `provenance/${store}/epochs?offset=${prov.epochs.length}&limit=${PAGE_SIZE}`
+    );
+    total = page.total;
+    if (page.epochs.length === 0) {
+      break;
+    }
+    for (const epoch of page.epochs) {
+      const data: Array<CellData> = [];
+      while (data.length < epoch.executions) {
+        const executions = await requestAPI<any>(
+          `provenance/${store}/epochs/${epoch.epoch}/executions?offset=${data.length}&limit=${PAGE_SIZE}`
+        );
+        if (executions.executions.length === 0) {
+          break;
+        }
+        data.push(...executions.executions);
+      }
+      prov.epochs.push({
+        modules: epoch.modules,
+        data: data,
+        cells: epoch.cells,
+        environment: epoch.environment
+      });
+    }
+  }
+
+  provenanceInstances[store] = prov;
+  return prov;
+}
+
+/**
+ * Append the record of an execution to the provenance data of a notebook
+ *
+ * Only the record is sent to the store, the notebook metadata is updated with
+ * the new summary so listeners of the metadata are notified.
+ *
+ * @param notebook
+ * @param record Provenance data of the execution
+ * @param modules Modules imported by the execution
+ * @param environment Environment of the kernel if the execution starts a new epoch
+ */
+export async function appendExecution(
+  notebook: NotebookPanel,
+  record: CellData,
+  modules: Dictionary<any>,
+  environment?: any
+): Promise<void> {
+  await loadProvenance(notebook);
+
+  //@ts-ignore
+  var pointer: ProvenancePointer = notebook.model.metadata.toJSON()[
+    'provenance'
+  ];
+  if (!pointer) {
+    pointer = await requestAPI<ProvenancePointer>('provenance', {
+      method: 'POST'
+    });
+    provenanceInstances[pointer.store] = { epochs: [], cells: [] };
+  }
+  const prov = provenanceInstances[pointer.store];
+
+  const summary = await requestAPI<ProvenanceSummary>(
+    `provenance/${pointer.store}/executions`,
+    {
+      body: JSON.stringify({
+        record: record,
+        modules: modules,
+        environment: environment
+      }),
+      method: 'POST'
+    }
+  );
+
+  // Apply the same changes to the loaded data
+  if (!prov.cells.includes(record.cell_id)) {
+    prov.cells.push(record.cell_id);
+  }
+  if (environment || prov.epochs.length === 0) {
+    prov.epochs.push({
+      modules: modules || {},
+      data: [record],
+      cells: [record.cell_id],
+      environment: environment
+    });
+  } else {
+    const epoch = prov.epochs[prov.epochs.length - 1];
+    if (!epoch.cells.includes(record.cell_id)) {
+      epoch.cells.push(record.cell_id);
+    }
+    epoch.data.push(record);
+    if (modules) {
+      epoch.modules = { ...epoch.modules, ...modules };
+    }
+  }
+
+  notebook.model.metadata.set('provenance', {
+    store: pointer.store,
+    summary: summary
+  } as any);
+}
+
+/**
+ * Get the edges between the executions of an epoch
+ *
+ * The dependency graph is kept by the server and updated with every
+ * execution. Edges never change once they exist, so only the edges of
+ * executions that are new since the last request are fetched.
+ *
+ * @param notebook
+ * @param epoch Index of the epoch
+ * @param imports Also add edges to the executions that imported a variable
+ */
+export async function getGraph(
+  notebook: NotebookPanel,
+  epoch: number,
+  imports: boolean
+): Promise<Array<GraphEdge>> {
+  //@ts-ignore
+  const metadata: any = notebook.model.metadata.toJSON()['provenance'];
+  if (!metadata || !metadata.store) {
+    return [];
+  }
+  const key = `${metadata.store}/${epoch}/${imports}`;
+  if (!graphs[key]) {
+    graphs[key] = { version: 0, edges: [], update: Promise.resolve() };
+  }
+  const graph = graphs[key];
+
+  // Updates are chained so concurrent renders do not add the same edges twice
+  graph.update = graph.update.then(async () => {
+    try {
+      const delta = await requestAPI<any>(
+        `provenance/${metadata.store}/epochs/${epoch}/graph?since=${
+          graph.version
+        }&imports=${imports ? 1 : 0}`
+      );
+      if (delta.since === graph.version) {
+        graph.edges.push(...delta.edges);
+        graph.version = delta.version;
+      }
+    } catch (reason) {
+      console.error(`Error loading dependency graph.\n${reason}`);
+    }
+  });
+  await graph.update;
+  return graph.edges;
+}
+
+/**
+ * Delete the provenance data of a notebook
+ *
+ * @param notebook
+ */
+export async function deleteProvenance(notebook: NotebookPanel): Promise<void> {
+  //@ts-ignore
+  const metadata: any = notebook.model.metadata.toJSON()['provenance'];
+  if (metadata && metadata.store) {
+    await requestAPI<any>('provenance/' + metadata.store, {
+      method: 'DELETE'
+    });
+    delete provenanceInstances[metadata.store];
+  }
+  delete loading[notebook.id];
+  notebook.model.metadata.delete('provenance');
+}
@@ -0,0 +1,56 @@
+/**
+ * Milliseconds an execution waits for the analysis of its cell before it is not recorded
+ */
+export const ANALYSIS_WAIT_TIMEOUT = 30000;
+
+/**
+ * Runs the steps that record the executions of a notebook one after the other
+ *
+ * Every step starts as soon as the one before it settled, so records are
+ * appended in the order the steps were added without polling. A step that
+ * fails is logged and the next one runs anyway.
+ */
+export class RecordingQueue {
+  /**
+   * Add a step, it runs after all steps that were added before
+   *
+   * @param step
+   * @returns Resolves once the step settled, it never rejects
+   */
+  add(step: () => Promise<void>): Promise<void> {
+    this.last = this.last.then(step).catch(reason => {
+      console.error(`Error storing provenance data.\n${reason}`);
+    });
+    return this.last;
+  }
+
+  private last: Promise<void> = Promise.resolve();
+}
+
+/**
+ * Reject if the promise does not settle within a time
+ *
+ * @param promise
+ * @param milliseconds
+ */
+export function withTimeout<T>(
+  promise: Promise<T>,
+  milliseconds: number
+): Promise<T> {
+  return new Promise<T>((resolve, reject) => {
+    const timer = setTimeout(
+      () => reject(new Error(`No result after ${milliseconds} ms.`)),
+      milliseconds
+    );
+    promise.then(
+      value => {
+        clearTimeout(timer);
+        resolve(value);
+      },
+      reason => {
+        clearTimeout(timer);
+        reject(reason);
+      }
+    );
+  });
+}
@@ -11,6 +11,16 @@ export const renderOnUpdate = createState(false);
  */
 export const renderImports = createState(false);
 
+/**
+ * Profile value shown as heat of the executions in the graph, none if empty
+ */
+export const heatOverlay = createState<'' | 'wall' | 'cpu' | 'memory'>('');
+
+/**
+ * Number of executions in the graph above which executions with few edges are collapsed, never if 0
+ */
+export const collapseThreshold = createState(500);
+
 /**
  * State for zoom on select option
  */
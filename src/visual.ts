@@ -5,9 +5,17 @@ import coseBilkent from 'cytoscape-cose-bilkent';
 //@ts-ignore
 import cxtmenu from 'cytoscape-cxtmenu';
 
-import { CellData, ProvenanceData } from './interfaces';
 import {
+  CellData,
+  Dictionary,
+  ExecutionProfile,
+  ProvenanceData
+} from './interfaces';
+import { getGraph, GraphEdge } from './provenance';
+import {
+  collapseThreshold,
   displayedExecutions,
+  heatOverlay,
   renderImports,
   renderOnUpdate,
   showLastExecute,
@@ -36,7 +44,9 @@ export function InitCytoscape(id: string, app: JupyterFrontEnd, path: string) {
           'text-valign': 'center',
           'text-halign': 'center',
           'font-size': 16,
-          'font-weight': 'bold'
+          'font-weight': 'bold',
+          // Labels are not drawn while they would be too small to read
+          'min-zoomed-font-size': 8
         }
       },
       {
@@ -67,6 +77,7 @@ export function InitCytoscape(id: string, app: JupyterFrontEnd, path: string) {
           'text-margin-x': 0,
           'text-margin-y': 0,
           'font-size': 16,
+          'min-zoomed-font-size': 8,
           'font-weight': 'bold',
           'text-outline-color': '#fff',
           'text-outline-width': 2,
@@ -133,6 +144,23 @@ export function InitCytoscape(id: string, app: JupyterFrontEnd, path: string) {
           'background-opacity': 0.2
         }
       },
+      {
+        // Executions collapsed above the size threshold
+        selector: '.Collapsed',
+        style: {
+          shape: 'roundrectangle',
+          'background-color': '#bdbdbd',
+          'font-size': 12
+        }
+      },
+      {
+        // Heat overlay, relative to the most expensive displayed execution
+        selector: 'node[heat]',
+        style: {
+          'border-width': 6,
+          'border-color': 'mapData(heat, 0, 1, #fff3c4, #d50000)'
+        }
+      },
       {
         selector: '.Import',
         style: {
@@ -148,7 +176,11 @@ export function InitCytoscape(id: string, app: JupyterFrontEnd, path: string) {
     }, // the outer radius (node center to the end of the menu) in pixels. It is added to the rendered size of the node. Can either be a number or function as in the example.
     selector: 'node,edge', // elements matching this Cytoscape.js selector will trigger cxtmenus
     commands: (inputEle: any) => {
-      if (inputEle.isNode() && inputEle.children().length == 0) {
+      if (
+        inputEle.isNode() &&
+        inputEle.children().length == 0 &&
+        !inputEle.classes().includes('Collapsed')
+      ) {
         return [
           {
             fillColor: 'rgba(200, 200, 200, 0.75)', // optional: custom background color for item
@@ -412,8 +444,27 @@ function LayoutCytoscape(cy: cytoscape.Core) {
   }).run();
 }
 
+// Epoch shown by every cytoscape instance, a graph of another epoch is laid out again completely
+var renderedEpochs = new WeakMap<cytoscape.Core, number>();
+
+// Part of the nodes that may be new before the whole graph is laid out again instead of placing them
+const MAX_PLACED_RATIO = 0.25;
+
+// Executions of a cell with at most this many edges are collapsed above the size threshold
+const COLLAPSED_MAX_DEGREE = 1;
+
+// Distance between a placed node and the other nodes
+const PLACEMENT_SPACING = 80;
+
 /**
  * Renders a cytoscape instance with the given provenance information of a notebook panel
+ *
+ * Only the elements that changed since the last render of the same epoch are
+ * removed and added, new nodes are placed next to their cell or the nodes
+ * they are connected with. The whole graph is laid out again for another
+ * epoch or if too much of it is new. Above the threshold of the options the
+ * executions that are not the last of their cell and have few edges are
+ * collapsed into one node per cell.
  * @param cy
  * @param epoch_index
  * @param cell_index
@@ -427,286 +478,314 @@ async function RenderCytoscape(
   prov: ProvenanceData,
   nbPanel: NotebookPanel
 ) {
-  // Remove all old elements
-  cy.remove(cy.elements());
+  // Edges between the executions come from the dependency graph of the server.
+  // They are requested first so the graph is not left half drawn while waiting
+  var edges = await getGraph(nbPanel, epoch_index, renderImports.get());
 
   var epoch = prov.epochs[epoch_index];
   var epoch_cells = epoch.cells;
-  var executed_cells: string[] = [];
-  if (showLastExecute.value) {
-    // Get cell of the last execution
-    var cell_id = epoch.data[cell_index].cell_id;
-    var iter = nbPanel.content.model.cells.iter();
-
-    // Find the corresponding notebook cell if there
-    var nextCellModel = iter.next();
-    while (nextCellModel) {
-      if (nextCellModel.metadata.toJSON()['prov_id'] == cell_id) {
-        break;
+
+  // Cells that are still in the notebook, the others are shown as deleted
+  var notebookCells = new Set<string>();
+  var iter = nbPanel.content.model.cells.iter();
+  var nextCellModel = iter.next();
+  while (nextCellModel) {
+    const prov_id = nextCellModel.metadata.toJSON()['prov_id'];
+    if (prov_id) notebookCells.add(prov_id.toString());
+    nextCellModel = iter.next();
+  }
+
+  // Last execution of every cell up to the selected one
+  var lastExecution: Dictionary<number> = {};
+  for (let index = 0; index <= cell_index; index++) {
+    lastExecution[epoch.data[index].cell_id] = index;
+  }
+  var executed_cells: string[] = showLastExecute.value
+    ? [epoch.data[cell_index].cell_id]
+    : epoch_cells.filter(element => element in lastExecution);
+
+  var edgesByTarget: Array<Array<GraphEdge>> = [];
+  for (let index = 0; index < edges.length; index++) {
+    const edge = edges[index];
+    if (edge.target <= cell_index) {
+      if (!edgesByTarget[edge.target]) edgesByTarget[edge.target] = [];
+      edgesByTarget[edge.target].push(edge);
+    }
+  }
+
+  // An execution depends on a data source if it uses one or an execution using one
+  var dataSources: Array<boolean> = [];
+  for (let index = 0; index <= cell_index; index++) {
+    dataSources[index] =
+      epoch.data[index].data_vars.length != 0 ||
+      (edgesByTarget[index] || []).some(edge => dataSources[edge.source]);
+  }
+
+  // Follow the dependencies of the last executes to all earlier executions
+  var visited: Array<boolean> = [];
+  var stack = executed_cells.map(element => lastExecution[element]);
+  var positions: Array<number> = [];
+  while (stack.length != 0) {
+    const pos = stack.pop();
+    if (visited[pos]) continue;
+    visited[pos] = true;
+    positions.push(pos);
+    (edgesByTarget[pos] || []).forEach(edge => stack.push(edge.source));
+  }
+
+  // Level of detail, the node id of collapsed executions by their own id
+  var collapsedInto: Dictionary<string> = {};
+  const threshold = collapseThreshold.get();
+  if (threshold > 0 && positions.length > threshold) {
+    var degree: Array<number> = [];
+    positions.forEach(pos =>
+      (edgesByTarget[pos] || []).forEach(edge => {
+        degree[pos] = (degree[pos] || 0) + 1;
+        degree[edge.source] = (degree[edge.source] || 0) + 1;
+      })
+    );
+    positions.forEach(pos => {
+      const cell = epoch.data[pos];
+      if (
+        pos !== lastExecution[cell.cell_id] &&
+        (degree[pos] || 0) <= COLLAPSED_MAX_DEGREE
+      ) {
+        collapsedInto[ExecutionId(cell)] = cell.cell_id + '-collapsed';
       }
-      nextCellModel = iter.next();
+    });
+  }
+
+  // Elements of the graph by id
+  var elements: Dictionary<cytoscape.ElementDefinition> = {};
+  const addGroup = (cell_id: string) => {
+    const index = epoch_cells.indexOf(cell_id);
+    if (!elements[cell_id] && index != -1) {
+      elements[cell_id] = {
+        group: 'nodes',
+        data: { id: cell_id, label: 'Cell: ' + (index + 1).toString() },
+        classes: notebookCells.has(cell_id)
+          ? 'top-center'
+          : 'top-center Deleted'
+      };
     }
-    for (let index = 0; index < epoch_cells.length; index++) {
-      const element = epoch_cells[index];
-      if (element == cell_id) {
-        cy.add({
+  };
+  executed_cells.forEach(addGroup);
+  positions.forEach(pos => {
+    const cell = epoch.data[pos];
+    const id = ExecutionId(cell);
+    addGroup(cell.cell_id);
+    if (id in collapsedInto) {
+      if (!elements[collapsedInto[id]]) {
+        elements[collapsedInto[id]] = {
           group: 'nodes',
-          data: { id: cell_id, label: 'Cell: ' + (index + 1).toString() },
-          classes: nextCellModel ? 'top-center' : 'top-center Deleted'
-        });
-        break;
+          classes: 'Collapsed',
+          data: { id: collapsedInto[id], parent: cell.cell_id, executions: [] }
+        };
       }
+      const collapsed = elements[collapsedInto[id]].data;
+      collapsed.executions.push(cell.execution_count);
+      collapsed.label = '+' + collapsed.executions.length.toString();
+    } else {
+      elements[id] = ExecutionElement(cell, epoch_index);
     }
-    executed_cells.push(cell_id);
-  } else {
-    // Look trough all cells in an epoch and see if tey got executed
-    for (let index = 0; index < epoch_cells.length; index++) {
-      const element = epoch_cells[index];
-
-      // See if cell already got executed
-      for (let index2 = 0; index2 <= cell_index; index2++) {
-        const cell = epoch.data[index2];
-        if (cell.cell_id == element) {
-          // Add cell if it got executed already
-          var iter = nbPanel.content.model.cells.iter();
-
-          // Find cell in the notebook panel
-          var nextCellModel = iter.next();
-          while (nextCellModel) {
-            if (nextCellModel.metadata.toJSON()['prov_id'] == element) {
-              break;
-            }
-            nextCellModel = iter.next();
+  });
+  positions.forEach(pos => {
+    const target = epoch.data[pos];
+    (edgesByTarget[pos] || []).forEach(edge => {
+      const remote = epoch.data[edge.source];
+      const target_id =
+        collapsedInto[ExecutionId(target)] || ExecutionId(target);
+      const source_id =
+        collapsedInto[ExecutionId(remote)] || ExecutionId(remote);
+      var edge_id: string = target_id + source_id + edge.variable;
+
+      var edgeClasses = dataSources[edge.source] ? 'DataSource ' : '';
+      edgeClasses += edge.import ? 'Import' : '';
+
+      // Edges between executions collapsed into the same node are left out
+      if (
+        !elements[edge_id] &&
+        target_id != source_id &&
+        target.execution_count != remote.execution_count
+      ) {
+        elements[edge_id] = {
+          group: 'edges',
+          classes: edgeClasses,
+          data: {
+            id: edge_id,
+            target: target_id,
+            source: source_id,
+            execution_count: remote.execution_count.toString(),
+            epoch: epoch_index,
+            source_id: remote.cell_id,
+            label: edge.variable
           }
+        };
+      }
+    });
+  });
 
-          // Add the parent for the cells
-          cy.add({
-            group: 'nodes',
-            data: { id: element, label: 'Cell: ' + (index + 1).toString() },
-            classes: nextCellModel ? 'top-center' : 'top-center Deleted'
-          });
-          executed_cells.push(element);
-          break;
-        }
+  // Profiles of the executions as heat, executions without one are not colored
+  const metric = heatOverlay.get();
+  if (metric) {
+    const values = positions.map(pos =>
+      ProfileValue(epoch.data[pos].profile, metric)
+    );
+    const max = Math.max(0, ...values.filter(value => value !== undefined));
+    positions.forEach((pos, index) => {
+      const element = elements[ExecutionId(epoch.data[pos])];
+      if (element && values[index] !== undefined && max > 0) {
+        element.data.heat = values[index] / max;
       }
-    }
+    });
   }
 
-  var last_executes: Array<{ pos: number; cell: CellData }> = [];
-
-  // Find last execute of an executed cell
-  for (let index = 0; index < executed_cells.length; index++) {
-    const element = executed_cells[index];
-
-    for (let index2 = cell_index; index2 >= 0; index2--) {
-      const cell = epoch.data[index2];
-      if (cell.cell_id == element) {
-        last_executes.push({ pos: index2, cell: cell });
-        break;
+  const incremental = renderedEpochs.get(cy) === epoch_index;
+  renderedEpochs.set(cy, epoch_index);
+  var definitions: Array<cytoscape.ElementDefinition> = [];
+  cy.batch(() => {
+    cy.remove(cy.elements().filter(element => !elements[element.id()]));
+    for (const id in elements) {
+      const existing = cy.$id(id);
+      if (existing.empty()) {
+        definitions.push(elements[id]);
+        continue;
       }
+      // Only the data that may change, the id and the connections are fixed
+      const data: any = { ...elements[id].data };
+      delete data.id;
+      delete data.parent;
+      delete data.source;
+      delete data.target;
+      existing.removeData('heat');
+      existing.data(data);
+      existing.classes(elements[id].classes || '');
     }
-  }
-
-  var edgePromises: Array<Promise<any>> = [];
-
-  // Find connections between last executes and other ones
-  last_executes.forEach(exec => {
-    edgePromises.push(
-      CreateEdges(cy, exec, epoch.data, epoch_index, epoch_cells, nbPanel)
-    );
   });
+  const added = cy.add(definitions);
 
-  await Promise.all(edgePromises);
-  // Rerun layout
-  LayoutCytoscape(cy);
-  var executions: Array<number> = [];
-  cy.$('node:childless').forEach(element => {
-    //@ts-ignore
-    executions.push(element.data()['execution_count']);
-  });
-  displayedExecutions[nbPanel.id].set(executions.sort((a, b) => a - b));
+  if (
+    !incremental ||
+    added.nodes().length > MAX_PLACED_RATIO * cy.nodes().length
+  ) {
+    LayoutCytoscape(cy);
+  } else {
+    PlaceNodes(cy, added.nodes(':childless'));
+  }
+
+  displayedExecutions[nbPanel.id].set(
+    positions
+      .map(pos => epoch.data[pos].execution_count)
+      .sort((a, b) => a - b)
+  );
 }
 
 /**
- * Recursively searches for dependencies of earlier executed cells and creates edges and nodes for them in the graph
+ * Places new nodes next to the other executions of their cell or the nodes they are connected with
  * @param cy
- * @param element
- * @param data
- * @param epoch_index
- * @param epoch_cells
- * @param nbPanel
- * @returns
+ * @param nodes
  */
-async function CreateEdges(
-  cy: cytoscape.Core,
-  element: { pos: number; cell: CellData },
-  data: Array<CellData>,
-  epoch_index: number,
-  epoch_cells: Array<string>,
-  nbPanel: NotebookPanel
-): Promise<boolean> {
-  var edges: Array<{
-    cell: CellData;
-    dataSource: boolean;
-    vars: Array<string>;
-    execution_count: number;
-    pos: number;
-    import: boolean;
-  }> = [];
-  var dataSource = element.cell.data_vars.length != 0;
-
-  // Iterate trough all remote dependencies of a cell
-  for (let i = 0; i < element.cell.remote.length; i++) {
-    const value = element.cell.remote[i];
-
-    // Iterate trough all earlier executions until all dependencies are found
-    for (let index = element.pos; index >= 0; index--) {
-      const remote = data[index];
-
-      // If found remote cell not already exists add it to a list to check itself
-      if (remote.local.includes(value)) {
-        var remoteCell = edges.find(
-          el => el.execution_count == remote.execution_count && !el.import
-        );
-        if (remoteCell) {
-          remoteCell.vars.push(value);
-        } else {
-          edges.push({
-            cell: remote,
-            dataSource: false,
-            vars: [value],
-            execution_count: remote.execution_count,
-            pos: index,
-            import: false
-          });
-        }
-        break;
-        // If imports should be rendered also search for them
-      } else if (renderImports.get() && remote.imports.includes(value)) {
-        var remoteCell = edges.find(
-          el => el.execution_count == remote.execution_count && el.import
-        );
-        if (remoteCell) {
-          remoteCell.vars.push(value);
-        } else {
-          edges.push({
-            cell: remote,
-            dataSource: false,
-            vars: [value],
-            execution_count: remote.execution_count,
-            pos: index,
-            import: true
-          });
-        }
-        break;
-      }
+function PlaceNodes(cy: cytoscape.Core, nodes: cytoscape.NodeCollection) {
+  var placed = cy.nodes(':childless').difference(nodes);
+  nodes.forEach(node => {
+    var anchors = node.siblings().intersection(placed);
+    if (anchors.empty()) {
+      anchors = node.neighborhood('node').intersection(placed);
+    }
+    var x: number;
+    var y: number;
+    if (anchors.empty()) {
+      // Nothing to be next to, right of the graph
+      const box = placed.empty()
+        ? { x2: 0, y1: 0, y2: 0 }
+        : placed.boundingBox({});
+      x = box.x2 + PLACEMENT_SPACING;
+      y = (box.y1 + box.y2) / 2;
+    } else {
+      x = anchors.reduce((sum, anchor) => sum + anchor.position('x'), 0);
+      y = anchors.reduce((sum, anchor) => sum + anchor.position('y'), 0);
+      x /= anchors.length;
+      y /= anchors.length;
     }
-  }
 
-  // Add the target node if its not already there
-  if (!cy.$id(element.cell.cell_id)[0]) {
-    for (let index = 0; index < epoch_cells.length; index++) {
-      const el = epoch_cells[index];
-      if (el == element.cell.cell_id) {
-        var iter = nbPanel.content.model.cells.iter();
-
-        // Search for notebook cell to see if it got deleted
-        var nextCellModel = iter.next();
-        while (nextCellModel) {
-          if (nextCellModel.metadata.toJSON()['prov_id'] == el) {
-            break;
-          }
-          nextCellModel = iter.next();
+    // The first free position on rings around the anchor
+    const positions = placed.map(other => other.position());
+    const free = (px: number, py: number) =>
+      positions.every(
+        position =>
+          Math.abs(position.x - px) >= PLACEMENT_SPACING ||
+          Math.abs(position.y - py) >= PLACEMENT_SPACING
+      );
+    var position = { x: x, y: y };
+    for (let ring = 1; !free(position.x, position.y) && ring <= 20; ring++) {
+      for (let step = 0; step < 8 * ring; step++) {
+        const angle = (2 * Math.PI * step) / (8 * ring);
+        const px = x + ring * PLACEMENT_SPACING * Math.cos(angle);
+        const py = y + ring * PLACEMENT_SPACING * Math.sin(angle);
+        if (free(px, py)) {
+          position = { x: px, y: py };
+          break;
         }
-
-        // Add cell group
-        cy.add({
-          group: 'nodes',
-          data: {
-            id: element.cell.cell_id,
-            label: 'Cell: ' + (index + 1).toString()
-          },
-          classes: nextCellModel ? 'top-center' : 'top-center Deleted'
-        });
-        break;
       }
     }
+    node.position(position);
+    placed = placed.union(node);
+  });
+}
+
+/**
+ * Value of a profile that is shown as heat
+ * @param profile
+ * @param metric
+ */
+function ProfileValue(
+  profile: ExecutionProfile | undefined,
+  metric: 'wall' | 'cpu' | 'memory'
+): number | undefined {
+  if (!profile) {
+    return undefined;
   }
-  if (
-    !cy.$id(element.cell.cell_id + element.cell.execution_count.toString())[0]
-  ) {
-    var class_string = '';
-    if (element.cell.data_vars.length != 0) class_string += 'DataSource';
-    if (element.cell.cell_outputs.length != 0) class_string += 'Output';
-    if (element.cell.type == 'error') class_string += 'Error';
-
-    // Add the execution into the cell group in the graph
-    cy.add({
-      group: 'nodes',
-      classes: class_string,
-      data: {
-        id: element.cell.cell_id + element.cell.execution_count.toString(),
-        parent: element.cell.cell_id,
-        execution_count: element.cell.execution_count,
-        epoch: epoch_index,
-        label: element.cell.execution_count.toString(),
-        data_source: element.cell.data_vars
-      }
-    });
+  if (metric === 'memory') {
+    // The peak of Python allocations where the resident set size is not known
+    return profile.peak_rss_delta !== undefined
+      ? profile.peak_rss_delta
+      : profile.python_peak;
   }
+  return profile[metric];
+}
 
-  for (let index = 0; index < edges.length; index++) {
-    const remote = edges[index];
-    // wait for earlier executions to be created
-    var remoteDataSource = await CreateEdges(
-      cy,
-      { pos: remote.pos - 1, cell: remote.cell },
-      data,
-      epoch_index,
-      epoch_cells,
-      nbPanel
-    );
-    if (remoteDataSource) {
-      dataSource = remoteDataSource;
-    }
-    remote.dataSource = remoteDataSource;
-
-    // creation of the edges between executions
-    for (let i = 0; i < remote.vars.length; i++) {
-      const value = remote.vars[i];
-
-      var edge_id: string =
-        element.cell.cell_id +
-        element.cell.execution_count.toString() +
-        remote.cell.cell_id +
-        remote.execution_count.toString() +
-        value;
-
-      var edgeClasses = remoteDataSource ? 'DataSource ' : '';
-      edgeClasses += remote.import ? 'Import' : '';
+/**
+ * Id of the node of an execution
+ * @param cell
+ */
+function ExecutionId(cell: CellData): string {
+  return cell.cell_id + cell.execution_count.toString();
+}
 
-      // Add the new edge
-      if (
-        !cy.$id(edge_id)[0] &&
-        element.cell.execution_count != remote.execution_count
-      ) {
-        cy.add({
-          group: 'edges',
-          classes: edgeClasses,
-          data: {
-            id: edge_id,
-            target:
-              element.cell.cell_id + element.cell.execution_count.toString(),
-            source: remote.cell.cell_id + remote.execution_count.toString(),
-            execution_count: remote.execution_count.toString(),
-            epoch: epoch_index,
-            source_id: remote.cell.cell_id,
-            label: value
-          }
-        });
-      }
+/**
+ * Node of an execution in the group of its cell
+ * @param cell
+ * @param epoch_index
+ */
+function ExecutionElement(
+  cell: CellData,
+  epoch_index: number
+): cytoscape.ElementDefinition {
+  var class_string = '';
+  if (cell.data_vars.length != 0) class_string += 'DataSource';
+  if (cell.cell_outputs.length != 0) class_string += 'Output';
+  if (cell.type == 'error') class_string += 'Error';
+
+  return {
+    group: 'nodes',
+    classes: class_string,
+    data: {
+      id: ExecutionId(cell),
+      parent: cell.cell_id,
+      execution_count: cell.execution_count,
+      epoch: epoch_index,
+      label: cell.execution_count.toString(),
+      data_source: cell.data_vars
     }
-  }
-
-  return dataSource;
+  };
 }
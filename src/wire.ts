@@ -0,0 +1,104 @@
+import { BodyDefinition, Definition, Dictionary } from './interfaces';
+
+/**
+ * Media type that asks the server for analysis results in the compact format
+ */
+export const COMPACT_MEDIA_TYPE = 'application/vnd.mlprovlab.compact+json';
+
+/**
+ * Request options that negotiate the compact format, see mlprovlab/wire.py
+ */
+export const COMPACT_REQUEST: RequestInit = {
+  headers: { Accept: COMPACT_MEDIA_TYPE }
+};
+
+/**
+ * Definition as tuple:
+ * [type, name, lineno, end_lineno, col_offset, end_col_offset, dependencies, body?, orelse?]
+ */
+type CompactDefinition = Array<any>;
+
+interface Envelope {
+  format: 'compact';
+  version: number;
+  names: Array<string>;
+  result?: Dictionary<any>;
+  results?: Dictionary<Dictionary<any>>;
+}
+
+// Fields of a result that are lists of names
+const NAME_FIELDS = ['local', 'remote', 'imports', 'data_vars'];
+
+function isCompact(data: any): data is Envelope {
+  return (
+    data !== null &&
+    typeof data === 'object' &&
+    data.format === 'compact' &&
+    Array.isArray(data.names)
+  );
+}
+
+/**
+ * Get the result of an analysis, servers that do not know the compact
+ * format answer with the result itself
+ *
+ * @param data Response of /mlprovlab/analyze
+ */
+export function decodeResult(data: any): any {
+  if (!isCompact(data)) {
+    return data;
+  }
+  return decodeFields(data.result, data.names);
+}
+
+/**
+ * Get the results of an analysis by cell id
+ *
+ * @param data Response of /mlprovlab/analyze_batch
+ */
+export function decodeBatch(data: any): Dictionary<any> {
+  if (!isCompact(data)) {
+    return data;
+  }
+  const results: Dictionary<any> = {};
+  for (const cell_id in data.results) {
+    results[cell_id] = decodeFields(data.results[cell_id], data.names);
+  }
+  return results;
+}
+
+function decodeFields(
+  encoded: Dictionary<any>,
+  names: Array<string>
+): Dictionary<any> {
+  const result: Dictionary<any> = { ...encoded };
+  result.definitions = decodeDefinitions(encoded.definitions || [], names);
+  for (const field of NAME_FIELDS) {
+    if (field in encoded) {
+      result[field] = encoded[field].map((index: number) => names[index]);
+    }
+  }
+  return result;
+}
+
+function decodeDefinitions(
+  encoded: Array<CompactDefinition>,
+  names: Array<string>
+): Array<Definition | BodyDefinition> {
+  return encoded.map(item => {
+    const definition: any = { type: names[item[0]] };
+    if (item[1] >= 0) {
+      definition.name = names[item[1]];
+    }
+    definition.lineno = item[2];
+    definition.end_lineno = item[3];
+    definition.col_offset = item[4];
+    definition.end_col_offset = item[5];
+    definition.dependencies = item[6].map((index: number) => names[index]);
+    if (item.length > 7) {
+      definition.body = decodeDefinitions(item[7], names);
+      definition.orelse = decodeDefinitions(item[8], names);
+    }
+    return definition;
+  });
+}